@@ -0,0 +1,27 @@
+import importlib
+import sys
+
+import pytest
+
+
+@pytest.fixture
+def cargar_servicio(tmp_path, monkeypatch):
+    """
+    Carga un servicio contra un sqlite nuevo en tmp_path.
+
+    Recarga `db` con el DATABASE_URL del test, reimporta `models` (metadata
+    limpia), crea el esquema y recarga los módulos pedidos, relativos a
+    `services.<servicio>.app`, en ese orden. Retorna (db, models, *módulos).
+
+        db, models, svc = cargar_servicio("pagos", "services.conciliacion_service")
+    """
+    def _cargar(servicio: str, *modulos: str):
+        paquete = f"services.{servicio}.app"
+        monkeypatch.setenv("DATABASE_URL", f"sqlite:///{tmp_path}/test.db")
+        db = importlib.reload(importlib.import_module(f"{paquete}.db"))
+        sys.modules.pop(f"{paquete}.models", None)
+        models = importlib.import_module(f"{paquete}.models")
+        db.init_db()
+        return (db, models, *(importlib.reload(importlib.import_module(f"{paquete}.{m}")) for m in modulos))
+
+    return _cargar
@@ -0,0 +1,60 @@
+import json, sys
+from datetime import date, datetime
+
+
+def _sembrar(db, models):
+    s = db.SessionLocal()
+    facturas = [
+        # (cliente, total, fecha, estatus)
+        (1, 100.0, datetime(2025, 1, 31, 23, 0), "timbrado"),  # 0 días
+        (1, 50.0, datetime(2025, 1, 1), "timbrado"),  # 30 días
+        (1, 40.0, datetime(2024, 12, 31), "pendiente"),  # 31 días
+        (2, 30.0, datetime(2024, 11, 1), "timbrado"),  # 91 días
+        (2, 20.0, datetime(2024, 11, 2), "timbrado"),  # 90 días
+        (2, 999.0, datetime(2024, 10, 1), "pagado"),
+        (3, 999.0, datetime(2024, 12, 1), "cancelado"),
+        (3, 999.0, datetime(2025, 2, 1), "timbrado"),  # posterior al corte
+        (4, 10.0, datetime(2025, 1, 15), "timbrado"),
+    ]
+    for i, (cliente, total, fecha, estatus) in enumerate(facturas):
+        s.add(models.Factura(uuid=f"U-{i}", cliente_id=cliente, total=total, xml_path="", estatus=estatus,
+                             fecha_emision=fecha, creado_en=fecha))
+    svc = sys.modules['services.facturacion.app.services.aging_service']
+    svc.registrar_zonas(s, {1: "norte", 2: "norte", 4: "sur"})
+    s.commit()
+    s.close()
+
+
+def test_tramos_por_cliente_y_zona(cargar_servicio):
+    db, models, svc = cargar_servicio("facturacion", "services.aging_service")
+    _sembrar(db, models)
+    assert svc.fecha_corte("2024-02") == date(2024, 2, 29)
+    s = db.SessionLocal()
+    por_cliente = svc.calcular(s, "2025-01")
+    assert por_cliente == [
+        {"cliente_id": 1, "zona": "norte", "facturas": 3, "d0_30": 150.0, "d31_60": 40.0, "d61_90": 0.0, "d90_mas": 0.0, "total": 190.0},
+        {"cliente_id": 2, "zona": "norte", "facturas": 2, "d0_30": 0.0, "d31_60": 0.0, "d61_90": 20.0, "d90_mas": 30.0, "total": 50.0},
+        {"cliente_id": 4, "zona": "sur", "facturas": 1, "d0_30": 10.0, "d31_60": 0.0, "d61_90": 0.0, "d90_mas": 0.0, "total": 10.0},
+    ]
+    por_zona = svc.calcular(s, "2025-01", "zona")
+    assert [(z["zona"], z["clientes"], z["total"]) for z in por_zona] == [("norte", 2, 240.0), ("sur", 1, 10.0)]
+    csv = "".join(svc.a_csv(por_zona, "zona")).splitlines()
+    assert csv[0] == "zona,clientes,facturas,d0_30,d31_60,d61_90,d90_mas,total"
+    assert csv[1] == "norte,2,5,150.00,40.00,20.00,30.00,240.00"
+    s.close()
+
+
+def test_periodo_cerrado_se_guarda(cargar_servicio):
+    db, models, svc = cargar_servicio("facturacion", "services.aging_service")
+    _sembrar(db, models)
+    s = db.SessionLocal()
+    primero = svc.reporte(s, "2025-01")
+    guardado = s.get(models.AgingCorte, ("2025-01", "cliente"))
+    assert json.loads(guardado.contenido) == primero
+
+    # Un pago posterior no altera el corte guardado hasta pedir refrescar
+    s.query(models.Factura).filter_by(uuid="U-0").update({"estatus": "pagado"})
+    s.commit()
+    assert svc.reporte(s, "2025-01") == primero
+    assert svc.reporte(s, "2025-01", refrescar=True)[0]["d0_30"] == 50.0
+    s.close()
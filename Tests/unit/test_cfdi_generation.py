@@ -1,8 +1,13 @@
 import os
+import re
+
+import pytest
+
 # Ensure DB driver not required during unit import
 os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
 
 from services.facturacion.app.main import generar_cfdi_xml
+from services.facturacion.app.cfdi import CFDIInconsistente, PlantillaCFDI
 
 
 def test_cfdi_xml_minimo():
@@ -10,3 +15,54 @@ def test_cfdi_xml_minimo():
     assert "Version=\"4.0\"" in xml
     assert "UUID=\"UUID-TEST\"" in xml
     assert "Total=\"123.45\"" in xml
+
+
+def test_cfdi_lote_conceptos_y_escape():
+    emisor = {"rfc": "TEL010101AB1", "nombre": "Telecable & Cía", "regimen": "601", "cp": "64000"}
+    plantilla = PlantillaCFDI(emisor)
+    facturas = [
+        {"uuid": "U-1", "fecha": "2025-01-01T00:00:00", "total": 116.0, "receptor": {"rfc": "GODE561231GR8", "nombre": "Ana <Pérez>"}},
+        {
+            "uuid": "U-2",
+            "fecha": "2025-01-01T00:00:00",
+            "total": 232.0,
+            "conceptos": [
+                {"descripcion": "Internet 100", "valor_unitario": 150.0},
+                {"descripcion": "Renta router", "valor_unitario": 50.0},
+            ],
+        },
+    ]
+    lote = plantilla.render_lote(facturas)
+    assert [bytes(x) for x in lote] == [plantilla.render(f) for f in facturas]
+    uno, dos = (bytes(x).decode("utf-8") for x in lote)
+    assert 'Nombre="Telecable &amp; Cía"' in uno and 'Nombre="Ana &lt;Pérez&gt;"' in uno
+    assert 'SubTotal="100.00"' in uno and 'TotalImpuestosTrasladados="16.00"' in uno
+    assert dos.count("<cfdi:Concepto ") == 2 and 'SubTotal="200.00"' in dos
+
+
+def _importes(xml):
+    sub = float(re.search(r'SubTotal="([\d.]+)"', xml).group(1))
+    total = float(re.search(r' Total="([\d.]+)"', xml).group(1))
+    iva = float(re.search(r'TotalImpuestosTrasladados="([\d.]+)"', xml).group(1))
+    ivas = [float(x) for x in re.findall(r'Importe="([\d.]+)"/></cfdi:Traslados></cfdi:Impuestos></cfdi:Concepto>', xml)]
+    return sub, iva, total, ivas
+
+
+def test_cfdi_totales_salen_de_los_conceptos():
+    plantilla = PlantillaCFDI()
+    # Tres conceptos con IVA de medio centavo: se redondea cada uno y se suman
+    conceptos = [{"descripcion": f"C{i}", "valor_unitario": 0.03} for i in range(3)]
+    sub, iva, total, ivas = _importes(plantilla.render({"uuid": "U", "conceptos": conceptos}).decode())
+    assert ivas == [0.0, 0.0, 0.0] and (sub, iva, total) == (0.09, 0.0, 0.09)
+
+    # Concepto genérico: para cualquier total, IVA del concepto == IVA del comprobante
+    for centavos in (1, 7, 99, 11599, 12345, 99999):
+        t = centavos / 100
+        sub, iva, total, ivas = _importes(plantilla.render({"uuid": "U", "total": t}).decode())
+        assert total == t and round(sub + iva, 2) == total and ivas == [iva]
+
+
+def test_cfdi_total_inconsistente_con_conceptos():
+    conceptos = [{"descripcion": "Internet", "valor_unitario": 100.0}]
+    with pytest.raises(CFDIInconsistente):
+        PlantillaCFDI().render({"uuid": "U", "total": 120.0, "conceptos": conceptos})
@@ -0,0 +1,73 @@
+import importlib
+from datetime import datetime
+
+
+def _pagos(db, models, refs):
+    s = db.SessionLocal()
+    for i, ref in enumerate(refs):
+        s.add(models.Pago(referencia=ref, metodo="spei", monto=100.0 + i, estatus="confirmado"))
+        s.add(models.Conciliacion(referencia=ref, conciliado=i % 2 == 0))
+    s.commit()
+    s.close()
+
+
+def test_reporte_csv_una_consulta_por_bloques(cargar_servicio):
+    db, models, svc = cargar_servicio("pagos", "services.conciliacion_service")
+    _pagos(db, models, ["R1", "R2", "R3"])
+    chunks = list(svc.reporte_csv(bloque=2))
+    # encabezado + 2 bloques de filas
+    assert len(chunks) == 3
+    assert "".join(chunks).splitlines() == [
+        "referencia,monto,estatus,conciliado",
+        "R1,100.00,confirmado,true",
+        "R2,101.00,confirmado,false",
+        "R3,102.00,confirmado,true",
+    ]
+
+
+def test_reporte_incremental_por_marca(cargar_servicio):
+    db, models, svc = cargar_servicio("pagos", "services.conciliacion_service")
+    _pagos(db, models, ["R1", "R2"])
+    assert len("".join(svc.reporte_csv(marca="cron")).splitlines()) == 3
+    assert "".join(svc.reporte_csv(marca="cron")).splitlines() == ["referencia,monto,estatus,conciliado"]
+
+    _pagos(db, models, ["R3"])
+    # Un reporte abandonado a medias no avanza la marca
+    gen = svc.reporte_csv(marca="cron")
+    next(gen)
+    gen.close()
+    assert [l.split(",")[0] for l in "".join(svc.reporte_csv(marca="cron")).splitlines()[1:]] == ["R3"]
+
+    # Otra marca lleva su propia posición
+    assert len("".join(svc.reporte_csv(marca="cierre")).splitlines()) == 4
+
+
+def test_reporte_incremental_incluye_ids_confirmados_fuera_de_orden(cargar_servicio):
+    db, models, svc = cargar_servicio("pagos", "services.conciliacion_service")
+    s = db.SessionLocal()
+    # El id 2 quedó asignado a una transacción que aún no confirma
+    s.add_all([
+        models.Pago(id=1, referencia="R1", metodo="spei", monto=1, estatus="confirmado"),
+        models.Pago(id=3, referencia="R3", metodo="spei", monto=3, estatus="confirmado"),
+    ])
+    s.commit()
+    assert len("".join(svc.reporte_csv(marca="cron")).splitlines()) == 3
+
+    s.add(models.Pago(id=2, referencia="R2", metodo="spei", monto=2, estatus="confirmado"))
+    s.commit()
+    s.close()
+    assert [l.split(",")[0] for l in "".join(svc.reporte_csv(marca="cron")).splitlines()[1:]] == ["R2"]
+    assert "".join(svc.reporte_csv(marca="cron")).splitlines() == ["referencia,monto,estatus,conciliado"]
+
+
+def test_migracion_anota_reportados_de_marcas_previas(cargar_servicio):
+    db, models, svc = cargar_servicio("pagos", "services.conciliacion_service")
+    _pagos(db, models, ["R1", "R2"])
+    s = db.SessionLocal()
+    s.add(models.ConciliacionMarca(nombre="cron", ultimo_pago_id=1, ultimo_creado_en=datetime.utcnow()))
+    s.commit()
+    s.close()
+    migrations = importlib.import_module('services.pagos.app.migrations')
+    with db.engine.begin() as conn:
+        migrations._0008_conciliacion_reportados(conn)
+    assert [l.split(",")[0] for l in "".join(svc.reporte_csv(marca="cron")).splitlines()[1:]] == ["R2"]
@@ -0,0 +1,52 @@
+import importlib
+
+
+def test_emision_lote_bulk(cargar_servicio, monkeypatch):
+    db, models, svc = cargar_servicio("facturacion", "services.emision_service")
+    subidos = []
+    monkeypatch.setattr(svc.storage, "subir_objetos", lambda objs: subidos.extend(k for k, _, _ in objs))
+    lote = [{"cliente_id": i, "total": 100.0 + i} for i in range(1, 6)]
+    session = db.SessionLocal()
+    try:
+        out = svc.emitir_lote(session, lote)
+        session.commit()
+        assert [f["cliente_id"] for f in out] == [1, 2, 3, 4, 5]
+        assert sorted(subidos) == sorted(f"{f['uuid']}.xml" for f in out)
+        ids = {f["uuid"]: f["id"] for f in out}
+        for fac in session.query(models.Factura).all():
+            assert ids[fac.uuid] == fac.id
+            assert fac.estatus == "pendiente"
+    finally:
+        session.close()
+
+
+def test_emision_lote_empaquetado(cargar_servicio, monkeypatch):
+    db, models, svc = cargar_servicio("facturacion", "services.emision_service")
+    paquetes = []
+    monkeypatch.setattr(svc.storage, "EMPAQUETADO", "zip")
+    monkeypatch.setattr(svc.storage, "subir_objeto", lambda key, body, ct, **kw: paquetes.append((key, body)))
+    session = db.SessionLocal()
+    try:
+        out = svc.emitir_lote(session, [{"cliente_id": 1, "total": 1.0}] * 3)
+        session.commit()
+        assert len(paquetes) == 1 and paquetes[0][0].endswith(".zip")
+        paths = {f.xml_path for f in session.query(models.Factura).all()}
+        assert paths == {f"{paquetes[0][0]}#{f['uuid']}.xml" for f in out}
+    finally:
+        session.close()
+
+
+def test_generar_masiva_idempotente(cargar_servicio, monkeypatch):
+    db, models, svc = cargar_servicio("facturacion", "services.emision_service")
+    monkeypatch.setattr(svc.storage, "subir_objetos", lambda objs: [])
+    importlib.reload(importlib.import_module('services.facturacion.app.services.timbrado_service'))
+    main = importlib.reload(importlib.import_module('services.facturacion.app.main'))
+    lote = [{"cliente_id": 1, "total": 299.0}, {"cliente_id": 2, "total": 99.0}]
+
+    primera = main.generar_masiva(lote, idempotency_key="saga-1")
+    # Reintento de la saga con la misma llave: mismas facturas, sin duplicar
+    assert main.generar_masiva(lote, idempotency_key="saga-1") == primera
+    assert main.generar_masiva(lote, idempotency_key="saga-2") != primera
+    s = db.SessionLocal()
+    assert s.query(models.Factura).count() == 4
+    s.close()
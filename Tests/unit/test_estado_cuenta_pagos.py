@@ -0,0 +1,95 @@
+import io
+from datetime import datetime
+
+import pytest
+
+
+def _pago(s, models, ref, monto, fecha, provider_tx=None):
+    s.add(models.Pago(referencia=ref, metodo="spei", monto=monto, estatus="confirmado", creado_en=fecha))
+    s.add(models.Conciliacion(referencia=ref, conciliado=False))
+    s.add(models.Transaccion(pago_ref=ref, provider="SPEI", provider_tx=provider_tx or f"TX-{ref}"))
+
+
+def test_reglas_exacta_aproximada_y_ventana(cargar_servicio):
+    db, models, svc = cargar_servicio("pagos", "services.estado_cuenta_service")
+    s = db.SessionLocal()
+    _pago(s, models, "P1", 299.0, datetime(2025, 1, 10))
+    _pago(s, models, "P2", 499.0, datetime(2025, 1, 11), provider_tx="RASTREO-2")
+    _pago(s, models, "P3", 349.0, datetime(2025, 1, 12))
+    _pago(s, models, "P4", 349.0, datetime(2025, 1, 20))
+    _pago(s, models, "P5", 999.0, datetime(2025, 1, 12))
+    s.commit()
+
+    csv = (
+        "Fecha,Referencia,Importe,Concepto\n"
+        "2025-01-10,P1,299.00,SPEI\n"
+        "11/01/2025,RASTREO-2,\"498.50\",SPEI con comision\n"
+        "2025-01-13,,349.00,Deposito sin referencia\n"
+        "2025-01-13,,1500.00,Sin pago\n"
+        "2025-01-13,,-50.00,Comision\n"
+    )
+    res = svc.conciliar_estado_cuenta(s, io.BytesIO(csv.encode()), "estado.csv")
+    s.commit()
+    assert res["movimientos"] == 5
+    assert res["conciliados"] == {"exacta": 1, "referencia_monto": 1, "monto_fecha": 1}
+    assert res["sin_conciliar"] == 2
+
+    estatus = {p.referencia: p.estatus for p in s.query(models.Pago).all()}
+    assert estatus == {"P1": "conciliado", "P2": "conciliado", "P3": "conciliado", "P4": "confirmado", "P5": "confirmado"}
+    assert {c.referencia for c in s.query(models.Conciliacion).filter_by(conciliado=True)} == {"P1", "P2", "P3"}
+
+    with pytest.raises(svc.EstadoCuentaDuplicado):
+        svc.conciliar_estado_cuenta(s, io.BytesIO(csv.encode()), "estado.csv")
+    s.close()
+
+
+def test_ofx_y_pago_no_se_asigna_dos_veces(cargar_servicio):
+    db, models, svc = cargar_servicio("pagos", "services.estado_cuenta_service")
+    s = db.SessionLocal()
+    _pago(s, models, "P1", 299.0, datetime(2025, 2, 1))
+    s.commit()
+    ofx = (
+        "OFXHEADER:100\n<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>\n"
+        "<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20250201120000<TRNAMT>299.00<FITID>A1<MEMO>Pago\n"
+        "<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20250202<TRNAMT>299.00<FITID>A2<NAME>Otro\n"
+        "</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>\n"
+    )
+    movs = list(svc.parsear_estado_cuenta(io.BytesIO(ofx.encode()), "banco.ofx"))
+    assert [(m.referencia, m.monto, m.descripcion) for m in movs] == [("A1", 299.0, "Pago"), ("A2", 299.0, "Otro")]
+
+    res = svc.conciliar_estado_cuenta(s, io.BytesIO(ofx.encode()), "banco.ofx")
+    s.commit()
+    assert res["conciliados"] == {"monto_fecha": 1}
+    assert res["sin_conciliar"] == 1
+    asignado = s.query(models.MovimientoBancario).filter(models.MovimientoBancario.pago_ref.isnot(None)).one()
+    assert asignado.referencia == "A1"
+    s.close()
+
+
+def test_por_bloques_y_referencia_larga(cargar_servicio, monkeypatch):
+    db, models, svc = cargar_servicio("pagos", "services.estado_cuenta_service")
+    monkeypatch.setattr(svc, "BLOQUE_ESCRITURA", 2)
+    s = db.SessionLocal()
+    for i in range(5):
+        _pago(s, models, f"P{i}", 100.0, datetime(2025, 3, 1 + i))
+    s.commit()
+    # P0 se asigna en el primer bloque: su referencia en el tercero ya no lo encuentra
+    csv = "fecha,referencia,monto\n" + "".join(f"2025-03-0{1 + i},P{i},100.00\n" for i in range(4))
+    csv += f"2025-03-05,{'X' * 150},100.00\n2025-03-01,P0,100.00\n"
+    res = svc.conciliar_estado_cuenta(s, io.BytesIO(csv.encode()), "estado.csv")
+    s.commit()
+    assert res == {"archivo_hash": res["archivo_hash"], "movimientos": 6,
+                   "conciliados": {"exacta": 4, "monto_fecha": 1}, "sin_conciliar": 1}
+    largo = s.query(models.MovimientoBancario).filter_by(linea=6).one()
+    assert largo.referencia == "X" * 100 and largo.pago_ref == "P4"
+    assert s.query(models.MovimientoBancario).filter_by(linea=7).one().pago_ref is None
+    s.close()
+
+
+
+def test_candidatos_bloqueados_con_skip_locked():
+    from sqlalchemy.dialects import postgresql
+    from services.pagos.app.services import estado_cuenta_service as svc
+
+    stmt = svc._consulta_candidatos(datetime(2025, 1, 1), datetime(2025, 2, 1))
+    assert "FOR UPDATE OF pagos SKIP LOCKED" in str(stmt.compile(dialect=postgresql.dialect()))
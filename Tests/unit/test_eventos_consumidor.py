@@ -0,0 +1,127 @@
+import json, os
+
+
+def _escribir(path, *ids, modo="a"):
+    with open(path, modo, encoding="utf-8") as f:
+        for i in ids:
+            f.write(json.dumps({"topic": "ClienteCreado", "payload": {"cliente_id": i}}) + "\n")
+
+
+def _consumidor(svc, path, recibidos, grupo="facturacion", **kw):
+    c = svc.ConsumidorEventos(grupo=grupo, path=str(path), **kw)
+    c.suscribir("ClienteCreado", lambda payloads: recibidos.extend(p["cliente_id"] for p in payloads))
+    return c
+
+
+def test_offset_durable_por_grupo(cargar_servicio, tmp_path):
+    db, models, svc = cargar_servicio("facturacion", "services.eventos_service")
+    log = tmp_path / "events.log"
+    _escribir(log, 1, 2, 3)
+    recibidos = []
+    c = _consumidor(svc, log, recibidos)
+    assert c.drenar() == 3
+    _escribir(log, 4)
+    assert c.drenar() == 1
+    c.cerrar()
+
+    # Reinicio: continúa desde el offset confirmado, sin releer
+    recibidos_2 = []
+    c2 = _consumidor(svc, log, recibidos_2)
+    _escribir(log, 5)
+    c2.drenar()
+    assert recibidos == [1, 2, 3, 4]
+    assert recibidos_2 == [5]
+
+    # Otro grupo tiene su propio offset y lee todo
+    otro = []
+    _consumidor(svc, log, otro, grupo="auditoria").drenar()
+    assert otro == [1, 2, 3, 4, 5]
+
+
+def test_linea_incompleta_y_corrupta(cargar_servicio, tmp_path):
+    db, models, svc = cargar_servicio("facturacion", "services.eventos_service")
+    log = tmp_path / "events.log"
+    _escribir(log, 1)
+    with open(log, "a", encoding="utf-8") as f:
+        f.write("no-es-json\n")
+        f.write('{"topic": "ClienteCreado", "payload": {"cliente_id": 2')
+    recibidos = []
+    c = _consumidor(svc, log, recibidos, batch_bytes=16)
+    c.drenar()
+    assert recibidos == [1]
+    with open(log, "a", encoding="utf-8") as f:
+        f.write("}}\n")
+    c.drenar()
+    assert recibidos == [1, 2]
+
+
+def test_rotacion_y_truncado(cargar_servicio, tmp_path):
+    db, models, svc = cargar_servicio("facturacion", "services.eventos_service")
+    log = tmp_path / "events.log"
+    _escribir(log, 1, 2)
+    recibidos = []
+    c = _consumidor(svc, log, recibidos)
+    c.drenar()
+
+    # Rotación: lo pendiente del archivo viejo se termina de leer y luego el nuevo desde 0
+    _escribir(log, 3)
+    os.rename(log, tmp_path / "events.log.1")
+    _escribir(log, 10, 11)
+    c.drenar()
+    assert recibidos == [1, 2, 3, 10, 11]
+
+    # Compactación en sitio: el archivo queda más chico que el offset
+    _escribir(log, 20, modo="w")
+    c.drenar()
+    assert recibidos[-1] == 20
+
+
+def test_fallo_de_manejador_no_avanza_offset(cargar_servicio, tmp_path):
+    db, models, svc = cargar_servicio("facturacion", "services.eventos_service")
+    log = tmp_path / "events.log"
+    _escribir(log, 1, 2)
+    recibidos, intentos = [], []
+
+    def _inestable(payloads):
+        intentos.append(len(payloads))
+        if len(intentos) == 1:
+            raise RuntimeError("db caída")
+        recibidos.extend(p["cliente_id"] for p in payloads)
+
+    c = svc.ConsumidorEventos(path=str(log), max_reintentos=3)
+    c.suscribir("ClienteCreado", _inestable)
+    try:
+        c.drenar()
+        assert False, "debió propagar el fallo"
+    except svc.ManejadorFallido:
+        pass
+    # Reinicio tras el fallo: el offset no avanzó, se reciben los dos
+    c.cerrar()
+    c2 = svc.ConsumidorEventos(path=str(log), max_reintentos=3)
+    c2.suscribir("ClienteCreado", _inestable)
+    assert c2.drenar() == 2
+    assert recibidos == [1, 2]
+
+
+def test_dead_letter_tras_agotar_reintentos(cargar_servicio, tmp_path):
+    db, models, svc = cargar_servicio("facturacion", "services.eventos_service")
+    log = tmp_path / "events.log"
+    _escribir(log, 7)
+
+    def _siempre_falla(payloads):
+        raise ValueError("zona inválida")
+
+    c = svc.ConsumidorEventos(path=str(log), max_reintentos=2)
+    c.suscribir("ClienteCreado", _siempre_falla)
+    try:
+        c.drenar()
+    except svc.ManejadorFallido:
+        pass
+    # Segundo intento: se aparca en eventos_fallidos y el offset avanza
+    assert c.drenar() == 1
+    assert c.drenar() == 0
+    s = db.SessionLocal()
+    fallidos = s.query(models.EventoFallido).all()
+    assert [(f.topic, json.loads(f.payload)["cliente_id"]) for f in fallidos] == [("ClienteCreado", 7)]
+    assert "zona inválida" in fallidos[0].error
+    s.close()
@@ -0,0 +1,38 @@
+import asyncio, importlib, io, json
+
+
+class _BusFallido:
+    async def publicar_lote(self, eventos):
+        raise ConnectionError("broker caído")
+
+
+def test_evento_en_mismo_commit_y_relay_al_log(cargar_servicio, tmp_path):
+    db, models, svc, lote, main = cargar_servicio("pagos", "services.eventos_outbox_service", "services.lote_pagos_service", "main")
+    main.crear_pago(main.PagoIn(cliente_id=7, monto=100.0))
+    main.procesar_pago({"monto": 50.0, "cliente_id": 8}, idempotency_key=None)
+    s = db.SessionLocal()
+    lote.importar_lote(s, io.BytesIO(b"cliente_id,monto\n9,10\n9,20\n"), "a.csv")
+    assert s.query(models.EventoOutbox).count() == 4
+    s.close()
+
+    # Bus caído: nada se borra y el lote se reintenta después
+    relay = svc.RelayEventos(bus=_BusFallido())
+    try:
+        asyncio.run(relay.publicar_una_vez())
+    except ConnectionError:
+        pass
+    s = db.SessionLocal()
+    assert s.query(models.EventoOutbox).count() == 4
+    s.close()
+
+    log = tmp_path / "events.log"
+    relay = svc.RelayEventos(bus=importlib.import_module('services.pagos.app.events').EventBus(path=str(log)), batch=3)
+    assert asyncio.run(relay.publicar_una_vez()) == 3
+    assert asyncio.run(relay.publicar_una_vez()) == 1
+    eventos = [json.loads(x) for x in log.read_text().splitlines()]
+    assert {e["topic"] for e in eventos} == {"PagoRegistrado"}
+    assert [e["payload"]["cliente_id"] for e in eventos] == [7, 8, 9, 9]
+    assert len({e["payload"]["evento_id"] for e in eventos}) == 4
+    s = db.SessionLocal()
+    assert s.query(models.EventoOutbox).count() == 0
+    s.close()
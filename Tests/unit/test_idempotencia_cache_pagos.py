@@ -0,0 +1,52 @@
+import importlib
+
+
+def test_lru_responde_sin_base_y_expira():
+    idem = importlib.import_module('services.pagos.app.services.idempotencia_service')
+    cache = idem.CacheLRU(max_items=2, ttl=60)
+    cache.set("a", "1")
+    cache.set("b", "2")
+    cache.get("a")
+    cache.set("c", "3")
+    assert cache.get("b") is None and cache.get("a") == "1"
+    expirada = idem.CacheLRU(ttl=-1)
+    expirada.set("x", "1")
+    assert expirada.get("x") is None
+
+
+def test_llave_en_misma_transaccion_y_cache(cargar_servicio):
+    db, models, idem, main = cargar_servicio("pagos", "services.idempotencia_service", "main")
+    r1 = main.procesar_pago({"monto": 50.0}, idempotency_key="K-1")
+    s = db.SessionLocal()
+    fila = s.query(models.IdempotencyKey).filter_by(key="K-1").one()
+    assert fila.reference == r1["referencia"]
+    # El reintento lo responde la LRU aunque la fila ya no esté
+    s.delete(fila)
+    s.commit()
+    s.close()
+    assert main.procesar_pago({"monto": 50.0}, idempotency_key="K-1") == r1
+
+    # Con la LRU vacía responde la cache compartida
+    idem.compartido = idem.CacheLRU()
+    idem.recordar("K-2", '{"referencia": "R-2"}')
+    idem.lru.clear()
+    assert main.procesar_pago({"monto": 1.0}, idempotency_key="K-2") == {"referencia": "R-2"}
+
+
+def test_carrera_devuelve_respuesta_ganadora(cargar_servicio, monkeypatch):
+    db, models, idem, main = cargar_servicio("pagos", "services.idempotencia_service", "main")
+    ganador = main.procesar_pago({"monto": 10.0}, idempotency_key="K-R")
+    idem.lru.clear()
+    real = idem.buscar
+    llamadas = []
+
+    def _buscar(db_, key):
+        # Simula que la primera lectura ocurrió antes del commit del ganador
+        llamadas.append(key)
+        return None if len(llamadas) == 1 else real(db_, key)
+
+    monkeypatch.setattr(idem, "buscar", _buscar)
+    assert main.procesar_pago({"monto": 10.0}, idempotency_key="K-R") == ganador
+    s = db.SessionLocal()
+    assert s.query(models.Pago).count() == 1
+    s.close()
@@ -0,0 +1,75 @@
+import importlib, io, json
+
+import pytest
+
+
+CSV = (
+    "cliente_id,monto,metodo,referencia,factura_uuid\n"
+    "1,350.00,efectivo,OXXO-1,F-1\n"
+    "2,199.00,,OXXO-2,\n"
+    "x,10,efectivo,OXXO-3,\n"
+    "4,50.00,efectivo,OXXO-1,\n"
+    "5,-1,efectivo,,\n"
+    "6,80.00,efectivo,,\n"
+)
+
+
+def test_csv_por_bloques_con_resultado_por_fila(cargar_servicio):
+    db, models, svc = cargar_servicio("pagos", "services.lote_pagos_service")
+    s = db.SessionLocal()
+    res = svc.importar_lote(s, io.BytesIO(CSV.encode("utf-8")), "oxxo.csv", chunk_size=2)
+    assert (res["procesados"], res["exitosos"], res["duplicados"], res["fallidos"]) == (6, 3, 1, 2)
+    assert [r["linea"] for r in res["resultados"]] == [2, 3, 4, 5, 6, 7]
+    assert [r["estatus"] for r in res["resultados"]] == ["ok", "ok", "error", "duplicado", "error", "ok"]
+
+    assert s.query(models.Pago).count() == 3
+    assert s.query(models.Transaccion).count() == 3 and s.query(models.Conciliacion).count() == 3
+    pago = s.query(models.Pago).filter_by(referencia="OXXO-1").one()
+    assert (pago.metodo, pago.estatus, pago.monto) == ("efectivo", "conciliado", 350.0)
+    assert s.query(models.Pago).filter_by(referencia="OXXO-2").one().metodo == "spei"
+    # El pago con factura deja su aviso en el outbox
+    assert [o.factura_uuid for o in s.query(models.FacturaPagadaOutbox)] == ["F-1"]
+
+    # Reimportar el mismo archivo no duplica las filas con referencia del socio
+    res = svc.importar_lote(s, io.BytesIO(CSV.encode("utf-8")), "oxxo.csv")
+    assert res["duplicados"] == 3 and res["exitosos"] == 1
+    assert s.query(models.Pago).count() == 4
+    s.close()
+
+
+def test_ndjson_detectado_por_contenido(cargar_servicio):
+    db, models, svc = cargar_servicio("pagos", "services.lote_pagos_service")
+    lineas = [json.dumps({"cliente_id": i, "monto": 10.0 * i, "provider_tx": f"T-{i}"}) for i in range(1, 4)]
+    raw = io.BytesIO(("\n".join(lineas[:2]) + "\n{roto\n\n" + lineas[2] + "\n").encode("utf-8"))
+    s = db.SessionLocal()
+    res = svc.importar_lote(s, raw)
+    assert [(r["linea"], r["estatus"]) for r in res["resultados"]] == [(1, "ok"), (2, "ok"), (3, "error"), (5, "ok")]
+    assert sorted(t.provider_tx for t in s.query(models.Transaccion)) == ["T-1", "T-2", "T-3"]
+    s.close()
+
+
+def test_csv_sin_encabezado_es_invalido(cargar_servicio):
+    db, models, svc = cargar_servicio("pagos", "services.lote_pagos_service")
+    s = db.SessionLocal()
+    with pytest.raises(svc.LoteInvalido):
+        svc.importar_lote(s, io.BytesIO(b"1,2,3\n"), "a.csv")
+    s.close()
+
+
+def test_referencia_reservada_en_tabla_global(cargar_servicio):
+    db, models, svc = cargar_servicio("pagos", "services.lote_pagos_service")
+    s = db.SessionLocal()
+    # Referencia reservada por otra transacción (o en otra partición): el lote la respeta
+    s.add(models.PagoReferencia(referencia="OXXO-2"))
+    s.commit()
+    res = svc.importar_lote(s, io.BytesIO(CSV.encode("utf-8")), "oxxo.csv")
+    assert [r["estatus"] for r in res["resultados"] if r.get("referencia") == "OXXO-2"] == ["duplicado"]
+    assert s.query(models.Pago).filter_by(referencia="OXXO-2").count() == 0
+    assert s.query(models.PagoReferencia).count() == 3
+
+    main = importlib.import_module('services.pagos.app.main')
+    importlib.reload(main)
+    with pytest.raises(main.HTTPException) as exc:
+        main.procesar_pago({"referencia": "OXXO-1", "monto": 1}, idempotency_key=None)
+    assert exc.value.status_code == 409
+    s.close()
@@ -0,0 +1,155 @@
+import asyncio, csv, importlib, io, os, time
+from datetime import datetime, timedelta
+
+import pytest
+
+
+def _load(cargar_servicio, tmp_path, monkeypatch):
+    db, models = cargar_servicio("facturacion")
+    # Sin reload: el módulo registra métricas de Prometheus al importarse
+    svc = importlib.import_module('services.facturacion.app.services.facturacion_lote_service')
+    monkeypatch.setattr(svc, "SessionLocal", db.SessionLocal)
+    monkeypatch.setattr(svc, "Factura", models.Factura)
+    monkeypatch.setattr(svc, "LoteJob", models.LoteJob)
+    monkeypatch.setattr(svc, "EXPORT_DIR", str(tmp_path / "exports"))
+    return db, models, svc
+
+
+CSV = (
+    "cliente_id,plan_id,monto,folio_interno\n"
+    "1,1,350.00,F-001\n"
+    "2,2,499.00,F-002\n"
+    "3,3,-1,F-003\n"
+    "4,1,199.00,F-001\n"
+    "5,1,99.00,F-004\n"
+)
+
+
+def test_lote_por_bloques_con_upsert(cargar_servicio, tmp_path, monkeypatch):
+    db, models, svc = _load(cargar_servicio, tmp_path, monkeypatch)
+    raw = io.BytesIO(CSV.encode("utf-8"))
+    res = asyncio.run(svc.procesar_lote_stream(raw, "lote_test.csv", idem=True, chunk_size=2))
+    assert res["procesados"] == 5
+    assert res["exitosos"] == 4 and res["fallidos"] == 1
+
+    s = db.SessionLocal()
+    facs = {f.uuid: f for f in s.query(models.Factura).all()}
+    s.close()
+    assert set(facs) == {"F-001", "F-002", "F-004"}
+    # La última aparición del folio gana en modo idempotente
+    assert facs["F-001"].cliente_id == 4 and facs["F-001"].total == 199.0
+
+    with open(tmp_path / "exports" / "lote_test.csv", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert [r["estatus"] for r in rows] == ["OK", "OK", "ERROR", "OK", "OK"]
+
+
+def test_lote_estricto_marca_duplicados(cargar_servicio, tmp_path, monkeypatch):
+    db, models, svc = _load(cargar_servicio, tmp_path, monkeypatch)
+    asyncio.run(svc.procesar_lote_stream(io.BytesIO(CSV.encode()), "a.csv", idem=True, chunk_size=2))
+    res = asyncio.run(svc.procesar_lote_stream(io.BytesIO(CSV.encode()), "b.csv", idem=False, chunk_size=2))
+    assert res["exitosos"] == 0
+    assert res["fallidos"] == 5
+
+
+def test_lote_reanuda_desde_checkpoint(cargar_servicio, tmp_path, monkeypatch):
+    db, models, svc = _load(cargar_servicio, tmp_path, monkeypatch)
+    original = svc._procesar_chunk
+    llamadas = []
+
+    def _falla_en_segundo(*args, **kwargs):
+        llamadas.append(1)
+        if len(llamadas) == 2:
+            raise RuntimeError("caída simulada")
+        return original(*args, **kwargs)
+
+    monkeypatch.setattr(svc, "_procesar_chunk", _falla_en_segundo)
+    with pytest.raises(RuntimeError):
+        asyncio.run(svc.procesar_lote_stream(io.BytesIO(CSV.encode()), "r.csv", chunk_size=2))
+
+    s = db.SessionLocal()
+    job = s.query(models.LoteJob).one()
+    assert (job.estatus, job.ultima_fila) == ("fallido", 2)
+    assert s.query(models.Factura).count() == 2
+    s.close()
+
+    res = asyncio.run(svc.procesar_lote_stream(io.BytesIO(CSV.encode()), "otro.csv", chunk_size=2))
+    assert res["reanudado_desde"] == 2
+    assert res["procesados"] == 5 and res["csv_resultado"] == "r.csv"
+    with open(tmp_path / "exports" / "r.csv", newline="") as f:
+        assert len(list(csv.DictReader(f))) == 5
+
+
+def test_job_asincrono_encola_y_procesa(cargar_servicio, tmp_path, monkeypatch):
+    db, models, svc = _load(cargar_servicio, tmp_path, monkeypatch)
+    job = svc._encolar_job(io.BytesIO(CSV.encode()), True, 2)
+    assert job.estatus == "en_cola" and job.total_filas == 5
+
+    assert asyncio.run(svc.procesar_siguiente_job()) is True
+    assert asyncio.run(svc.procesar_siguiente_job()) is False
+    estado = asyncio.run(svc.estado_job(job.id))
+    assert estado["estatus"] == "completado"
+    assert (estado["procesados"], estado["exitosos"], estado["fallidos"]) == (5, 4, 1)
+    assert os.path.exists(svc.ruta_resultado(estado["csv_resultado"]))
+    # La copia del upload se borra al completar
+    assert os.listdir(tmp_path / "exports" / "uploads") == []
+
+
+def test_limpieza_borra_uploads_huerfanos(cargar_servicio, tmp_path, monkeypatch):
+    db, models, svc = _load(cargar_servicio, tmp_path, monkeypatch)
+    job = svc._encolar_job(io.BytesIO(CSV.encode()), True, 2)
+    uploads = tmp_path / "exports" / "uploads"
+    huerfano = uploads / "huerfano.csv"
+    huerfano.write_text(CSV)
+    reciente = uploads / ".tmp-reciente"
+    reciente.write_text(CSV)
+    viejo = time.time() - svc.LOTE_JOB_STALE_SEGUNDOS - 1
+    os.utime(huerfano, (viejo, viejo))
+    os.utime(job.archivo_path, (viejo, viejo))
+
+    assert svc._limpiar_uploads() == 1
+    assert sorted(os.listdir(uploads)) == sorted([".tmp-reciente", os.path.basename(job.archivo_path)])
+
+
+def test_lote_sincrono_no_toma_job_en_curso(cargar_servicio, tmp_path, monkeypatch):
+    db, models, svc = _load(cargar_servicio, tmp_path, monkeypatch)
+    job = svc._encolar_job(io.BytesIO(CSV.encode()), True, 2)
+    with pytest.raises(svc.LoteEnCurso):
+        asyncio.run(svc.procesar_lote_stream(io.BytesIO(CSV.encode()), "s.csv", chunk_size=2))
+
+    # Un job 'en_proceso' de un worker vivo tampoco; uno sin avance reciente sí se reanuda
+    s = db.SessionLocal()
+    fila = s.get(models.LoteJob, job.id)
+    fila.estatus = "en_proceso"
+    s.commit()
+    with pytest.raises(svc.LoteEnCurso):
+        asyncio.run(svc.procesar_lote_stream(io.BytesIO(CSV.encode()), "s.csv", chunk_size=2))
+    fila.actualizado_en = datetime.utcnow() - timedelta(seconds=svc.LOTE_JOB_STALE_SEGUNDOS + 1)
+    s.commit()
+    s.close()
+    res = asyncio.run(svc.procesar_lote_stream(io.BytesIO(CSV.encode()), "s.csv", chunk_size=2))
+    assert res["procesados"] == 5
+
+
+def test_job_sincrono_caido_se_retoma_con_subida_asincrona(cargar_servicio, tmp_path, monkeypatch):
+    db, models, svc = _load(cargar_servicio, tmp_path, monkeypatch)
+    # Un request síncrono abrió el job y murió: 'en_proceso' sin copia del archivo
+    s = db.SessionLocal()
+    hash_csv = svc._hash_archivo(io.BytesIO(CSV.encode()))
+    svc._abrir_job(s, hash_csv, "sync.csv")
+    s.close()
+
+    # Mientras parece vivo, la subida asíncrona le deja la copia sin tomarlo
+    job = svc._encolar_job(io.BytesIO(CSV.encode()), True, 2)
+    assert job.estatus == "en_proceso" and job.archivo_path
+    assert asyncio.run(svc.procesar_siguiente_job()) is False
+
+    # Sin avance reciente: otra subida lo vuelve a encolar y el worker lo termina
+    s = db.SessionLocal()
+    s.get(models.LoteJob, job.id).actualizado_en = datetime.utcnow() - timedelta(seconds=svc.LOTE_JOB_STALE_SEGUNDOS + 1)
+    s.commit()
+    s.close()
+    assert svc._encolar_job(io.BytesIO(CSV.encode()), True, 2).estatus == "en_cola"
+    assert asyncio.run(svc.procesar_siguiente_job()) is True
+    estado = asyncio.run(svc.estado_job(job.id))
+    assert (estado["estatus"], estado["procesados"], estado["csv_resultado"]) == ("completado", 5, "sync.csv")
@@ -0,0 +1,29 @@
+import importlib, os, sqlite3, sys
+
+from sqlalchemy import inspect, text
+
+
+def test_migracion_agrega_columnas_e_indices(tmp_path):
+    path = tmp_path / "legacy.db"
+    con = sqlite3.connect(path)
+    con.execute(
+        "CREATE TABLE facturas (id INTEGER PRIMARY KEY, uuid VARCHAR(64) UNIQUE, cliente_id INTEGER,"
+        " total FLOAT, xml_path VARCHAR(255), estatus VARCHAR(20), creado_en DATETIME)"
+    )
+    con.execute("INSERT INTO facturas VALUES (1, 'U-1', 1, 10.0, 'x.xml', 'pendiente', '2025-01-01 00:00:00')")
+    con.commit()
+    con.close()
+
+    os.environ['DATABASE_URL'] = f"sqlite:///{path}"
+    db = importlib.import_module('services.facturacion.app.db')
+    importlib.reload(db)
+    sys.modules.pop('services.facturacion.app.models', None)
+    sys.modules.pop('services.facturacion.app.migrations', None)
+    db.init_db()
+    db.init_db()  # idempotente
+
+    indices = {ix["name"] for ix in inspect(db.engine).get_indexes("facturas")}
+    assert {"ix_facturas_cliente_creado", "ix_facturas_estatus_emision", "ix_facturas_fecha_emision"} <= indices
+    with db.engine.connect() as conn:
+        assert conn.execute(text("SELECT fecha_emision FROM facturas")).scalar() == "2025-01-01 00:00:00"
+        assert conn.execute(text("SELECT count(*) FROM facturacion_migraciones")).scalar() == 2
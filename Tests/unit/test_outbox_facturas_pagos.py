@@ -0,0 +1,74 @@
+import asyncio, json
+
+import httpx
+
+
+def _despachar(outbox, handler):
+    async def _flujo():
+        despachador = outbox.DespachadorFacturas(base_url="http://facturacion", transport=httpx.MockTransport(handler))
+        despachador._client = despachador._crear_cliente()
+        try:
+            return await despachador.despachar_una_vez()
+        finally:
+            await despachador._client.aclose()
+
+    return asyncio.run(_flujo())
+
+
+def test_pago_conciliado_encola_y_despacha_en_lote(cargar_servicio):
+    db, models, outbox, main = cargar_servicio("pagos", "services.outbox_facturas_service", "main")
+    for uuid in ("F-1", "F-2", "F-1"):
+        main.crear_pago(main.PagoIn(cliente_id=1, monto=10.0, factura_uuid=uuid))
+    main.crear_pago(main.PagoIn(cliente_id=1, monto=10.0))
+    s = db.SessionLocal()
+    assert s.query(models.FacturaPagadaOutbox).count() == 3
+    s.close()
+
+    llamadas = []
+
+    def handler(request):
+        llamadas.append((request.method, request.url.path, json.loads(request.content)))
+        return httpx.Response(200, json={"pagadas": ["F-1", "F-2"], "ya_pagadas": [], "no_encontradas": []})
+
+    assert _despachar(outbox, handler) == 3
+    # Una sola llamada con los uuid sin repetir
+    assert llamadas == [("PATCH", "/facturacion/pagar-lote", {"uuids": ["F-1", "F-2"]})]
+    s = db.SessionLocal()
+    assert s.query(models.FacturaPagadaOutbox).count() == 0
+    s.close()
+
+
+def test_fallo_y_no_encontradas_se_reintentan_con_backoff(cargar_servicio):
+    db, models, outbox, main = cargar_servicio("pagos", "services.outbox_facturas_service", "main")
+    s = db.SessionLocal()
+    outbox.encolar(s, "F-1", "R-1")
+    outbox.encolar(s, "F-2", "R-2")
+    s.commit()
+    s.close()
+
+    assert _despachar(outbox, lambda request: httpx.Response(503)) == 2
+    s = db.SessionLocal()
+    filas = s.query(models.FacturaPagadaOutbox).all()
+    assert [f.intentos for f in filas] == [1, 1]
+    assert all(f.estatus == "pendiente" and f.ultimo_error for f in filas)
+    s.close()
+    # Con backoff vigente no se reclama nada
+    assert outbox.reclamar() == []
+
+    s = db.SessionLocal()
+    s.query(models.FacturaPagadaOutbox).update({"proximo_intento": models.FacturaPagadaOutbox.creado_en})
+    s.commit()
+    s.close()
+    respuesta = {"pagadas": ["F-1"], "ya_pagadas": [], "no_encontradas": ["F-2"]}
+    assert _despachar(outbox, lambda request: httpx.Response(200, json=respuesta)) == 2
+    s = db.SessionLocal()
+    fila = s.query(models.FacturaPagadaOutbox).one()
+    assert (fila.factura_uuid, fila.intentos, fila.ultimo_error) == ("F-2", 2, "factura no encontrada")
+    s.close()
+
+    # Al agotar intentos el aviso queda fallido y deja de reclamarse
+    outbox.OUTBOX_MAX_INTENTOS = 3
+    outbox.reprogramar([fila.id], "timeout")
+    s = db.SessionLocal()
+    assert s.query(models.FacturaPagadaOutbox).one().estatus == "fallido"
+    s.close()
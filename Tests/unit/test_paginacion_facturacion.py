@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta
+
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+
+SERVICIO = (
+    "facturacion",
+    "services.resumen_service",
+    "services.emision_service",
+    "services.timbrado_service",
+    "main",
+)
+
+
+def _sembrar(db, models, n):
+    s = db.SessionLocal()
+    base = datetime(2025, 1, 1)
+    for i in range(n):
+        # Misma fecha por pares: el id desempata el cursor
+        fecha = base + timedelta(minutes=i // 2)
+        s.add(models.Factura(uuid=f"U-{i}", cliente_id=1, total=float(i), xml_path="x", estatus="pendiente",
+                             creado_en=fecha, fecha_emision=fecha))
+    s.commit()
+    s.close()
+
+
+def _paginas(client, url, limit):
+    vistos, cursor, paginas = [], None, 0
+    while True:
+        r = client.get(url, params={"limit": limit, **({"after": cursor} if cursor else {})})
+        assert r.status_code == 200
+        vistos += [f["uuid"] for f in r.json()]
+        paginas += 1
+        cursor = r.headers.get("X-Next-Cursor")
+        if not cursor:
+            return vistos, paginas
+
+
+def test_paginacion_keyset_sin_huecos_ni_repetidos(cargar_servicio):
+    db, models, *_, main = cargar_servicio(*SERVICIO)
+    _sembrar(db, models, 7)
+    client = TestClient(main.app)
+    esperado = [f"U-{i}" for i in reversed(range(7))]
+
+    # Los cortes de página caen entre facturas con la misma fecha
+    for url in ("/facturacion/ultimas", "/facturacion/cliente/1"):
+        assert _paginas(client, url, 3) == (esperado, 3)
+        # Página exacta: la última trae cursor y la siguiente llega vacía
+        vistos, paginas = _paginas(client, url, 7)
+        assert (vistos, paginas) == (esperado, 2)
+
+
+def test_ultimas_omite_facturas_sin_fecha_emision(cargar_servicio):
+    db, models, *_, main = cargar_servicio(*SERVICIO)
+    _sembrar(db, models, 3)
+    s = db.SessionLocal()
+    s.add(models.Factura(uuid="U-null", cliente_id=1, total=1.0, xml_path="x", estatus="pendiente",
+                         creado_en=datetime(2025, 2, 1)))
+    s.commit()
+    # El default de la columna aplica al insertar; NULL explícito con un UPDATE
+    s.execute(text("UPDATE facturas SET fecha_emision = NULL WHERE uuid = 'U-null'"))
+    s.commit()
+    s.close()
+    client = TestClient(main.app)
+    # Sin fecha_emision no se codifica cursor ni se rompe el orden
+    assert _paginas(client, "/facturacion/ultimas", 1) == (["U-2", "U-1", "U-0"], 4)
+
+
+def test_cursor_invalido_400(cargar_servicio):
+    db, models, *_, main = cargar_servicio(*SERVICIO)
+    client = TestClient(main.app)
+    for cursor in ("no-es-base64!", "YWJj"):
+        assert client.get("/facturacion/ultimas", params={"after": cursor}).status_code == 400
+        assert client.get("/facturacion/cliente/1", params={"after": cursor}).status_code == 400
+
+
+def test_cors_expone_x_next_cursor(cargar_servicio):
+    db, models, *_, main = cargar_servicio(*SERVICIO)
+    _sembrar(db, models, 2)
+    r = TestClient(main.app).get("/facturacion/ultimas?limit=1", headers={"Origin": "http://backoffice"})
+    assert r.headers["X-Next-Cursor"]
+    assert "x-next-cursor" in r.headers["access-control-expose-headers"].lower()
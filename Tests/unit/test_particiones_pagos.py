@@ -0,0 +1,49 @@
+import importlib
+from datetime import date, datetime
+
+from fastapi.testclient import TestClient
+from sqlalchemy.dialects import postgresql
+
+
+def test_rangos_y_nombres_mensuales():
+    part = importlib.import_module('services.pagos.app.particiones')
+    assert part.sumar_meses(date(2024, 11, 1), 3) == date(2025, 2, 1)
+    assert part.sumar_meses(date(2025, 1, 1), -1) == date(2024, 12, 1)
+    assert list(part.meses(date(2024, 12, 15), date(2025, 2, 1))) == [date(2024, 12, 1), date(2025, 1, 1), date(2025, 2, 1)]
+    assert part.ddl_particion("pagos", date(2024, 12, 1)) == (
+        "CREATE TABLE IF NOT EXISTS pagos_p202412 PARTITION OF pagos "
+        "FOR VALUES FROM ('2024-12-01') TO ('2025-01-01')"
+    )
+
+
+def test_conversion_incluye_llave_de_particion_en_restricciones():
+    part = importlib.import_module('services.pagos.app.particiones')
+    ddl = part.ddl_conversion(postgresql.dialect(), "pagos", date(2025, 1, 1), date(2025, 3, 1))
+    assert ddl[1] == "ALTER TABLE pagos RENAME TO pagos_legacy"
+    assert "PARTITION BY RANGE (creado_en)" in ddl[2]
+    assert sum("PARTITION OF pagos FOR VALUES" in x for x in ddl) == 3
+    # La copia va antes del DROP y las restricciones después de la copia
+    assert ddl.index("INSERT INTO pagos SELECT * FROM pagos_legacy") < ddl.index("DROP TABLE pagos_legacy")
+    assert "ALTER TABLE pagos ADD PRIMARY KEY (id, creado_en)" in ddl
+    assert "ALTER TABLE pagos ADD CONSTRAINT pagos_referencia_key UNIQUE (referencia, creado_en)" in ddl
+    assert any("ix_pagos_pendientes" in x and "WHERE estatus <> 'conciliado'" in x for x in ddl)
+
+
+def test_archivo_respeta_retencion():
+    part = importlib.import_module('services.pagos.app.particiones')
+    nombres = ["pagos_default", "pagos_p202401", "pagos_p202402", "pagos_p202403", "transacciones_p202401"]
+    # Retener 12 meses desde marzo 2025: se archiva lo que termina antes de marzo 2024
+    assert part.particiones_a_archivar(nombres, "pagos", date(2025, 3, 10), 12) == ["pagos_p202401", "pagos_p202402"]
+
+
+def test_pagos_cliente_ventana_solo_con_meses(cargar_servicio):
+    db, models, main = cargar_servicio("pagos", "main")
+    s = db.SessionLocal()
+    for ref, creado in (("P-viejo", datetime(2000, 1, 1)), ("P-nuevo", datetime.utcnow())):
+        s.add(models.Pago(referencia=ref, cliente_id=7, metodo="spei", monto=10, estatus="confirmado", creado_en=creado))
+    s.commit()
+    s.close()
+    client = TestClient(main.app)
+    # Sin `meses` no se filtra por fecha: el historial completo sigue visible
+    assert [p["referencia"] for p in client.get("/pagos/cliente/7").json()] == ["P-nuevo", "P-viejo"]
+    assert [p["referencia"] for p in client.get("/pagos/cliente/7?meses=24").json()] == ["P-nuevo"]
@@ -0,0 +1,50 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import text
+
+
+def _sembrar(db, models, n):
+    s = db.SessionLocal()
+    base = datetime(2025, 1, 1)
+    for i in range(n):
+        # Misma fecha por pares: el id desempata el cursor
+        s.add(models.Pago(referencia=f"R-{i}", metodo="spei", monto=float(i), cliente_id=1,
+                          estatus="conciliado" if i % 3 == 0 else "confirmado",
+                          creado_en=base + timedelta(minutes=i // 2)))
+    s.commit()
+    s.close()
+
+
+def test_paginacion_por_cursor_recorre_todo_sin_repetir(cargar_servicio):
+    db, models, svc = cargar_servicio("pagos", "services.pendientes_service")
+    _sembrar(db, models, 20)
+    s = db.SessionLocal()
+    vistos, cursor = [], None
+    while True:
+        pagos, cursor = svc.pagina(s, cursor, limite=4)
+        vistos += [p["referencia"] for p in pagos]
+        if cursor is None:
+            break
+    assert vistos == [f"R-{i}" for i in range(20) if i % 3]
+    # El índice parcial existe y el planificador lo usa
+    plan = " ".join(str(r) for r in s.execute(
+        text("EXPLAIN QUERY PLAN " + str(svc._consulta(None).limit(5).compile(compile_kwargs={"literal_binds": True})))
+    ))
+    assert "ix_pagos_pendientes" in plan
+    s.close()
+    with pytest.raises(svc.CursorInvalido):
+        svc.decodificar_cursor("no-es-cursor")
+
+
+def test_ndjson_desde_cursor(cargar_servicio):
+    db, models, svc = cargar_servicio("pagos", "services.pendientes_service")
+    _sembrar(db, models, 10)
+    s = db.SessionLocal()
+    primera, cursor = svc.pagina(s, None, limite=2)
+    s.close()
+    lineas = "".join(svc.stream_ndjson(cursor, bloque=2)).splitlines()
+    resto = [json.loads(x) for x in lineas]
+    assert [p["referencia"] for p in primera + resto] == [f"R-{i}" for i in range(10) if i % 3]
+    assert set(resto[0]) == {"referencia", "metodo", "monto", "estatus", "clienteId", "creadoEn", "facturaUuid"}
@@ -0,0 +1,66 @@
+import httpx
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+from services.orquestador.app import proxy_router, upstreams
+
+
+def _app(monkeypatch, handler):
+    registro = upstreams.RegistroClientes({"red": "http://red:8020"}, transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(proxy_router, "registro_clientes", registro)
+    app = FastAPI()
+    app.include_router(proxy_router.router)
+    return TestClient(app)
+
+
+def _conteo(fase):
+    return REGISTRY.get_sample_value(
+        "orquestador_upstream_latencia_segundos_count", {"upstream": "red", "fase": fase}
+    ) or 0.0
+
+
+def test_proxy_streaming_reenvia_cuerpos_por_chunks(monkeypatch):
+    recibido = {}
+
+    async def _chunks():
+        for i in range(50):
+            yield f"linea-{i}\n".encode()
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        recibido["url"] = str(request.url)
+        recibido["body"] = await request.aread()
+        recibido["host"] = request.headers["host"]
+        return httpx.Response(207, headers={"X-Red": "1"}, content=_chunks())
+
+    antes_total, antes_cab = _conteo("total"), _conteo("cabeceras")
+    with _app(monkeypatch, handler) as client:
+        payload = b"x" * 200_000
+        r = client.post("/router/diagnostico/R-1?detalle=1", content=payload)
+    assert r.status_code == 207
+    assert r.headers["x-red"] == "1"
+    assert r.text.splitlines()[-1] == "linea-49"
+    assert recibido["url"] == "http://red:8020/router/diagnostico/R-1?detalle=1"
+    assert recibido["body"] == payload
+    assert recibido["host"] == "red:8020"
+    assert _conteo("total") == antes_total + 1
+    assert _conteo("cabeceras") == antes_cab + 1
+
+
+def test_proxy_sin_body_y_upstream_caido(monkeypatch):
+    async def _json():
+        yield b'{"routers": []}'
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("caido"):
+            raise httpx.ConnectError("sin ruta", request=request)
+        assert await request.aread() == b""
+        # MockTransport lee por adelantado los cuerpos no-stream; un generador
+        # se comporta como un upstream real
+        return httpx.Response(200, headers={"Content-Type": "application/json"}, content=_json())
+
+    with _app(monkeypatch, handler) as client:
+        assert client.get("/router/listado").json() == {"routers": []}
+        r = client.get("/router/caido")
+    assert r.status_code == 502
+    assert "ConnectError" in r.json()["detail"]
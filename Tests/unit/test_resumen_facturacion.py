@@ -0,0 +1,72 @@
+import importlib
+
+
+def test_rollup_incremental_coincide_con_reconstruccion(cargar_servicio, monkeypatch):
+    db, models, resumen, emision, timbrado = cargar_servicio("facturacion", "services.resumen_service", "services.emision_service", "services.timbrado_service")
+    monkeypatch.setattr(emision.storage, "subir_objetos", lambda objs: [])
+    s = db.SessionLocal()
+    lote = [{"cliente_id": 1, "total": 100.0}, {"cliente_id": 2, "total": 50.0}, {"cliente_id": 2, "total": 25.0}]
+    out = emision.emitir_lote(s, lote)
+    timbrado.encolar_timbrado(s, [f["id"] for f in out])
+    s.commit()
+    timbrado.procesar_lote_timbrado()
+
+    fac = s.query(models.Factura).filter_by(uuid=out[2]["uuid"]).one()
+    resumen.registrar(s, resumen.cambio(fac.creado_en, fac.cliente_id, fac.total, fac.estatus, "pagado"))
+    fac.estatus = "pagado"
+    s.commit()
+
+    incremental = (resumen.stats(s), resumen.kpis(s))
+    assert incremental[0] == {"total": 3, "timbradas": 2, "pendientes": 0, "canceladas": 0}
+    assert incremental[1] == {
+        "clientes_activos": 2,
+        "morosos": 0,
+        "ingresos_mensuales": 25.0,
+        "facturas_emitidas": 3,
+    }
+    resumen.reconstruir(s)
+    assert (resumen.stats(s), resumen.kpis(s)) == incremental
+    s.close()
+
+
+def test_pagar_lote_actualiza_rollup(cargar_servicio, monkeypatch):
+    db, models, resumen, emision, timbrado = cargar_servicio("facturacion", "services.resumen_service", "services.emision_service", "services.timbrado_service")
+    monkeypatch.setattr(emision.storage, "subir_objetos", lambda objs: [])
+    main = importlib.reload(importlib.import_module('services.facturacion.app.main'))
+    s = db.SessionLocal()
+    out = emision.emitir_lote(s, [{"cliente_id": 1, "total": 100.0}, {"cliente_id": 2, "total": 40.0}])
+    s.commit()
+
+    r = main.marcar_pagadas_lote(main.PagarLoteIn(uuids=[out[0]["uuid"], out[1]["uuid"], "NO-EXISTE"]))
+    assert sorted(r["pagadas"]) == sorted(f["uuid"] for f in out)
+    assert r["no_encontradas"] == ["NO-EXISTE"]
+    # Reintento del outbox: idempotente, no vuelve a sumar al rollup
+    r = main.marcar_pagadas_lote(main.PagarLoteIn(uuids=[out[0]["uuid"]]))
+    assert r == {"pagadas": [], "ya_pagadas": [out[0]["uuid"]], "no_encontradas": []}
+
+    incremental = (resumen.stats(s), resumen.kpis(s))
+    assert incremental[1]["ingresos_mensuales"] == 140.0
+    resumen.reconstruir(s)
+    assert (resumen.stats(s), resumen.kpis(s)) == incremental
+    s.close()
+
+
+def test_reconstruir_sobrescribe_y_borra_llaves_sin_facturas(cargar_servicio, monkeypatch):
+    db, models, resumen, emision, timbrado = cargar_servicio("facturacion", "services.resumen_service", "services.emision_service", "services.timbrado_service")
+    monkeypatch.setattr(emision.storage, "subir_objetos", lambda objs: [])
+    s = db.SessionLocal()
+    emision.emitir_lote(s, [{"cliente_id": 1, "total": 100.0}, {"cliente_id": 2, "total": 50.0}])
+    s.commit()
+    esperado = (resumen.stats(s), resumen.kpis(s))
+
+    # Rollup desviado: conteo inflado y una llave sin facturas detrás
+    s.query(models.FacturaResumenDiario).update({"cantidad": 7})
+    s.add(models.FacturaResumenCliente(cliente_id=9, estatus="timbrado", cantidad=3))
+    s.commit()
+    assert resumen.reconstruir(s) is True
+    assert (resumen.stats(s), resumen.kpis(s)) == esperado
+    assert s.query(models.FacturaResumenCliente).filter_by(cliente_id=9).first() is None
+    # Repetir no choca con las llaves existentes
+    assert resumen.reconstruir(s) is True
+    assert (resumen.stats(s), resumen.kpis(s)) == esperado
+    s.close()
@@ -0,0 +1,88 @@
+import json
+
+from fastapi.testclient import TestClient
+
+from services.orquestador.app import main, router_lote, router_status
+
+
+def _linea(rid, cliente_id=1, estado="online", velocidad=100):
+    return json.dumps({"router_id": rid, "cliente_id": cliente_id, "estado": estado, "velocidad_mbps": velocidad})
+
+
+def test_ndjson_reporta_lineas_invalidas_y_aplica_el_resto():
+    raw = "\n".join([
+        _linea("R-1"),
+        _linea("R-2", estado="apagado"),
+        _linea("R-3", estado="offline"),
+        _linea("R-4", velocidad=5000),
+        "",
+    ]).encode()
+    filas, errores, recibidos = router_lote.parsear(raw, "application/x-ndjson")
+    assert recibidos == 4
+    assert [f[0] for f in filas] == ["R-1", "R-3"]
+    assert [(e["linea"], e["campo"]) for e in errores] == [(2, "estado"), (4, "velocidad_mbps")]
+
+    # JSON roto: se cae a validar línea por línea
+    filas, errores, _ = router_lote.parsear(raw + b"{no-json\n" + _linea("R-5").encode())
+    assert [f[0] for f in filas] == ["R-1", "R-3", "R-5"]
+    assert [e["linea"] for e in errores] == [2, 4, 5]
+
+
+def test_ndjson_varios_objetos_en_una_linea_y_numeros_fisicos():
+    # `{..},{malo}` desfasa los índices del arreglo respecto a las líneas
+    raw = "\n".join([_linea("R-1") + "," + _linea("R-2", estado="apagado"), _linea("R-3")]).encode()
+    filas, errores, recibidos = router_lote.parsear(raw)
+    assert recibidos == 2
+    assert [f[0] for f in filas] == ["R-3"]
+    assert [e["linea"] for e in errores] == [1]
+
+    # Varios objetos válidos en una línea tampoco cuentan como varias líneas
+    filas, errores, _ = router_lote.parsear((_linea("R-1") + "," + _linea("R-2")).encode())
+    assert filas == [] and [e["linea"] for e in errores] == [1]
+
+    # Las líneas en blanco cuentan para el número de línea reportado
+    raw = "\n\n".join([_linea("R-1"), _linea("R-2", estado="apagado"), _linea("R-3")]).encode()
+    filas, errores, _ = router_lote.parsear(raw)
+    assert [f[0] for f in filas] == ["R-1", "R-3"]
+    assert [(e["linea"], e["campo"]) for e in errores] == [(3, "estado")]
+
+
+def test_binario_ida_y_vuelta():
+    items = [
+        {"router_id": "R-ñ", "cliente_id": 9, "estado": "instalando", "velocidad_mbps": 0},
+        {"router_id": "R-2", "cliente_id": 0, "estado": "online", "velocidad_mbps": 10},
+    ]
+    filas, errores, recibidos = router_lote.parsear(router_lote.codificar_binario(items))
+    assert recibidos == 2
+    assert filas == [("R-ñ", 9, router_status.CODIGOS["instalando"], 0)]
+    assert errores == [{"linea": 2, "error": "valor fuera de rango"}]
+
+
+def test_endpoint_lote_y_websocket(monkeypatch):
+    monkeypatch.setattr(main, "router_status_store", router_status.AlmacenLocal(shards=4))
+    client = TestClient(main.app)
+    raw = "\n".join(_linea(f"R-{i}", estado="offline" if i % 2 else "online") for i in range(10))
+    r = client.post("/router/status/lote", content=raw, headers={"Content-Type": "application/x-ndjson"})
+    assert r.status_code == 200
+    assert r.json()["aceptados"] == 10
+    assert r.json()["reset"] == [f"R-{i}" for i in range(1, 10, 2)]
+    assert client.get("/router/status/R-3").json()["estado"] == "offline"
+
+    r = client.post("/router/status/lote", content=router_lote.MAGIC + b"\x05R-", headers={"Content-Type": router_lote.CONTENT_TYPE_BINARIO})
+    assert r.status_code == 400
+
+    maximo = router_lote.LOTE_MAX_BYTES
+    monkeypatch.setattr(router_lote, "LOTE_MAX_BYTES", 64)
+    r = client.post("/router/status/lote", content=raw, headers={"Content-Type": "application/x-ndjson"})
+    assert r.status_code == 413
+    monkeypatch.setattr(router_lote, "LOTE_MAX_BYTES", maximo)
+
+    with client.websocket_connect("/router/status/ws") as ws:
+        ws.send_bytes(router_lote.codificar_binario([{"router_id": "R-ws", "cliente_id": 2, "estado": "online", "velocidad_mbps": 300}]))
+        assert ws.receive_json()["aceptados"] == 1
+        ws.send_text(_linea("R-ws", estado="offline"))
+        assert ws.receive_json()["reset"] == ["R-ws"]
+        # Un mensaje con índices desfasados no tumba la conexión
+        ws.send_text(_linea("R-a") + "," + _linea("R-b", estado="apagado") + "\n" + _linea("R-ws", estado="offline"))
+        assert ws.receive_json()["aceptados"] == 1
+    assert client.get("/router/status/R-ws").json()["estado"] == "offline"
@@ -0,0 +1,48 @@
+import time
+
+from fastapi.testclient import TestClient
+
+from services.orquestador.app import main, router_status
+
+
+def test_almacen_acotado_y_ttl():
+    almacen = router_status.AlmacenLocal(max_routers=4, shards=1, ttl=60)
+    ahora = time.time()
+    almacen.actualizar("R-viejo", 1, "online", 100, ahora - 120)
+    assert almacen.obtener("R-viejo") is None
+    for i in range(6):
+        almacen.actualizar(f"R-{i}", i + 1, "offline", 50, ahora + i)
+    # Se conservan los 4 reportes más recientes
+    assert len(almacen) == 4
+    assert almacen.obtener("R-0") is None
+    assert almacen.obtener("R-5")["estado"] == "offline"
+    # Un reporte nuevo mueve al router al final del orden de desalojo
+    almacen.actualizar("R-2", 3, "online", 80, ahora + 10)
+    almacen.actualizar("R-6", 7, "online", 80, ahora + 11)
+    assert almacen.obtener("R-2")["velocidad_mbps"] == 80
+    assert almacen.obtener("R-3") is None
+
+
+def test_snapshot_sobrevive_reinicio(tmp_path):
+    path = str(tmp_path / "routers.jsonl")
+    almacen = router_status.AlmacenLocal(shards=4, ttl=60, snapshot=path)
+    ahora = time.time()
+    almacen.actualizar("R-2", 2, "online", 200, ahora - 600)
+    almacen.actualizar("R-1", 1, "instalando", 0, ahora)
+    almacen.mantener()
+    assert len(almacen) == 1
+
+    nuevo = router_status.AlmacenLocal(shards=8, ttl=60, snapshot=path)
+    assert nuevo.cargar_snapshot() == 1
+    assert nuevo.obtener("R-1") == almacen.obtener("R-1")
+
+
+def test_router_status_no_lo_tapa_el_proxy(monkeypatch):
+    monkeypatch.setattr(main, "router_status_store", router_status.AlmacenLocal(shards=2))
+    client = TestClient(main.app)
+    r = client.post("/router/status", json={"router_id": "R-9", "cliente_id": 3, "estado": "offline", "velocidad_mbps": 10})
+    assert r.status_code == 200
+    assert r.json()["accion"] == "reset"
+    data = client.get("/router/status/R-9").json()
+    assert data["cliente_id"] == 3 and data["estado"] == "offline"
+    assert data["timestamp"] == r.json()["timestamp"]
@@ -0,0 +1,188 @@
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+from fastapi import Response
+
+from services.orquestador.app import main, sagas, upstreams
+
+
+def _motor(tmp_path, *definiciones):
+    return sagas.MotorSagas(sagas.AlmacenSagas(str(tmp_path / "sagas.db")), definiciones)
+
+
+def test_dag_invalido():
+    async def nada(ctx):
+        return None
+
+    with pytest.raises(ValueError):
+        sagas.DefinicionSaga("x", [sagas.Paso("a", nada, depende=("b",))])
+    with pytest.raises(ValueError):
+        sagas.DefinicionSaga("x", [sagas.Paso("a", nada, depende=("b",)), sagas.Paso("b", nada, depende=("a",))])
+
+
+def test_pasos_independientes_en_paralelo_con_reintento(tmp_path, monkeypatch):
+    monkeypatch.setattr(sagas, "SAGAS_BACKOFF_SEGUNDOS", 0.0)
+    intentos = {"b": 0}
+
+    async def a(ctx):
+        return {"id": 7}
+
+    async def b(ctx):
+        intentos["b"] += 1
+        if intentos["b"] == 1:
+            raise RuntimeError("transitorio")
+        await asyncio.sleep(0.2)
+        return ctx["a"]["id"] + 1
+
+    async def c(ctx):
+        await asyncio.sleep(0.2)
+        return "c"
+
+    definicion = sagas.DefinicionSaga("t", [
+        sagas.Paso("a", a),
+        sagas.Paso("b", b, depende=("a",), reintentos=1),
+        sagas.Paso("c", c, depende=("a",)),
+    ])
+    motor = _motor(tmp_path, definicion)
+    inicio = time.perf_counter()
+    res = asyncio.run(motor.ejecutar("t", {}, saga_id="S-1"))
+    assert time.perf_counter() - inicio < 0.35
+    assert res == {"a": {"id": 7}, "b": 8, "c": "c"}
+    guardada = motor.almacen.obtener("S-1")
+    assert guardada["estado"] == "completada"
+    assert guardada["pasos"]["b"]["intentos"] == 2
+    assert guardada["pasos"]["b"]["resultado"] == 8
+
+
+def test_fallo_critico_compensa_en_orden_inverso(tmp_path):
+    compensados = []
+
+    def paso_ok(nombre):
+        async def accion(ctx):
+            return nombre
+
+        async def compensar(ctx):
+            compensados.append(nombre)
+
+        return accion, compensar
+
+    async def lento(ctx):
+        await asyncio.sleep(1)
+
+    a, ca = paso_ok("a")
+    b, cb = paso_ok("b")
+    definicion = sagas.DefinicionSaga("t", [
+        sagas.Paso("a", a, compensacion=ca),
+        sagas.Paso("b", b, compensacion=cb, depende=("a",)),
+        sagas.Paso("c", lento, depende=("b",), timeout=0.05),
+    ])
+    motor = _motor(tmp_path, definicion)
+    with pytest.raises(sagas.SagaFallida) as exc:
+        asyncio.run(motor.ejecutar("t", {}, saga_id="S-2"))
+    assert exc.value.paso == "c"
+    assert "TimeoutError" in exc.value.detalle
+    assert compensados == ["b", "a"]
+    guardada = motor.almacen.obtener("S-2")
+    assert guardada["estado"] == "compensada"
+    assert guardada["pasos"]["a"]["estado"] == "compensado"
+
+
+def test_reanudar_tras_caida(tmp_path):
+    llamadas = []
+
+    async def a(ctx):
+        llamadas.append("a")
+        return 1
+
+    async def b(ctx):
+        llamadas.append("b")
+        return ctx["a"] + 1
+
+    async def comp(ctx):
+        llamadas.append("comp-a")
+
+    definicion = sagas.DefinicionSaga("t", [sagas.Paso("a", a, compensacion=comp), sagas.Paso("b", b, depende=("a",))])
+    # Estado que dejaría una caída: 'a' completado, 'b' corriendo
+    almacen = sagas.AlmacenSagas(str(tmp_path / "sagas.db"))
+    almacen.crear("S-3", "t", {}, ["a", "b"])
+    almacen.estado_paso("S-3", "a", "completado", 1)
+    almacen.estado_paso("S-3", "b", "en_curso", intento=True)
+    # Y otra que se cayó compensando
+    almacen.crear("S-4", "t", {}, ["a", "b"])
+    almacen.estado_paso("S-4", "a", "completado", 1)
+    almacen.estado_paso("S-4", "b", "fallido", error="error x")
+    almacen.estado_saga("S-4", "compensando", "error x")
+    almacen.cerrar()
+
+    motor = _motor(tmp_path, definicion)
+    assert asyncio.run(motor.reanudar()) == 2
+    assert llamadas == ["b", "comp-a"]
+    s3 = motor.almacen.obtener("S-3")
+    assert s3["estado"] == "completada"
+    assert s3["pasos"]["b"]["resultado"] == 2
+    assert motor.almacen.obtener("S-4")["estado"] == "compensada"
+
+
+def test_saga_procesar_pago_notifica_y_reconecta(tmp_path, monkeypatch):
+    vistos = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        vistos.append((request.url.host, request.url.path))
+        if request.url.host == "pagos":
+            assert request.headers["Idempotency-Key"]
+            return httpx.Response(200, json={"referencia": "R-1", "estatus": "conciliado"})
+        if request.url.host == "whatsapp":
+            return httpx.Response(503, text="caido")
+        return httpx.Response(200, json={"ok": True})
+
+    registro = upstreams.RegistroClientes(upstreams.UPSTREAMS, transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(main, "registro_clientes", registro)
+    monkeypatch.setattr(sagas, "SAGAS_BACKOFF_SEGUNDOS", 0.0)
+    monkeypatch.setattr(main, "motor_sagas", _motor(tmp_path, main.SAGA_ALTA_CLIENTE, main.SAGA_PROCESAR_PAGO))
+
+    response = Response()
+    res = asyncio.run(main.saga_procesar_pago({"monto": 10, "cliente_id": 5}, response))
+    # La respuesta refleja el estado real de cada paso
+    assert res == {"pago": {"referencia": "R-1", "estatus": "conciliado"}, "conciliado": True, "notificado": False, "reconectado": True}
+    assert ("red", "/router/reconectar") in vistos
+    guardada = main.motor_sagas.almacen.obtener(response.headers["X-Saga-Id"])
+    assert guardada["estado"] == "completada"
+    # La notificación es best effort: falla sin revertir el pago
+    assert guardada["pasos"]["notificacion"]["estado"] == "fallido"
+    assert guardada["pasos"]["notificacion"]["intentos"] == 2
+    assert json.loads(json.dumps(guardada["entrada"])) == {"monto": 10, "cliente_id": 5}
+
+
+def test_saga_alta_cliente_factura_con_idempotency_key(tmp_path, monkeypatch):
+    llaves = {}
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        llaves[request.url.host] = request.headers.get("Idempotency-Key")
+        if request.url.host == "clientes":
+            return httpx.Response(200, json={"id": 3})
+        return httpx.Response(200, json=[{"uuid": "U-1", "estatus": "pendiente"}])
+
+    registro = upstreams.RegistroClientes(upstreams.UPSTREAMS, transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(main, "registro_clientes", registro)
+    monkeypatch.setattr(main, "motor_sagas", _motor(tmp_path, main.SAGA_ALTA_CLIENTE, main.SAGA_PROCESAR_PAGO))
+
+    response = Response()
+    res = asyncio.run(main.saga_alta_cliente({"nombre": "x"}, response))
+    assert res == {"cliente": {"id": 3}, "facturas": [{"uuid": "U-1", "estatus": "pendiente"}]}
+    assert llaves["facturacion"] == response.headers["X-Saga-Id"]
+
+
+def test_purga_sagas_terminadas(tmp_path):
+    almacen = sagas.AlmacenSagas(str(tmp_path / "sagas.db"))
+    for sid, estado in [("S-1", "completada"), ("S-2", "compensada"), ("S-3", "en_curso"), ("S-4", "compensando")]:
+        almacen.crear(sid, "t", {}, ["a"])
+        almacen.estado_saga(sid, estado)
+    assert almacen.purgar(datetime.utcnow() - timedelta(hours=1)) == 0
+    assert almacen.purgar(datetime.utcnow() + timedelta(seconds=1)) == 2
+    assert almacen.obtener("S-1") is None and almacen.obtener("S-2") is None
+    assert almacen.obtener("S-3")["pasos"]["a"]["estado"] == "pendiente"
+    assert almacen._ejecutar("SELECT count(*) FROM saga_pasos") == [(2,)]
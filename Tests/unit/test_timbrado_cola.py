@@ -0,0 +1,40 @@
+def test_cola_timbrado_drena_en_lote(cargar_servicio):
+    db, models, svc = cargar_servicio("facturacion", "services.timbrado_service")
+    s = db.SessionLocal()
+    facs = [models.Factura(uuid=f"U-{i}", cliente_id=i, total=10.0, xml_path="x.xml", estatus="pendiente") for i in range(3)]
+    s.add_all(facs)
+    s.flush()
+    svc.encolar_timbrado(s, [f.id for f in facs])
+    s.commit()
+    s.close()
+
+    assert svc.procesar_lote_timbrado(limite=10) == 3
+    assert svc.procesar_lote_timbrado(limite=10) == 0
+    s = db.SessionLocal()
+    assert {f.estatus for f in s.query(models.Factura).all()} == {"timbrado"}
+    assert s.query(models.TimbradoPendiente).count() == 0
+    s.close()
+
+
+def test_cola_timbrado_reintenta_con_backoff(cargar_servicio, monkeypatch):
+    db, models, svc = cargar_servicio("facturacion", "services.timbrado_service")
+    s = db.SessionLocal()
+    fac = models.Factura(uuid="U-ERR", cliente_id=1, total=10.0, xml_path="x.xml", estatus="pendiente")
+    s.add(fac)
+    s.flush()
+    svc.encolar_timbrado(s, [fac.id])
+    s.commit()
+    s.close()
+
+    def _falla(xml):
+        raise RuntimeError("PAC no disponible")
+
+    monkeypatch.setattr(svc, "timbrar_emulado", _falla)
+    assert svc.procesar_lote_timbrado() == 1
+    # La entrada queda diferida por backoff y no se vuelve a reclamar de inmediato
+    assert svc.procesar_lote_timbrado() == 0
+    s = db.SessionLocal()
+    entrada = s.query(models.TimbradoPendiente).one()
+    assert entrada.intentos == 1 and entrada.ultimo_error == "PAC no disponible"
+    assert s.query(models.Factura).one().estatus == "pendiente"
+    s.close()
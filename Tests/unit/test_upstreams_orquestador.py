@@ -0,0 +1,61 @@
+import asyncio
+
+import httpx
+
+from services.orquestador.app import upstreams
+
+
+def test_registro_reutiliza_un_cliente_por_upstream():
+    vistos = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        vistos.append(str(request.url))
+        return httpx.Response(200, json={"ok": True})
+
+    async def _flujo():
+        registro = upstreams.RegistroClientes(
+            {"pagos": "http://pagos:8003", "red": "http://red:8020"}, transport=httpx.MockTransport(handler)
+        )
+        c1 = registro.cliente("pagos")
+        assert registro.cliente("pagos") is c1
+        assert registro.cliente("red") is not c1
+        await c1.post("/pagos/procesar", json={})
+        await registro.cliente("red").get("/router/status")
+        await registro.cerrar()
+        assert c1.is_closed
+        # Tras cerrar se crea uno nuevo al siguiente uso
+        assert registro.cliente("pagos") is not c1
+        await registro.cerrar()
+
+    asyncio.run(_flujo())
+    assert vistos == ["http://pagos:8003/pagos/procesar", "http://red:8020/router/status"]
+
+
+def test_limites_por_upstream(monkeypatch):
+    monkeypatch.setenv("ORQ_RED_MAX_CONEXIONES", "7")
+    registro = upstreams.RegistroClientes({"red": "http://red", "pagos": "http://pagos"})
+    red = registro.limites("red")
+    assert red.max_connections == 7
+    assert red.max_keepalive_connections == 7
+    assert registro.limites("pagos").max_connections == upstreams.MAX_CONEXIONES
+
+
+def test_ocupacion_y_colector(monkeypatch):
+    monkeypatch.setenv("ORQ_PAGOS_MAX_CONEXIONES", "3")
+
+    async def _flujo():
+        registro = upstreams.RegistroClientes({"pagos": "http://pagos"})
+        registro.cliente("pagos")
+        ocupacion = registro.ocupacion()
+        metricas = {
+            (m.name, tuple(s.labels.values())): s.value
+            for m in upstreams._ColectorPool(registro).collect()
+            for s in m.samples
+        }
+        await registro.cerrar()
+        return ocupacion, metricas
+
+    ocupacion, metricas = asyncio.run(_flujo())
+    assert ocupacion == {"pagos": {"activas": 0, "ociosas": 0, "en_espera": 0, "maximo": 3}}
+    assert metricas[("orquestador_upstream_conexiones_max", ("pagos",))] == 3
+    assert metricas[("orquestador_upstream_conexiones", ("pagos", "en_espera"))] == 0
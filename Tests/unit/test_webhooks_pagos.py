@@ -0,0 +1,65 @@
+import asyncio, hashlib, hmac, importlib, json
+
+from fastapi.testclient import TestClient
+
+
+def test_firma_sobre_bytes_crudos():
+    svc = importlib.import_module('services.pagos.app.services.webhook_service')
+    raw = b'{"id": "E1",  "monto": 10}'
+    firma = hmac.new(b"s3cr3t", raw, hashlib.sha256).hexdigest()
+    assert svc.firma_valida("s3cr3t", raw, firma)
+    # El mismo JSON re-serializado ya no coincide: se firma lo recibido
+    assert not svc.firma_valida("s3cr3t", json.dumps(json.loads(raw), sort_keys=True).encode(), firma)
+
+
+def test_escritor_agrupa_y_deduplica(cargar_servicio):
+    db, models, svc = cargar_servicio("pagos", "services.webhook_service")
+
+    async def _flujo():
+        escritor = svc.EscritorWebhooks(batch=50, flush_ms=20)
+        escritor.start()
+        estados = await asyncio.gather(*(escritor.aceptar(f"E{i % 30}", "{}") for i in range(60)))
+        await escritor.stop()
+        return escritor, estados
+
+    escritor, estados = asyncio.run(_flujo())
+    assert estados.count("ok") == 30 and estados.count("ignored") == 30
+
+    # Otra réplica (set vacío) reenvía: la restricción única lo absorbe
+    otro = svc.EscritorWebhooks()
+    assert asyncio.run(otro.aceptar("E1", "{}")) == "ignored"
+    assert asyncio.run(otro.aceptar("E-NUEVO", "{}")) == "ok"
+    s = db.SessionLocal()
+    assert s.query(models.WebhookLog).count() == 31
+    s.close()
+
+
+def test_no_confirma_eventos_no_persistidos(cargar_servicio, monkeypatch):
+    db, models, svc = cargar_servicio("pagos", "services.webhook_service")
+    escritor = svc.EscritorWebhooks(batch=10, flush_ms=5)
+    escribir = escritor._escribir
+
+    def _falla(eventos):
+        raise RuntimeError("base caída")
+
+    async def _flujo(n):
+        escritor.start()
+        estados = await asyncio.gather(*(escritor.aceptar(f"X{i}", "{}") for i in range(n)))
+        await escritor.stop()
+        return estados
+
+    monkeypatch.setattr(escritor, "_escribir", _falla)
+    assert asyncio.run(_flujo(3)) == ["error"] * 3
+    # No quedaron marcados como vistos: el reintento de la pasarela sí se escribe
+    monkeypatch.setattr(escritor, "_escribir", escribir)
+    assert asyncio.run(_flujo(3)) == ["ok"] * 3
+    s = db.SessionLocal()
+    assert s.query(models.WebhookLog).count() == 3
+    s.close()
+
+
+def test_event_id_demasiado_largo_400(cargar_servicio):
+    db, models, svc, main = cargar_servicio("pagos", "services.webhook_service", "main")
+    client = TestClient(main.app)
+    r = client.post("/pagos/webhook", content=json.dumps({"id": "E" * (svc.EVENT_ID_MAX + 1)}))
+    assert r.status_code == 400
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark de generación de CFDI: f-strings por factura (implementación
+original de generar_cfdi_xml y un f-string del CFDI completo, sin escapar)
+contra la plantilla precompilada de services/facturacion/app/cfdi.py, por
+factura y renderizando el lote completo.
+
+Uso: python scripts/bench_cfdi.py [N_FACTURAS] [REPETICIONES]
+"""
+import os
+import sys
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from services.facturacion.app.cfdi import PlantillaCFDI  # noqa: E402
+
+
+def generar_cfdi_xml_fstring(cliente_id: int, total: float, uuid: str) -> str:
+    # Implementación original: sin conceptos, impuestos ni datos del receptor
+    return (
+        f"<cfdi:Comprobante Version=\"4.0\" Total=\"{total:.2f}\">"
+        f"<cfdi:Emisor Rfc=\"AAA010101AAA\"/>"
+        f"<cfdi:Receptor Rfc=\"XEXX010101000\"/>"
+        f"<tfd:TimbreFiscalDigital UUID=\"{uuid}\"/>"
+        f"</cfdi:Comprobante>"
+    )
+
+
+def generar_cfdi_completo_fstring(f: dict) -> str:
+    # Mismo documento que la plantilla, armado con un f-string por factura
+    total = f["total"]
+    subtotal = round(total / 1.16, 2)
+    iva = total - subtotal
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<cfdi:Comprobante xmlns:cfdi="http://www.sat.gob.mx/cfd/4" '
+        'xmlns:tfd="http://www.sat.gob.mx/TimbreFiscalDigital" '
+        f'Version="4.0" Serie="A" Folio="{f["cliente_id"]}" Fecha="{f["fecha"]}" '
+        f'FormaPago="99" SubTotal="{subtotal:.2f}" Moneda="MXN" Total="{total:.2f}" '
+        'TipoDeComprobante="I" Exportacion="01" MetodoPago="PUE" LugarExpedicion="00000">'
+        '<cfdi:Emisor Rfc="AAA010101AAA" Nombre="TELECABLE" RegimenFiscal="601"/>'
+        '<cfdi:Receptor Rfc="XEXX010101000" Nombre="PUBLICO EN GENERAL" '
+        'DomicilioFiscalReceptor="00000" RegimenFiscalReceptor="616" UsoCFDI="S01"/>'
+        '<cfdi:Conceptos><cfdi:Concepto ClaveProdServ="81161700" Cantidad="1" ClaveUnidad="E48" '
+        f'Descripcion="Servicio de internet" ValorUnitario="{subtotal:.2f}" Importe="{subtotal:.2f}" ObjetoImp="02">'
+        f'<cfdi:Impuestos><cfdi:Traslados><cfdi:Traslado Base="{subtotal:.2f}" Impuesto="002" '
+        f'TipoFactor="Tasa" TasaOCuota="0.160000" Importe="{subtotal * 0.16:.2f}"/></cfdi:Traslados></cfdi:Impuestos>'
+        '</cfdi:Concepto></cfdi:Conceptos>'
+        f'<cfdi:Impuestos TotalImpuestosTrasladados="{iva:.2f}">'
+        f'<cfdi:Traslados><cfdi:Traslado Base="{subtotal:.2f}" Impuesto="002" TipoFactor="Tasa" '
+        f'TasaOCuota="0.160000" Importe="{iva:.2f}"/></cfdi:Traslados>'
+        '</cfdi:Impuestos>'
+        f'<cfdi:Complemento><tfd:TimbreFiscalDigital Version="1.1" UUID="{f["uuid"]}"/></cfdi:Complemento>'
+        '</cfdi:Comprobante>'
+    )
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repeticiones = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    facturas = [
+        {"cliente_id": i, "total": 299.0 + i % 7, "uuid": str(uuid.uuid4()), "fecha": "2025-01-01T00:00:00"}
+        for i in range(n)
+    ]
+    plantilla = PlantillaCFDI()
+
+    def fstring():
+        return [generar_cfdi_xml_fstring(f["cliente_id"], f["total"], f["uuid"]).encode("utf-8") for f in facturas]
+
+    def fstring_completo():
+        return [generar_cfdi_completo_fstring(f).encode("utf-8") for f in facturas]
+
+    def por_factura():
+        return [plantilla.render(f) for f in facturas]
+
+    def lote():
+        return plantilla.render_lote(facturas)
+
+    print(f"{n} facturas, mejor de {repeticiones} corridas")
+    casos = (
+        ("f-string original (CFDI mínimo)", fstring),
+        ("f-string CFDI completo", fstring_completo),
+        ("plantilla por factura", por_factura),
+        ("plantilla lote", lote),
+    )
+    for nombre, fn in casos:
+        mejor = min(timeit.repeat(fn, number=1, repeat=repeticiones))
+        tam = sum(len(x) for x in fn())
+        print(f"  {nombre:<34} {mejor * 1000:8.1f} ms  {mejor / n * 1e6:6.2f} us/factura  {tam / n:6.0f} B/factura")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-import os, csv, sys, json
+import os, csv, json, shutil
 from datetime import datetime
 import urllib.request
 
@@ -30,15 +30,13 @@ def main():
     for p in fact_candidates:
         try:
             stats = http_json(f"http://localhost:{int(p)}/facturacion/stats")
+            fact_port = p
             break
         except Exception as e:
             last_err = e
             continue
     if stats is None and last_err:
         raise last_err
-    # Conciliacion pagos (csv dentro de json)
-    conc = http_json(f"http://localhost:{int(pagos_port)}/pagos/conciliar")
-    csv_text = conc.get('csv','')
     out_dir = 'Tests/reports/finanzas'
     os.makedirs(out_dir, exist_ok=True)
     mes = datetime.utcnow().strftime('%Y%m')
@@ -47,10 +45,18 @@ def main():
         w = csv.writer(f)
         w.writerow(['metric','valor'])
         for k,v in stats.items(): w.writerow([k,v])
+    # Aging del periodo cerrado, calculado en facturación y guardado allá por periodo
+    periodo = os.environ.get('CIERRE_PERIODO', '')
     aging = os.path.join(out_dir, 'aging.csv')
-    with open(aging,'w',newline='') as f:
-        f.write(csv_text)
-    print('Wrote', cierre, 'and', aging)
+    url = f"http://localhost:{int(fact_port)}/facturacion/aging?formato=csv" + (f"&periodo={periodo}" if periodo else "")
+    with urllib.request.urlopen(url, timeout=60) as r, open(aging,'wb') as f:
+        shutil.copyfileobj(r, f)
+    # Conciliacion pagos: CSV transmitido directo a disco, solo pagos desde el cierre anterior
+    conciliacion = os.path.join(out_dir, 'conciliacion.csv')
+    url = f"http://localhost:{int(pagos_port)}/pagos/conciliar?formato=csv&marca=cierre-mensual"
+    with urllib.request.urlopen(url, timeout=60) as r, open(conciliacion,'wb') as f:
+        shutil.copyfileobj(r, f)
+    print('Wrote', cierre, aging, 'and', conciliacion)
 
 if __name__=='__main__':
     main()
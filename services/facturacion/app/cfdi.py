@@ -0,0 +1,252 @@
+"""
+Generación de XML CFDI 4.0 a partir de plantillas precompiladas.
+
+La plantilla se compila una sola vez a un formato binario (`b"...%s..."`)
+con los datos del emisor ya incrustados como texto estático. Renderizar una
+factura es un solo formateo en C sobre bytes, sin armar el documento como
+str intermedio; `render_lote` escribe todo un lote en un único buffer y lo
+corta en vistas por factura.
+
+Los importes del comprobante salen de los conceptos: SubTotal es la suma de
+sus importes, el IVA trasladado la suma del IVA de cada concepto (ya
+redondeado) y Total = SubTotal + IVA. Una factura con conceptos cuyo `total`
+no cuadra con ellos se rechaza con CFDIInconsistente.
+"""
+import io
+import os
+from datetime import datetime
+from operator import itemgetter
+from string import Formatter
+from typing import Any, Dict, Iterable, List, Sequence, Tuple
+
+TASA_IVA = 0.16
+
+
+class CFDIInconsistente(ValueError):
+    pass
+
+
+_ESCAPE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&apos;"})
+
+PLANTILLA_COMPROBANTE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<cfdi:Comprobante xmlns:cfdi="http://www.sat.gob.mx/cfd/4" '
+    'xmlns:tfd="http://www.sat.gob.mx/TimbreFiscalDigital" '
+    'Version="4.0" Serie="{serie}" Folio="{folio}" Fecha="{fecha}" '
+    'FormaPago="{forma_pago}" SubTotal="{subtotal}" Moneda="MXN" Total="{total}" '
+    'TipoDeComprobante="I" Exportacion="01" MetodoPago="{metodo_pago}" '
+    'LugarExpedicion="{emisor_cp}">'
+    '<cfdi:Emisor Rfc="{emisor_rfc}" Nombre="{emisor_nombre}" RegimenFiscal="{emisor_regimen}"/>'
+    '<cfdi:Receptor Rfc="{receptor_rfc}" Nombre="{receptor_nombre}" '
+    'DomicilioFiscalReceptor="{receptor_cp}" RegimenFiscalReceptor="{receptor_regimen}" '
+    'UsoCFDI="{receptor_uso}"/>'
+    '<cfdi:Conceptos>{conceptos}</cfdi:Conceptos>'
+    '<cfdi:Impuestos TotalImpuestosTrasladados="{iva}">'
+    '<cfdi:Traslados><cfdi:Traslado Base="{subtotal}" Impuesto="002" TipoFactor="Tasa" '
+    'TasaOCuota="0.160000" Importe="{iva}"/></cfdi:Traslados>'
+    '</cfdi:Impuestos>'
+    '<cfdi:Complemento><tfd:TimbreFiscalDigital Version="1.1" UUID="{uuid}"/></cfdi:Complemento>'
+    '</cfdi:Comprobante>'
+)
+
+PLANTILLA_CONCEPTO = (
+    '<cfdi:Concepto ClaveProdServ="{clave}" Cantidad="{cantidad}" ClaveUnidad="{unidad}" '
+    'Descripcion="{descripcion}" ValorUnitario="{valor_unitario}" Importe="{importe}" ObjetoImp="02">'
+    '<cfdi:Impuestos><cfdi:Traslados><cfdi:Traslado Base="{importe}" Impuesto="002" '
+    'TipoFactor="Tasa" TasaOCuota="0.160000" Importe="{iva}"/></cfdi:Traslados></cfdi:Impuestos>'
+    '</cfdi:Concepto>'
+)
+
+
+def _esc(valor: Any) -> str:
+    return str(valor).translate(_ESCAPE)
+
+
+def _esc_b(valor: Any) -> bytes:
+    return _esc(valor).encode("utf-8")
+
+
+class _Compilada:
+    """
+    Plantilla compilada a un formato binario `b"...%s..."` más un getter de
+    los campos en orden: el render es un solo `%` sobre bytes, sin str
+    intermedio ni un write por campo.
+    """
+
+    __slots__ = ("formato", "campos")
+
+    def __init__(self, plantilla: str, constantes: Dict[str, str]) -> None:
+        partes: List[str] = []
+        campos: List[str] = []
+        for literal, campo, _, _ in Formatter().parse(plantilla):
+            partes.append(literal.replace("%", "%%"))
+            if campo is None:
+                continue
+            if campo in constantes:
+                # Evaluación parcial: los datos fijos pasan a ser estáticos
+                partes.append(_esc(constantes[campo]).replace("%", "%%"))
+                continue
+            partes.append("%s")
+            campos.append(campo)
+        self.formato = "".join(partes).encode("utf-8")
+        self.campos = itemgetter(*campos)
+
+    def render(self, valores: Dict[str, bytes]) -> bytes:
+        return self.formato % self.campos(valores)
+
+
+class PlantillaCFDI:
+    def __init__(self, emisor: Dict[str, str] | None = None) -> None:
+        emisor = emisor or emisor_desde_entorno()
+        constantes = {
+            "emisor_rfc": emisor["rfc"],
+            "emisor_nombre": emisor["nombre"],
+            "emisor_regimen": emisor["regimen"],
+            "emisor_cp": emisor["cp"],
+        }
+        self._comprobante = _Compilada(PLANTILLA_COMPROBANTE, constantes)
+        self._concepto = _Compilada(PLANTILLA_CONCEPTO, {})
+
+    def _conceptos(self, crudos: Sequence[Dict[str, Any]], iva_fijo: float | None = None) -> Tuple[bytes, float, float]:
+        """
+        Nodos <cfdi:Concepto> ya renderizados, subtotal e IVA (suma del IVA
+        redondeado de cada concepto). `iva_fijo` reemplaza el IVA calculado de
+        un concepto único (ver _concepto_generico).
+        """
+        nodos = []
+        subtotal = 0.0
+        iva_total = 0.0
+        for c in crudos:
+            cantidad = float(c.get("cantidad", 1))
+            valor = float(c.get("valor_unitario", 0))
+            importe = round(cantidad * valor, 2)
+            iva = iva_fijo if iva_fijo is not None else round(importe * TASA_IVA, 2)
+            subtotal += importe
+            iva_total += iva
+            nodos.append(
+                self._concepto.render(
+                    {
+                        "clave": _esc_b(c.get("clave", "81161700")),
+                        "cantidad": b"%g" % cantidad,
+                        "unidad": _esc_b(c.get("unidad", "E48")),
+                        "descripcion": _esc_b(c.get("descripcion", "Servicio")),
+                        "valor_unitario": b"%.2f" % valor,
+                        "importe": b"%.2f" % importe,
+                        "iva": b"%.2f" % iva,
+                    }
+                )
+            )
+        return b"".join(nodos), round(subtotal, 2), round(iva_total, 2)
+
+    def render_into(self, buf: io.BytesIO, factura: Dict[str, Any], cache: Dict[Any, Any] | None = None) -> None:
+        """
+        Escribe el CFDI de `factura` en `buf`. `cache` se comparte dentro de
+        un lote para no recalcular lo que se repite entre facturas (conceptos
+        genéricos por monto, fecha).
+        """
+        if cache is None:
+            cache = {}
+        if factura.get("conceptos"):
+            conceptos, subtotal, iva = self._conceptos(factura["conceptos"])
+            if factura.get("total") is not None and abs(float(factura["total"]) - (subtotal + iva)) >= 0.005:
+                raise CFDIInconsistente(
+                    f"Factura {factura.get('uuid')}: total {float(factura['total']):.2f} no corresponde a los "
+                    f"conceptos ({subtotal:.2f} + IVA {iva:.2f})"
+                )
+        else:
+            total = float(factura.get("total", 0))
+            clave = ("generico", total)
+            if clave not in cache:
+                concepto, iva_fijo = _concepto_generico(total)
+                cache[clave] = self._conceptos([concepto], iva_fijo)
+            conceptos, subtotal, iva = cache[clave]
+        fecha = factura.get("fecha")
+        clave = ("fecha", fecha)
+        if clave not in cache:
+            cache[clave] = _esc_b(_fecha(fecha))
+        receptor = factura.get("receptor")
+        valores = _receptor(receptor) if receptor else dict(_RECEPTOR_GENERICO)
+        for campo, defecto in _DEFECTOS.items():
+            valor = factura.get(campo)
+            valores[campo] = defecto if valor is None else _esc_b(valor)
+        valores["folio"] = _esc_b(factura.get("folio") or factura.get("cliente_id", ""))
+        valores["fecha"] = cache[clave]
+        valores["subtotal"] = b"%.2f" % subtotal
+        valores["total"] = b"%.2f" % (subtotal + iva)
+        valores["iva"] = b"%.2f" % iva
+        valores["uuid"] = _esc_b(factura["uuid"])
+        valores["conceptos"] = conceptos
+        buf.write(self._comprobante.render(valores))
+
+    def render(self, factura: Dict[str, Any]) -> bytes:
+        buf = io.BytesIO()
+        self.render_into(buf, factura)
+        return buf.getvalue()
+
+    def render_lote(self, facturas: Iterable[Dict[str, Any]]) -> List[memoryview]:
+        """Renderiza un lote en un solo buffer; retorna una vista por factura."""
+        buf = io.BytesIO()
+        cortes = [0]
+        cache: Dict[Any, Any] = {}
+        for factura in facturas:
+            self.render_into(buf, factura, cache)
+            cortes.append(buf.tell())
+        datos = buf.getbuffer()
+        return [datos[a:b] for a, b in zip(cortes, cortes[1:])]
+
+
+def _fecha(valor: datetime | str | None) -> str:
+    if valor is None:
+        valor = datetime.utcnow()
+    if isinstance(valor, datetime):
+        return valor.strftime("%Y-%m-%dT%H:%M:%S")
+    return valor
+
+
+def _concepto_generico(total: float) -> Tuple[Dict[str, Any], float]:
+    """
+    Concepto único cuyo importe + IVA da exactamente `total`, con el IVA del
+    concepto. Se busca el valor unitario junto a total/1.16 cuyo IVA redondeado
+    cuadra; si ninguno (el redondeo salta ese centavo), el IVA absorbe la
+    diferencia de un centavo, igual en el concepto y en el comprobante.
+    """
+    base = round(total / (1 + TASA_IVA), 2)
+    for valor in (base, round(base - 0.01, 2), round(base + 0.01, 2)):
+        if abs(valor + round(valor * TASA_IVA, 2) - total) < 0.005:
+            return {"descripcion": "Servicio de internet", "valor_unitario": valor}, round(valor * TASA_IVA, 2)
+    return {"descripcion": "Servicio de internet", "valor_unitario": base}, round(total - base, 2)
+
+
+def _receptor(receptor: Dict[str, Any]) -> Dict[str, bytes]:
+    return {
+        "receptor_rfc": _esc_b(receptor.get("rfc", "XEXX010101000")),
+        "receptor_nombre": _esc_b(receptor.get("nombre", "PUBLICO EN GENERAL")),
+        "receptor_cp": _esc_b(receptor.get("cp", "00000")),
+        "receptor_regimen": _esc_b(receptor.get("regimen", "616")),
+        "receptor_uso": _esc_b(receptor.get("uso", "S01")),
+    }
+
+
+_RECEPTOR_GENERICO = _receptor({})
+# Valores por omisión ya escapados y codificados
+_DEFECTOS = {"serie": b"A", "forma_pago": b"99", "metodo_pago": b"PUE"}
+
+
+def emisor_desde_entorno() -> Dict[str, str]:
+    return {
+        "rfc": os.getenv("CFDI_EMISOR_RFC", "AAA010101AAA"),
+        "nombre": os.getenv("CFDI_EMISOR_NOMBRE", "TELECABLE"),
+        "regimen": os.getenv("CFDI_EMISOR_REGIMEN", "601"),
+        "cp": os.getenv("CFDI_EMISOR_CP", "00000"),
+    }
+
+
+_plantilla: PlantillaCFDI | None = None
+
+
+def plantilla() -> PlantillaCFDI:
+    """Plantilla del proceso, compilada en el primer uso."""
+    global _plantilla
+    if _plantilla is None:
+        _plantilla = PlantillaCFDI()
+    return _plantilla
@@ -26,5 +26,13 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 
 def init_db():
-    from .models import Factura
+    from .models import AgingCorte, ClienteZona, EventoFallido, EventoOffset, Factura, FacturaResumenCliente, FacturaResumenDiario, LoteJob, SchemaMigracion, TimbradoPendiente
+    from .migrations import aplicar_migraciones
     Base.metadata.create_all(bind=engine)
+    aplicar_migraciones(engine)
+
+
+def upsert_insert(db):
+    """`insert` con soporte ON CONFLICT del dialecto activo (Postgres en prod, SQLite en tests)."""
+    from sqlalchemy.dialects import postgresql, sqlite
+    return sqlite.insert if db.get_bind().dialect.name == "sqlite" else postgresql.insert
@@ -16,6 +16,9 @@ class CustomJsonFormatter(jsonlogger.JsonFormatter):
 
 def configure_logging(service_name: str = "facturacion") -> logging.Logger:
     logger = logging.getLogger(service_name)
+    if logger.handlers:
+        # Ya configurado por otro módulo del servicio: evitar líneas duplicadas
+        return logger
     handler = logging.StreamHandler()
     handler.setFormatter(CustomJsonFormatter("%(timestamp)s %(level)s %(message)s"))
     logger.addHandler(handler)
@@ -1,10 +1,11 @@
 import os
-import uuid as uuidlib
 from datetime import datetime
-from fastapi import FastAPI, BackgroundTasks, HTTPException, Query, Request, Response
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from sqlalchemy import func
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from sqlalchemy import select, tuple_, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from opentelemetry import trace
 from opentelemetry.sdk.resources import SERVICE_NAME, Resource
@@ -12,15 +13,17 @@ from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
 from opentelemetry.exporter.jaeger.thrift import JaegerExporter
 from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
-# Optional deps for local testing: boto3 and prometheus instrumentator
-try:
-    import boto3  # type: ignore
-except Exception:  # pragma: no cover - tolerate missing boto3 in unit envs
-    boto3 = None
-
 from .logging_conf import configure_logging
 from .db import init_db, SessionLocal
+from . import cfdi, storage
 from .models import Factura
+from .paginacion import codificar_cursor, decodificar_cursor
+from .services.emision_service import emitir_lote, uuids_idempotentes
+from .services.timbrado_service import encolar_timbrado, timbrado_pool
+from .services.facturacion_lote_service import lote_worker
+from .services.eventos_service import ConsumidorEventos
+from .services import aging_service, resumen_service
+# Optional deps for local testing: prometheus instrumentator
 try:
     from prometheus_fastapi_instrumentator import Instrumentator  # type: ignore
 except Exception:  # pragma: no cover - provide a no-op fallback
@@ -47,27 +50,6 @@ def setup_tracing():
     trace.set_tracer_provider(provider)
 
 
-def s3_client():
-    endpoint = os.getenv("S3_ENDPOINT") or os.getenv("MINIO_ENDPOINT", "http://minio:9000")
-    access = os.getenv("S3_ACCESS_KEY") or os.getenv("MINIO_ACCESS_KEY", "minioadmin")
-    secret = os.getenv("S3_SECRET_KEY") or os.getenv("MINIO_SECRET_KEY", "minioadmin")
-    if boto3 is None:
-        # Return a dummy object to trigger local fallback paths
-        class _Dummy:
-            def create_bucket(self, *a, **k):
-                raise RuntimeError("boto3 not available")
-            def put_object(self, *a, **k):
-                raise RuntimeError("boto3 not available")
-        return _Dummy()
-    return boto3.client(
-        "s3",
-        endpoint_url=endpoint,
-        aws_access_key_id=access,
-        aws_secret_access_key=secret,
-        region_name="us-east-1",
-    )
-
-
 app = FastAPI(title="Servicio Facturación", version="0.1.0")
 
 # Enable permissive CORS for Backoffice usage in dev/E2E
@@ -77,6 +59,8 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
+    # El backoffice lee el cursor de paginación desde JS
+    expose_headers=["X-Next-Cursor"],
 )
 try:
     # Registrar rutas separadas
@@ -92,15 +76,23 @@ async def on_startup():
     setup_tracing()
     init_db()
     # Ensure bucket exists
-    s3 = s3_client()
-    bucket = os.getenv("S3_BUCKET") or os.getenv("MINIO_BUCKET", "cfdi")
     try:
-        s3.create_bucket(Bucket=bucket)
+        storage.get_s3_client().create_bucket(Bucket=storage.bucket())
     except Exception:
         pass
-    # Start simple event consumer from shared volume
+    # Consumidor del log de eventos del volumen compartido (offset durable por grupo)
     import asyncio
-    asyncio.create_task(consume_events())
+    consumidor_eventos.start()
+    asyncio.create_task(resumen_service.reconstruir_periodicamente())
+    timbrado_pool.start()
+    lote_worker.start()
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await timbrado_pool.stop()
+    await lote_worker.stop()
+    await consumidor_eventos.stop()
 
 
 @app.middleware("http")
@@ -132,89 +124,53 @@ def contratos_generar(payload: dict):
     key = f"contratos/cliente-{cliente_id}-{plan_id}.pdf"
     # Contenido PDF mínimo (stub) – los visores suelen tolerar encabezado PDF
     pdf_bytes = b"%PDF-1.4\n1 0 obj<<>>endobj\ntrailer<<>>\n%%EOF\n"
-    try:
-        s3 = s3_client()
-        bucket = os.getenv("S3_BUCKET") or os.getenv("MINIO_BUCKET", "cfdi")
-        # s3_client puede ser dummy en entornos sin boto3 (cae a except)
-        if hasattr(s3, 'put_object'):
-            s3.put_object(Bucket=bucket, Key=key, Body=pdf_bytes, ContentType="application/pdf")
-            url = f"s3://{bucket}/{key}"
-        else:
-            raise Exception("no s3")
-    except Exception:
-        os.makedirs("/tmp/contratos", exist_ok=True)
-        with open(f"/tmp/contratos/{key.split('/')[-1]}", "wb") as f:
-            f.write(pdf_bytes)
-        url = f"file:///tmp/contratos/{key.split('/')[-1]}"
+    url = storage.subir_objeto(key, pdf_bytes, "application/pdf", fallback_dir="/tmp/contratos")
     return {"ok": True, "url": url}
 
 
 def generar_cfdi_xml(cliente_id: int, total: float, uuid: str) -> str:
-    # Simplified CFDI 4.0-like XML
-    return (
-        f"<cfdi:Comprobante Version=\"4.0\" Total=\"{total:.2f}\">"
-        f"<cfdi:Emisor Rfc=\"AAA010101AAA\"/>"
-        f"<cfdi:Receptor Rfc=\"XEXX010101000\"/>"
-        f"<tfd:TimbreFiscalDigital UUID=\"{uuid}\"/>"
-        f"</cfdi:Comprobante>"
-    )
+    # CFDI 4.0 desde la plantilla precompilada (ver cfdi.py)
+    return cfdi.plantilla().render({"cliente_id": cliente_id, "total": total, "uuid": uuid}).decode("utf-8")
 
 
-def timbrar_emulado(xml: str) -> str:
-    # In emulated mode, immediately return timbre UUID
-    return str(uuidlib.uuid4())
-
-
-def upload_xml_to_s3(xml: str, key: str):
-    try:
-        s3 = s3_client()
-        bucket = os.getenv("S3_BUCKET") or os.getenv("MINIO_BUCKET", "cfdi")
-        s3.put_object(Bucket=bucket, Key=key, Body=xml.encode("utf-8"), ContentType="application/xml")
-        return f"s3://{bucket}/{key}"
-    except Exception:
-        # Dev fallback: write to local path
-        os.makedirs("/tmp/cfdi", exist_ok=True)
-        with open(f"/tmp/cfdi/{key}", "w", encoding="utf-8") as f:
-            f.write(xml)
-        return f"file:///tmp/cfdi/{key}"
-
-
-def procesar_timbrado(factura_id: int):
-    db: Session = SessionLocal()
-    try:
-        fac = db.query(Factura).filter(Factura.id == factura_id).first()
-        if not fac:
-            return
-        uuid = timbrar_emulado(f"xml-{fac.uuid}")
-        fac.estatus = "timbrado"
-        db.commit()
-        logger.info("Factura timbrada", extra={"service": service_name, "cid": fac.uuid})
-    finally:
-        db.close()
+def _emitidas_previas(db: Session, uuids: list[str]) -> list[dict]:
+    """Facturas ya emitidas con esos UUID (reintento idempotente), en el orden del lote."""
+    previas = {f.uuid: f for f in db.query(Factura).filter(Factura.uuid.in_(uuids)).all()}
+    return [
+        {"id": f.id, "uuid": f.uuid, "cliente_id": f.cliente_id, "total": f.total, "tiempo_ms": 0.0}
+        for f in (previas.get(u) for u in uuids)
+        if f is not None
+    ]
 
 
 @app.post("/facturacion/generar-masiva")
-def generar_masiva(lote: list[dict], bg: BackgroundTasks, csv: int = 0):
+def generar_masiva(
+    lote: list[dict], csv: int = 0, idempotency_key: str | None = Header(default=None, alias="Idempotency-Key")
+):
     db: Session = SessionLocal()
     try:
+        uuids = uuids_idempotentes(idempotency_key, len(lote)) if idempotency_key else None
+        emitidas = _emitidas_previas(db, uuids) if uuids else None
+        if not emitidas:
+            try:
+                emitidas = emitir_lote(db, lote, uuids)
+                # El timbrado queda en cola persistente en la misma transacción
+                encolar_timbrado(db, [fac["id"] for fac in emitidas])
+                db.commit()
+            except cfdi.CFDIInconsistente as exc:
+                db.rollback()
+                raise HTTPException(status_code=400, detail=str(exc))
+            except IntegrityError:
+                # Un reintento concurrente con la misma llave ganó la carrera
+                db.rollback()
+                emitidas = _emitidas_previas(db, uuids) if uuids else None
+                if not emitidas:
+                    raise
         out = []
         rows = ["uuid,cliente_id,total,estatus,time_ms"]
-        for item in lote:
-            cliente_id = int(item.get("cliente_id"))
-            total = float(item.get("total", 0))
-            uuid = str(uuidlib.uuid4())
-            t0 = datetime.utcnow()
-            xml = generar_cfdi_xml(cliente_id, total, uuid)
-            key = f"{uuid}.xml"
-            upload_xml_to_s3(xml, key)
-            fac = Factura(uuid=uuid, cliente_id=cliente_id, total=total, xml_path=key, estatus="pendiente")
-            db.add(fac)
-            db.flush()
-            bg.add_task(procesar_timbrado, fac.id)
-            dt = (datetime.utcnow() - t0).total_seconds() * 1000.0
-            out.append({"uuid": uuid, "estatus": "pendiente"})
-            rows.append(f"{uuid},{cliente_id},{total:.2f},pendiente,{int(dt)}")
-        db.commit()
+        for fac in emitidas:
+            out.append({"uuid": fac["uuid"], "estatus": "pendiente"})
+            rows.append(f"{fac['uuid']},{fac['cliente_id']},{fac['total']:.2f},pendiente,{int(fac['tiempo_ms'])}")
         if csv:
             body = "\n".join(rows)
             return Response(content=body, media_type="text/csv")
@@ -228,11 +184,7 @@ def generar_masiva(lote: list[dict], bg: BackgroundTasks, csv: int = 0):
 def stats():
     db: Session = SessionLocal()
     try:
-        total = db.query(Factura).count()
-        timbradas = db.query(Factura).filter(Factura.estatus == "timbrado").count()
-        pendientes = db.query(Factura).filter(Factura.estatus == "pendiente").count()
-        canceladas = db.query(Factura).filter(Factura.estatus == "cancelado").count()
-        return {"total": total, "timbradas": timbradas, "pendientes": pendientes, "canceladas": canceladas}
+        return resumen_service.stats(db)
     finally:
         db.close()
 
@@ -241,52 +193,55 @@ def stats():
 def facturacion_kpis():
     db: Session = SessionLocal()
     try:
-        activos = (
-            db.query(func.count(func.distinct(Factura.cliente_id)))
-            .filter(Factura.estatus.in_(["timbrado", "pagado"]))
-            .scalar()
-            or 0
-        )
-        morosos = (
-            db.query(func.count(Factura.uuid))
-            .filter(Factura.estatus == "pendiente")
-            .scalar()
-            or 0
-        )
-        ahora = datetime.utcnow()
-        mes_inicio = ahora.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        ingresos = (
-            db.query(func.coalesce(func.sum(Factura.total), 0))
-            .filter(Factura.estatus == "pagado", Factura.fecha_emision >= mes_inicio)
-            .scalar()
-            or 0
-        )
-        emitidas = (
-            db.query(func.count(Factura.uuid))
-            .filter(Factura.fecha_emision >= mes_inicio)
-            .scalar()
-            or 0
-        )
-        return {
-            "clientes_activos": int(activos),
-            "morosos": int(morosos),
-            "ingresos_mensuales": float(ingresos),
-            "facturas_emitidas": int(emitidas),
-        }
+        return resumen_service.kpis(db)
     finally:
         db.close()
 
 
-@app.get("/facturacion/ultimas")
-def facturacion_ultimas(limit: int = Query(10, ge=1, le=50)):
+@app.get("/facturacion/aging")
+def facturacion_aging(
+    periodo: str | None = Query(None, pattern=r"^\d{4}-\d{2}$", description="YYYY-MM; por defecto el último periodo cerrado"),
+    agrupar: str = Query("cliente", pattern="^(cliente|zona)$"),
+    formato: str = Query("json", pattern="^(json|csv)$"),
+    refrescar: bool = Query(False, description="Recalcular un periodo cerrado ya guardado"),
+):
+    """Antigüedad de saldos 0-30/31-60/61-90/90+ al cierre del periodo, por cliente o por zona."""
+    periodo = periodo or aging_service.periodo_anterior()
     db: Session = SessionLocal()
     try:
-        rows = (
-            db.query(Factura)
-            .order_by(Factura.fecha_emision.desc())
-            .limit(limit)
-            .all()
+        try:
+            filas = aging_service.reporte(db, periodo, agrupar, refrescar)
+        except aging_service.PeriodoInvalido as exc:
+            raise HTTPException(status_code=400, detail=str(exc))
+    finally:
+        db.close()
+    if formato == "csv":
+        return StreamingResponse(
+            aging_service.a_csv(filas, agrupar),
+            media_type="text/csv",
+            headers={"Content-Disposition": f'attachment; filename="aging-{periodo}.csv"'},
         )
+    return {"periodo": periodo, "corte": aging_service.fecha_corte(periodo).isoformat(), "agrupar": agrupar, "filas": filas}
+
+
+@app.get("/facturacion/ultimas")
+def facturacion_ultimas(
+    response: Response,
+    limit: int = Query(10, ge=1, le=50),
+    after: str | None = Query(None, description="Cursor de X-Next-Cursor"),
+    estatus: str | None = None,
+):
+    db: Session = SessionLocal()
+    try:
+        # Sin fecha_emision no hay posición en el keyset (y cada motor ordena los NULL distinto)
+        q = db.query(Factura).filter(Factura.fecha_emision.is_not(None))
+        if estatus:
+            q = q.filter(Factura.estatus == estatus)
+        if after:
+            q = q.filter(tuple_(Factura.fecha_emision, Factura.id) < decodificar_cursor(after))
+        rows = q.order_by(Factura.fecha_emision.desc(), Factura.id.desc()).limit(limit).all()
+        if len(rows) == limit:
+            response.headers["X-Next-Cursor"] = codificar_cursor(rows[-1].fecha_emision, rows[-1].id)
         return [
             {
                 "uuid": fac.uuid,
@@ -303,16 +258,23 @@ def facturacion_ultimas(limit: int = Query(10, ge=1, le=50)):
 
 
 @app.get("/facturacion/cliente/{cliente_id}")
-def facturas_cliente(cliente_id: int, limit: int = Query(10, ge=1, le=100)):
+def facturas_cliente(
+    cliente_id: int,
+    response: Response,
+    limit: int = Query(10, ge=1, le=100),
+    after: str | None = Query(None, description="Cursor de X-Next-Cursor"),
+    estatus: str | None = None,
+):
     db: Session = SessionLocal()
     try:
-        rows = (
-            db.query(Factura)
-            .filter(Factura.cliente_id == cliente_id)
-            .order_by(Factura.creado_en.desc())
-            .limit(limit)
-            .all()
-        )
+        q = db.query(Factura).filter(Factura.cliente_id == cliente_id)
+        if estatus:
+            q = q.filter(Factura.estatus == estatus)
+        if after:
+            q = q.filter(tuple_(Factura.creado_en, Factura.id) < decodificar_cursor(after))
+        rows = q.order_by(Factura.creado_en.desc(), Factura.id.desc()).limit(limit).all()
+        if len(rows) == limit:
+            response.headers["X-Next-Cursor"] = codificar_cursor(rows[-1].creado_en, rows[-1].id)
         return [
             {
                 "uuid": fac.uuid,
@@ -342,9 +304,10 @@ def obtener_factura(uuid: str):
 def cancelar(uuid: str):
     db: Session = SessionLocal()
     try:
-        fac = db.query(Factura).filter(Factura.uuid == uuid).first()
+        fac = db.query(Factura).filter(Factura.uuid == uuid).with_for_update().first()
         if not fac:
             raise HTTPException(status_code=404, detail="No encontrado")
+        resumen_service.registrar(db, resumen_service.cambio(fac.creado_en, fac.cliente_id, fac.total, fac.estatus, "cancelado"))
         fac.estatus = "cancelado"
         db.commit()
         return {"uuid": fac.uuid, "estatus": fac.estatus, "acuse": f"Cancelado-{datetime.utcnow().isoformat()}"}
@@ -352,13 +315,49 @@ def cancelar(uuid: str):
         db.close()
 
 
+class PagarLoteIn(BaseModel):
+    uuids: list[str] = Field(..., min_length=1, max_length=1000)
+
+
+@app.patch("/facturacion/pagar-lote")
+def marcar_pagadas_lote(body: PagarLoteIn):
+    """Marca varias facturas como pagadas en una transacción (usado por el outbox de pagos)."""
+    db: Session = SessionLocal()
+    try:
+        uuids = list(dict.fromkeys(body.uuids))
+        # Bloqueo en orden de id para no cruzarse con otros lotes
+        facturas = db.execute(
+            select(Factura.id, Factura.uuid, Factura.estatus, Factura.creado_en, Factura.cliente_id, Factura.total)
+            .where(Factura.uuid.in_(uuids))
+            .order_by(Factura.id)
+            .with_for_update()
+        ).all()
+        cambiar = [f for f in facturas if f.estatus != "pagado"]
+        if cambiar:
+            db.execute(update(Factura).where(Factura.id.in_([f.id for f in cambiar])).values(estatus="pagado"))
+            resumen_service.registrar(
+                db,
+                (d for f in cambiar for d in resumen_service.cambio(f.creado_en, f.cliente_id, f.total, f.estatus, "pagado")),
+            )
+        db.commit()
+        encontradas = {f.uuid for f in facturas}
+        return {
+            "pagadas": [f.uuid for f in cambiar],
+            "ya_pagadas": [f.uuid for f in facturas if f.estatus == "pagado"],
+            "no_encontradas": [u for u in uuids if u not in encontradas],
+        }
+    finally:
+        db.close()
+
+
 @app.patch("/facturacion/{uuid}/pagar")
 def marcar_pagada(uuid: str):
     db: Session = SessionLocal()
     try:
-        fac = db.query(Factura).filter(Factura.uuid == uuid).first()
+        fac = db.query(Factura).filter(Factura.uuid == uuid).with_for_update().first()
         if not fac:
             raise HTTPException(status_code=404, detail="No encontrado")
+        resumen_service.registrar(db, resumen_service.cambio(fac.creado_en, fac.cliente_id, fac.total, fac.estatus, "pagado"))
         fac.estatus = "pagado"
         db.commit()
         return {"uuid": fac.uuid, "estatus": fac.estatus}
@@ -369,26 +368,24 @@ def marcar_pagada(uuid: str):
  
 
 
-async def consume_events():
-    import asyncio, json, os
-    path = "/app_events/events.log"
-    pos = 0
-    while True:
+def on_cliente_creado(payloads: list[dict]):
+    zonas = {}
+    for payload in payloads:
+        logger.info("consumed ClienteCreado", extra={"service": service_name, "cid": str(payload.get("cliente_id"))})
+        if payload.get("cliente_id") and payload.get("zona"):
+            zonas[int(payload["cliente_id"])] = str(payload["zona"])[:100]
+    if zonas:
+        # Proyección local cliente -> zona para el aging por zona
+        db: Session = SessionLocal()
         try:
-            if os.path.exists(path):
-                with open(path, "r", encoding="utf-8") as f:
-                    f.seek(pos)
-                    for line in f:
-                        pos = f.tell()
-                        try:
-                            evt = json.loads(line)
-                            if evt.get("topic") == "ClienteCreado":
-                                logger.info("consumed ClienteCreado", extra={"service": service_name, "cid": str(evt.get("payload", {}).get("cliente_id"))})
-                        except Exception:
-                            pass
-        except Exception:
-            pass
-        await asyncio.sleep(2)
+            aging_service.registrar_zonas(db, zonas)
+            db.commit()
+        finally:
+            db.close()
+
+
+consumidor_eventos = ConsumidorEventos()
+consumidor_eventos.suscribir("ClienteCreado", on_cliente_creado)
 
 # expose metrics at import time
 Instrumentator().instrument(app).expose(app)
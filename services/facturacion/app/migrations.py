@@ -0,0 +1,82 @@
+"""
+Migraciones idempotentes del esquema de facturación.
+
+`create_all` solo crea tablas nuevas; los cambios sobre tablas existentes
+(columnas, índices) se registran aquí y se aplican una sola vez por base,
+anotados en `facturacion_migraciones`.
+"""
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import inspect, select, text
+from sqlalchemy.engine import Connection, Engine
+
+from .models import Factura, SchemaMigracion
+
+
+def _agregar_columna(conn: Connection, tabla: str, columna) -> None:
+    existentes = {c["name"] for c in inspect(conn).get_columns(tabla)}
+    if columna.name in existentes:
+        return
+    tipo = columna.type.compile(dialect=conn.dialect)
+    conn.execute(text(f"ALTER TABLE {tabla} ADD COLUMN {columna.name} {tipo}"))
+
+
+def _0001_facturas_fecha_emision_folio(conn: Connection) -> None:
+    tabla = Factura.__table__
+    _agregar_columna(conn, tabla.name, tabla.c.folio)
+    _agregar_columna(conn, tabla.name, tabla.c.fecha_emision)
+    conn.execute(text("UPDATE facturas SET fecha_emision = creado_en WHERE fecha_emision IS NULL"))
+
+
+def _0002_facturas_indices_listado(conn: Connection) -> None:
+    existentes = {ix["name"] for ix in inspect(conn).get_indexes(Factura.__tablename__)}
+    for index in Factura.__table__.indexes:
+        if index.name in existentes:
+            continue
+        if conn.dialect.name == "postgresql":
+            # Sin bloquear escrituras sobre facturas; requiere AUTOCOMMIT
+            cols = ", ".join(c.name for c in index.columns)
+            conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} ON {index.table.name} ({cols})"))
+        else:
+            index.create(conn, checkfirst=True)
+
+
+MIGRACIONES: List[Tuple[str, Callable[[Connection], None], bool]] = [
+    # (id, función, requiere AUTOCOMMIT)
+    ("0001_facturas_fecha_emision_folio", _0001_facturas_fecha_emision_folio, False),
+    ("0002_facturas_indices_listado", _0002_facturas_indices_listado, True),
+]
+
+
+# Clave arbitraria del advisory lock que serializa réplicas arrancando a la vez
+_LOCK_ID = 742001
+
+
+def aplicar_migraciones(engine: Engine) -> None:
+    if engine.dialect.name != "postgresql":
+        _aplicar_pendientes(engine)
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_conn:
+        lock_conn.execute(text("SELECT pg_advisory_lock(:k)"), {"k": _LOCK_ID})
+        try:
+            _aplicar_pendientes(engine)
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": _LOCK_ID})
+
+
+def _aplicar_pendientes(engine: Engine) -> None:
+    with engine.connect() as conn:
+        aplicadas = set(conn.execute(select(SchemaMigracion.id)).scalars())
+    for mig_id, fn, autocommit in MIGRACIONES:
+        if mig_id in aplicadas:
+            continue
+        if autocommit:
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                fn(conn)
+            with engine.begin() as conn:
+                conn.execute(SchemaMigracion.__table__.insert().values(id=mig_id, aplicado_en=datetime.utcnow()))
+        else:
+            with engine.begin() as conn:
+                fn(conn)
+                conn.execute(SchemaMigracion.__table__.insert().values(id=mig_id, aplicado_en=datetime.utcnow()))
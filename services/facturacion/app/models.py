@@ -1,16 +1,120 @@
 from sqlalchemy.orm import Mapped, mapped_column
-from sqlalchemy import Integer, String, Float, DateTime
-from datetime import datetime
+from sqlalchemy import BigInteger, Integer, String, Float, Date, DateTime, Boolean, Index, Text
+from datetime import date, datetime
 from .db import Base
 
 
 class Factura(Base):
     __tablename__ = "facturas"
+    # Índices de los listados (keyset por fecha + id); en BDs existentes los crea migrations.py
+    __table_args__ = (
+        Index("ix_facturas_cliente_creado", "cliente_id", "creado_en", "id"),
+        Index("ix_facturas_estatus_emision", "estatus", "fecha_emision", "id"),
+        Index("ix_facturas_fecha_emision", "fecha_emision", "id"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     uuid: Mapped[str] = mapped_column(String(64), unique=True)
     cliente_id: Mapped[int] = mapped_column(Integer)
     total: Mapped[float] = mapped_column(Float)
     xml_path: Mapped[str] = mapped_column(String(255))
     estatus: Mapped[str] = mapped_column(String(20), default="pendiente")
+    folio: Mapped[str | None] = mapped_column(String(64), nullable=True)
+    fecha_emision: Mapped[datetime | None] = mapped_column(DateTime, default=datetime.utcnow, nullable=True)
     creado_en: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
+
+class SchemaMigracion(Base):
+    __tablename__ = "facturacion_migraciones"
+    id: Mapped[str] = mapped_column(String(100), primary_key=True)
+    aplicado_en: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+
+class TimbradoPendiente(Base):
+    """Cola persistente de timbrado; la fila se elimina al timbrar la factura."""
+    __tablename__ = "timbrado_cola"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    factura_id: Mapped[int] = mapped_column(Integer, unique=True)
+    estatus: Mapped[str] = mapped_column(String(20), default="pendiente")
+    intentos: Mapped[int] = mapped_column(Integer, default=0)
+    proximo_intento: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+    ultimo_error: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    creado_en: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class LoteJob(Base):
+    """Checkpoint de un lote CSV, identificado por el hash del archivo."""
+    __tablename__ = "lote_jobs"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    archivo_hash: Mapped[str] = mapped_column(String(64), unique=True)
+    estatus: Mapped[str] = mapped_column(String(20), default="en_proceso", index=True)
+    # Solo para jobs asíncronos: copia del archivo subido y parámetros
+    archivo_path: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    idem: Mapped[bool] = mapped_column(Boolean, default=True)
+    chunk: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    total_filas: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    ultima_fila: Mapped[int] = mapped_column(Integer, default=0)
+    fila_inicio: Mapped[int] = mapped_column(Integer, default=0)
+    procesados: Mapped[int] = mapped_column(Integer, default=0)
+    exitosos: Mapped[int] = mapped_column(Integer, default=0)
+    fallidos: Mapped[int] = mapped_column(Integer, default=0)
+    csv_resultado: Mapped[str] = mapped_column(String(255))
+    creado_en: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    iniciado_en: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    actualizado_en: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class FacturaResumenDiario(Base):
+    """Rollup de facturas por día de emisión y estatus (ver resumen_service)."""
+    __tablename__ = "facturas_resumen_diario"
+    fecha: Mapped[date] = mapped_column(Date, primary_key=True)
+    estatus: Mapped[str] = mapped_column(String(20), primary_key=True)
+    cantidad: Mapped[int] = mapped_column(Integer, default=0)
+    monto: Mapped[float] = mapped_column(Float, default=0.0)
+
+
+class FacturaResumenCliente(Base):
+    """Rollup de facturas por cliente y estatus, para KPIs de clientes distintos."""
+    __tablename__ = "facturas_resumen_cliente"
+    cliente_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    estatus: Mapped[str] = mapped_column(String(20), primary_key=True)
+    cantidad: Mapped[int] = mapped_column(Integer, default=0)
+
+
+class EventoFallido(Base):
+    """Evento que un manejador no pudo procesar tras agotar reintentos (dead-letter)."""
+    __tablename__ = "eventos_fallidos"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    grupo: Mapped[str] = mapped_column(String(64))
+    topic: Mapped[str] = mapped_column(String(100))
+    payload: Mapped[str] = mapped_column(Text)
+    error: Mapped[str] = mapped_column(Text)
+    creado_en: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class EventoOffset(Base):
+    """Posición confirmada de un grupo de consumidores en el log de eventos."""
+    __tablename__ = "eventos_offsets"
+    grupo: Mapped[str] = mapped_column(String(64), primary_key=True)
+    # Identidad del archivo (inode) al que se refiere la posición: si cambia, hubo rotación
+    inode: Mapped[int] = mapped_column(BigInteger, default=0)
+    posicion: Mapped[int] = mapped_column(BigInteger, default=0)
+    actualizado_en: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class ClienteZona(Base):
+    """Zona de cada cliente, proyectada desde los eventos ClienteCreado (para aging por zona)."""
+    __tablename__ = "clientes_zonas"
+    cliente_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    zona: Mapped[str] = mapped_column(String(100), index=True)
+    actualizado_en: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class AgingCorte(Base):
+    """Reporte de antigüedad de saldos ya calculado para un periodo cerrado (ver aging_service)."""
+    __tablename__ = "aging_cortes"
+    periodo: Mapped[str] = mapped_column(String(7), primary_key=True)
+    agrupar: Mapped[str] = mapped_column(String(10), primary_key=True)
+    # Filas del reporte serializadas como JSON
+    contenido: Mapped[str] = mapped_column(Text)
+    generado_en: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
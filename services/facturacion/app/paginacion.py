@@ -0,0 +1,20 @@
+import base64
+from datetime import datetime
+from typing import Tuple
+
+from fastapi import HTTPException
+
+
+def codificar_cursor(fecha: datetime, id_: int) -> str:
+    """Cursor opaco para paginación keyset sobre (fecha, id) descendente."""
+    raw = f"{fecha.isoformat()}|{id_}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decodificar_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        fecha, id_ = raw.split("|", 1)
+        return datetime.fromisoformat(fecha), int(id_)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
@@ -1,6 +1,16 @@
+import os
+
 from fastapi import APIRouter, UploadFile, File, HTTPException, Query
+from fastapi.responses import FileResponse, JSONResponse
 
-from ..services.facturacion_lote_service import procesar_lote_csv
+from ..services.facturacion_lote_service import (
+    LOTE_CHUNK_SIZE,
+    LoteEnCurso,
+    encolar_lote_csv,
+    estado_job,
+    procesar_lote_csv,
+    ruta_resultado,
+)
 
 
 router = APIRouter()
@@ -10,7 +20,36 @@ router = APIRouter()
 async def facturacion_lote(
     file: UploadFile = File(...),
     idem: int = Query(default=1, description="1=modo idempotente (upsert), 0=estricto"),
+    chunk: int = Query(default=LOTE_CHUNK_SIZE, ge=1, le=50000, description="Filas por commit"),
+    asincrono: int = Query(default=0, description="1=encolar y responder con job_id"),
 ):
     if not file.filename.lower().endswith(".csv"):
         raise HTTPException(status_code=400, detail="El archivo debe ser CSV")
-    return await procesar_lote_csv(file, idem=bool(idem))
+    if asincrono:
+        job = await encolar_lote_csv(file, idem=bool(idem), chunk_size=chunk)
+        return JSONResponse(status_code=202, content=job)
+    try:
+        return await procesar_lote_csv(file, idem=bool(idem), chunk_size=chunk)
+    except LoteEnCurso as e:
+        raise HTTPException(status_code=409, detail={"mensaje": str(e), "job_id": e.job_id, "estatus": e.estatus})
+
+
+@router.get("/facturacion/lote/{job_id}")
+async def facturacion_lote_estado(job_id: int):
+    estado = await estado_job(job_id)
+    if estado is None:
+        raise HTTPException(status_code=404, detail="No encontrado")
+    return estado
+
+
+@router.get("/facturacion/lote/{job_id}/resultado")
+async def facturacion_lote_resultado(job_id: int):
+    estado = await estado_job(job_id)
+    if estado is None:
+        raise HTTPException(status_code=404, detail="No encontrado")
+    if estado["estatus"] != "completado":
+        raise HTTPException(status_code=409, detail=f"Job en estatus {estado['estatus']}")
+    path = ruta_resultado(estado["csv_resultado"])
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="CSV de resultado no disponible")
+    return FileResponse(path, media_type="text/csv", filename=estado["csv_resultado"])
@@ -0,0 +1,150 @@
+"""
+Antigüedad de saldos (aging) de cuentas por cobrar al cierre de un periodo.
+
+Una sola consulta agrupada por cliente (o por zona) suma el saldo de las
+facturas no pagadas ni canceladas en los tramos 0-30, 31-60, 61-90 y 90+
+días. Los tramos se calculan comparando `fecha_emision` contra fechas de
+corte calculadas en Python (SUM(CASE ...)), sin aritmética de fechas propia de
+cada dialecto. La zona sale de `clientes_zonas`, la proyección local de los
+eventos ClienteCreado; los clientes sin evento quedan en "sin_zona".
+
+Los periodos cerrados se guardan en `aging_cortes` la primera vez que se
+piden; las corridas repetidas del cierre leen esa copia. El periodo en curso
+siempre se calcula en vivo.
+
+Limitación: la antigüedad usa el estatus actual de cada factura, no el que
+tenía al corte (no se registra la fecha de pago).
+"""
+import json
+import os
+from datetime import date, datetime, time, timedelta
+from typing import Any, Dict, Iterator, List
+
+from sqlalchemy import case, func, literal, select
+from sqlalchemy.orm import Session
+
+from ..db import upsert_insert
+from ..logging_conf import configure_logging
+from ..models import AgingCorte, ClienteZona, Factura
+
+
+service_name = os.getenv("SERVICE_NAME", "facturacion")
+logger = configure_logging(service_name)
+
+TRAMOS = ("d0_30", "d31_60", "d61_90", "d90_mas")
+SIN_ZONA = "sin_zona"
+ESTATUS_SALDADOS = ("pagado", "cancelado")
+
+
+class PeriodoInvalido(ValueError):
+    pass
+
+
+def periodo_anterior(hoy: date | None = None) -> str:
+    """Último periodo cerrado ("YYYY-MM")."""
+    hoy = hoy or datetime.utcnow().date()
+    return (hoy.replace(day=1) - timedelta(days=1)).strftime("%Y-%m")
+
+
+def fecha_corte(periodo: str) -> date:
+    """Último día del periodo."""
+    try:
+        inicio = datetime.strptime(periodo, "%Y-%m").date()
+    except ValueError:
+        raise PeriodoInvalido("Periodo inválido, se espera YYYY-MM")
+    return (inicio.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+
+
+def _consulta(corte: date, agrupar: str):
+    fecha = func.coalesce(Factura.fecha_emision, Factura.creado_en)
+    # Inicio del día (corte - n): una factura de ese día tiene n días de antigüedad
+    limite = {n: datetime.combine(corte - timedelta(days=n), time.min) for n in (30, 60, 90)}
+    tramos = [
+        fecha >= limite[30],
+        (fecha >= limite[60]) & (fecha < limite[30]),
+        (fecha >= limite[90]) & (fecha < limite[60]),
+        fecha < limite[90],
+    ]
+    sumas = [func.coalesce(func.sum(case((cond, Factura.total), else_=0)), 0).label(t) for t, cond in zip(TRAMOS, tramos)]
+    zona = func.coalesce(ClienteZona.zona, literal(SIN_ZONA)).label("zona")
+    if agrupar == "zona":
+        claves = [zona]
+        extra = [func.count(func.distinct(Factura.cliente_id)).label("clientes")]
+    else:
+        claves = [Factura.cliente_id, zona]
+        extra = []
+    return (
+        select(*claves, *extra, func.count().label("facturas"), *sumas)
+        .select_from(Factura)
+        .outerjoin(ClienteZona, ClienteZona.cliente_id == Factura.cliente_id)
+        .where(
+            Factura.estatus.not_in(ESTATUS_SALDADOS),
+            fecha < datetime.combine(corte + timedelta(days=1), time.min),
+        )
+        .group_by(*claves)
+        .order_by(*claves)
+    )
+
+
+def calcular(db: Session, periodo: str, agrupar: str = "cliente") -> List[Dict[str, Any]]:
+    corte = fecha_corte(periodo)
+    filas = []
+    for r in db.execute(_consulta(corte, agrupar)).mappings():
+        fila = dict(r)
+        for t in TRAMOS:
+            fila[t] = round(float(fila[t]), 2)
+        fila["total"] = round(sum(fila[t] for t in TRAMOS), 2)
+        filas.append(fila)
+    return filas
+
+
+def reporte(db: Session, periodo: str, agrupar: str = "cliente", refrescar: bool = False) -> List[Dict[str, Any]]:
+    """Aging del periodo; los periodos cerrados se sirven de `aging_cortes`."""
+    cerrado = fecha_corte(periodo) < datetime.utcnow().date()
+    if cerrado and not refrescar:
+        guardado = db.get(AgingCorte, (periodo, agrupar))
+        if guardado is not None:
+            return json.loads(guardado.contenido)
+    filas = calcular(db, periodo, agrupar)
+    if cerrado:
+        ins = upsert_insert(db)(AgingCorte).values(
+            periodo=periodo, agrupar=agrupar, contenido=json.dumps(filas), generado_en=datetime.utcnow()
+        )
+        db.execute(
+            ins.on_conflict_do_update(
+                index_elements=[AgingCorte.periodo, AgingCorte.agrupar],
+                set_={"contenido": ins.excluded.contenido, "generado_en": ins.excluded.generado_en},
+            )
+        )
+        db.commit()
+    logger.info(
+        f"[INFO] Aging {periodo} por {agrupar}: {len(filas)} filas" + (" (guardado)" if cerrado else ""),
+        extra={"service": service_name},
+    )
+    return filas
+
+
+def a_csv(filas: List[Dict[str, Any]], agrupar: str = "cliente", bloque: int = 1000) -> Iterator[str]:
+    """CSV del reporte en chunks de `bloque` filas."""
+    columnas = (["zona", "clientes"] if agrupar == "zona" else ["cliente_id", "zona"]) + ["facturas", *TRAMOS, "total"]
+    yield ",".join(columnas) + "\n"
+    for i in range(0, len(filas), bloque):
+        yield "".join(
+            ",".join(f"{f[c]:.2f}" if isinstance(f[c], float) else str(f[c]).replace(",", " ") for c in columnas) + "\n"
+            for f in filas[i : i + bloque]
+        )
+
+
+def registrar_zonas(db: Session, zonas: Dict[int, str]) -> None:
+    """Upsert de la proyección cliente -> zona (no hace commit)."""
+    if not zonas:
+        return
+    ahora = datetime.utcnow()
+    ins = upsert_insert(db)(ClienteZona)
+    db.execute(
+        ins.on_conflict_do_update(
+            index_elements=[ClienteZona.cliente_id],
+            set_={"zona": ins.excluded.zona, "actualizado_en": ins.excluded.actualizado_en},
+        ),
+        [{"cliente_id": c, "zona": z, "actualizado_en": ahora} for c, z in zonas.items()],
+    )
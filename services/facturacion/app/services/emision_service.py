@@ -0,0 +1,103 @@
+import os
+import time
+import uuid as uuidlib
+from datetime import datetime
+from typing import Any, Dict, List
+
+from opentelemetry import trace
+from sqlalchemy import insert
+from sqlalchemy.orm import Session
+
+from ..logging_conf import configure_logging
+from ..models import Factura
+from .. import cfdi, storage
+from . import resumen_service
+
+
+service_name = os.getenv("SERVICE_NAME", "facturacion")
+logger = configure_logging(service_name)
+tracer = trace.get_tracer(__name__)
+
+
+def uuids_idempotentes(idempotency_key: str, n: int) -> List[str]:
+    """UUIDs deterministas por (llave, posición): un reintento del mismo lote choca con las facturas ya emitidas."""
+    return [str(uuidlib.uuid5(uuidlib.NAMESPACE_URL, f"facturacion/lote/{idempotency_key}/{i}")) for i in range(n)]
+
+
+def emitir_lote(db: Session, lote: List[Dict[str, Any]], uuids: List[str] | None = None) -> List[Dict[str, Any]]:
+    """
+    Emite un lote de facturas en tres fases:
+    - Renderiza todos los CFDI (XML) del lote en un solo buffer con la
+      plantilla precompilada; cada item puede traer `receptor` y `conceptos`
+    - Sube los XML en paralelo con el executor compartido, o como un solo
+      paquete zip/tar si FACTURACION_S3_EMPAQUETADO está activo
+    - Inserta todas las filas con un único INSERT multi-fila ... RETURNING
+
+    No hace commit: el llamador controla la transacción. `uuids` (ver
+    uuids_idempotentes) reemplaza los UUID aleatorios, uno por item.
+    Retorna una fila por factura con id, uuid, cliente_id, total y tiempo_ms
+    (tiempo amortizado del lote por factura).
+    """
+    if not lote:
+        return []
+
+    t0 = time.perf_counter()
+    with tracer.start_as_current_span("facturacion.emision.lote") as span:
+        span.set_attribute("batch.size", len(lote))
+
+        ahora = datetime.utcnow()
+        filas: List[Dict[str, Any]] = []
+        datos_cfdi: List[Dict[str, Any]] = []
+        for i, item in enumerate(lote):
+            cliente_id = int(item.get("cliente_id"))
+            total = float(item.get("total", 0))
+            uuid = uuids[i] if uuids else str(uuidlib.uuid4())
+            datos_cfdi.append({**item, "cliente_id": cliente_id, "total": total, "uuid": uuid, "fecha": ahora})
+            filas.append(
+                {
+                    "uuid": uuid,
+                    "cliente_id": cliente_id,
+                    "total": total,
+                    "xml_path": f"{uuid}.xml",
+                    "estatus": "pendiente",
+                    "creado_en": ahora,
+                    "fecha_emision": ahora,
+                }
+            )
+
+        xmls = cfdi.plantilla().render_lote(datos_cfdi)
+        objetos = [(f["xml_path"], xml, "application/xml") for f, xml in zip(filas, xmls)]
+        if storage.EMPAQUETADO:
+            paquete = storage.empaquetar(str(uuidlib.uuid4()), objetos)
+            for f in filas:
+                f["xml_path"] = f"{paquete}#{f['xml_path']}"
+        else:
+            storage.subir_objetos(objetos)
+
+        # SQLAlchemy agrupa los parámetros en INSERT multi-fila con RETURNING
+        # (insertmanyvalues) y conserva el orden de entrada.
+        stmt = insert(Factura).returning(Factura.id, Factura.uuid, sort_by_parameter_order=True)
+        ids = db.execute(stmt, filas).all()
+        resumen_service.registrar(
+            db,
+            (d for f in filas for d in resumen_service.alta(ahora, f["cliente_id"], "pendiente", f["total"])),
+        )
+
+        dt_ms = (time.perf_counter() - t0) * 1000.0
+        por_factura_ms = dt_ms / len(filas)
+        span.set_attribute("batch.tiempo_total_ms", int(dt_ms))
+
+    logger.info(
+        f"[INFO] Lote emitido: {len(filas)} facturas en {int(dt_ms)} ms",
+        extra={"service": service_name},
+    )
+    return [
+        {
+            "id": row.id,
+            "uuid": row.uuid,
+            "cliente_id": f["cliente_id"],
+            "total": f["total"],
+            "tiempo_ms": por_factura_ms,
+        }
+        for row, f in zip(ids, filas)
+    ]
@@ -0,0 +1,318 @@
+"""
+Consumidor del log de eventos compartido (/app_events/events.log).
+
+Cada grupo de consumidores guarda su posición confirmada (offset en bytes
+más el inode del archivo) en `eventos_offsets`, así un reinicio continúa
+donde se quedó en lugar de releer todo el log. El archivo se mantiene
+abierto entre lecturas y se detecta rotación (cambia el inode) y truncado o
+compactación (el tamaño queda por debajo del offset). Las esperas usan
+watchfiles (inotify, viene con uvicorn[standard]) y caen a polling si no
+está disponible.
+
+Entrega al-menos-una-vez: el offset se confirma después de despachar cada
+lote, así que tras una caída puede repetirse como mucho el último lote. Si un
+manejador falla, el offset no avanza: el lote se reintenta con backoff y,
+tras FACTURACION_EVENTOS_MAX_REINTENTOS fallos seguidos, los payloads que
+fallaron se guardan en `eventos_fallidos` (dead-letter) y el consumidor sigue.
+Los manejadores deben ser idempotentes: un reintento repite el lote completo.
+"""
+import asyncio
+import json
+import os
+from collections import defaultdict
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Tuple
+
+from ..db import SessionLocal, upsert_insert
+from ..logging_conf import configure_logging
+from ..models import EventoFallido, EventoOffset
+
+# Optional deps: watchfiles para despertar con inotify en lugar de dormir fijo
+try:
+    from watchfiles import awatch  # type: ignore
+except Exception:  # pragma: no cover - tolerate missing watchfiles
+    awatch = None
+
+
+service_name = os.getenv("SERVICE_NAME", "facturacion")
+logger = configure_logging(service_name)
+
+EVENTOS_PATH = os.getenv("FACTURACION_EVENTOS_PATH", "/app_events/events.log")
+EVENTOS_GRUPO = os.getenv("FACTURACION_EVENTOS_GRUPO", "facturacion")
+# Bytes leídos (y decodificados de una vez) por lote
+EVENTOS_BATCH_BYTES = int(os.getenv("FACTURACION_EVENTOS_BATCH_BYTES", str(1024 * 1024)))
+# Intervalo de polling sin watchfiles; con watchfiles, revisión de respaldo
+EVENTOS_POLL_SEGUNDOS = float(os.getenv("FACTURACION_EVENTOS_POLL_SEGUNDOS", "2.0"))
+EVENTOS_MAX_REINTENTOS = int(os.getenv("FACTURACION_EVENTOS_MAX_REINTENTOS", "5"))
+EVENTOS_BACKOFF_MAX_SEGUNDOS = float(os.getenv("FACTURACION_EVENTOS_BACKOFF_MAX_SEGUNDOS", "60"))
+
+# Recibe los payloads de un mismo topic de un lote, en orden
+Manejador = Callable[[List[Dict[str, Any]]], None]
+# (topic, payloads, error) de cada manejador que falló
+Fallo = Tuple[str, List[Dict[str, Any]], str]
+
+
+class ManejadorFallido(Exception):
+    def __init__(self, fallos: List[Fallo]) -> None:
+        super().__init__(f"{len(fallos)} manejadores fallaron")
+        self.fallos = fallos
+
+
+def decodificar_lote(lineas: List[bytes]) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Decodifica varias líneas JSON con una sola llamada a json.loads (como
+    arreglo). Si alguna está corrupta cae a línea por línea y descarta las
+    inválidas. Retorna (eventos, líneas inválidas).
+    """
+    lineas = [linea for linea in lineas if linea.strip()]
+    if not lineas:
+        return [], 0
+    try:
+        eventos = json.loads(b"[" + b",".join(lineas) + b"]")
+    except ValueError:
+        eventos = []
+        for linea in lineas:
+            try:
+                eventos.append(json.loads(linea))
+            except ValueError:
+                pass
+    validos = [e for e in eventos if isinstance(e, dict)]
+    return validos, len(lineas) - len(validos)
+
+
+class ConsumidorEventos:
+    """Lector del log de eventos para un grupo de consumidores."""
+
+    def __init__(
+        self,
+        grupo: str = EVENTOS_GRUPO,
+        path: str = EVENTOS_PATH,
+        batch_bytes: int = EVENTOS_BATCH_BYTES,
+        poll_segundos: float = EVENTOS_POLL_SEGUNDOS,
+        max_reintentos: int = EVENTOS_MAX_REINTENTOS,
+    ) -> None:
+        self.grupo = grupo
+        self.path = path
+        self.batch_bytes = batch_bytes
+        self.poll_segundos = poll_segundos
+        self.max_reintentos = max_reintentos
+        # Fallos seguidos del lote en self._pos
+        self.fallos = 0
+        self._manejadores: Dict[str, List[Manejador]] = defaultdict(list)
+        self._f = None
+        self._inode = 0
+        self._pos = 0
+        self._cargado = False
+        self._task: asyncio.Task | None = None
+
+    def suscribir(self, topic: str, manejador: Manejador) -> None:
+        self._manejadores[topic].append(manejador)
+
+    # --- offsets ---------------------------------------------------------
+
+    def _cargar_offset(self) -> None:
+        db = SessionLocal()
+        try:
+            fila = db.get(EventoOffset, self.grupo)
+            if fila is not None:
+                self._inode, self._pos = fila.inode, fila.posicion
+        finally:
+            db.close()
+        self._cargado = True
+
+    def _confirmar(self) -> None:
+        db = SessionLocal()
+        try:
+            valores = {"inode": self._inode, "posicion": self._pos, "actualizado_en": datetime.utcnow()}
+            stmt = upsert_insert(db)(EventoOffset).values(grupo=self.grupo, **valores)
+            db.execute(stmt.on_conflict_do_update(index_elements=[EventoOffset.grupo], set_=valores))
+            db.commit()
+        finally:
+            db.close()
+
+    def _aparcar(self, fallos: List[Fallo]) -> None:
+        db = SessionLocal()
+        try:
+            db.add_all(
+                EventoFallido(grupo=self.grupo, topic=topic, payload=json.dumps(p), error=error)
+                for topic, payloads, error in fallos
+                for p in payloads
+            )
+            db.commit()
+        finally:
+            db.close()
+        logger.error(
+            f"[ERROR] {sum(len(f[1]) for f in fallos)} eventos a eventos_fallidos tras {self.fallos} intentos",
+            extra={"service": service_name},
+        )
+
+    # --- archivo ---------------------------------------------------------
+
+    def _abrir(self) -> bool:
+        try:
+            self._f = open(self.path, "rb")
+        except FileNotFoundError:
+            return False
+        st = os.fstat(self._f.fileno())
+        if st.st_ino != self._inode:
+            if self._inode:
+                logger.warning(
+                    "[WARN] Log de eventos rotado mientras el consumidor estaba detenido; leyendo desde el inicio",
+                    extra={"service": service_name},
+                )
+            self._inode, self._pos = st.st_ino, 0
+        elif st.st_size < self._pos:
+            self._truncado()
+        self._f.seek(self._pos)
+        return True
+
+    def _truncado(self) -> None:
+        logger.warning(
+            f"[WARN] Log de eventos truncado o compactado (offset {self._pos}); leyendo desde el inicio",
+            extra={"service": service_name},
+        )
+        self._pos = 0
+        if self._f is not None:
+            self._f.seek(0)
+
+    def _revisar_archivo(self) -> bool:
+        """
+        Llamado al llegar al final del archivo abierto. Retorna True si hay
+        que seguir leyendo: el log rotó (otro inode en la ruta; el archivo
+        viejo ya se drenó) o se truncó por debajo del offset.
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        if st.st_ino != self._inode:
+            logger.info("[INFO] Log de eventos rotado; siguiendo el archivo nuevo", extra={"service": service_name})
+            self.cerrar()
+            self._inode, self._pos = 0, 0
+            return self._abrir()
+        if st.st_size < self._pos:
+            self._truncado()
+            return True
+        return False
+
+    def cerrar(self) -> None:
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+
+    # --- lectura ---------------------------------------------------------
+
+    def _leer_lote(self) -> Tuple[int, bool]:
+        """Lee, decodifica y despacha un lote de líneas completas. Retorna (eventos, eof)."""
+        datos = self._f.read(self.batch_bytes)
+        eof = len(datos) < self.batch_bytes
+        fin = datos.rfind(b"\n")
+        if fin < 0 and not eof:
+            # Línea más larga que el lote: completarla
+            datos += self._f.readline()
+            fin = datos.rfind(b"\n")
+        if fin < 0:
+            # Solo una línea a medio escribir: esperar a que se complete
+            self._f.seek(self._pos)
+            return 0, True
+        completo = datos[: fin + 1]
+        self._f.seek(self._pos + len(completo))
+        eventos, invalidas = decodificar_lote(completo.split(b"\n"))
+        if invalidas:
+            logger.warning(
+                f"[WARN] {invalidas} líneas inválidas en el log de eventos",
+                extra={"service": service_name},
+            )
+        try:
+            self._despachar(eventos)
+        except ManejadorFallido as e:
+            self.fallos += 1
+            if self.fallos < self.max_reintentos:
+                # Sin avanzar el offset: el mismo lote se relee en el siguiente intento
+                self._f.seek(self._pos)
+                raise
+            self._aparcar(e.fallos)
+        self.fallos = 0
+        self._pos += len(completo)
+        self._confirmar()
+        return len(eventos), eof
+
+    def _despachar(self, eventos: List[Dict[str, Any]]) -> None:
+        por_topic: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        for evt in eventos:
+            topic = evt.get("topic")
+            if topic in self._manejadores:
+                por_topic[topic].append(evt.get("payload") or {})
+        fallos: List[Fallo] = []
+        for topic, payloads in por_topic.items():
+            for manejador in self._manejadores[topic]:
+                try:
+                    manejador(payloads)
+                except Exception as e:
+                    logger.exception(f"manejador de {topic} falló", extra={"service": service_name})
+                    fallos.append((topic, payloads, f"{type(e).__name__}: {e}"))
+        if fallos:
+            raise ManejadorFallido(fallos)
+
+    def drenar(self) -> int:
+        """Procesa todo lo disponible desde el offset confirmado; retorna eventos leídos."""
+        if not self._cargado:
+            self._cargar_offset()
+        if self._f is None and not self._abrir():
+            return 0
+        total = 0
+        while True:
+            leidos, eof = self._leer_lote()
+            total += leidos
+            if eof and not self._revisar_archivo():
+                return total
+
+    # --- ciclo asyncio ---------------------------------------------------
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self.cerrar()
+
+    async def _run(self) -> None:
+        async for _ in self._despertares():
+            try:
+                await asyncio.to_thread(self.drenar)
+            except asyncio.CancelledError:
+                raise
+            except ManejadorFallido:
+                # Backoff exponencial antes de reintentar el mismo lote
+                await asyncio.sleep(min(self.poll_segundos * 2 ** self.fallos, EVENTOS_BACKOFF_MAX_SEGUNDOS))
+            except Exception:
+                logger.exception("consumidor de eventos falló", extra={"service": service_name})
+
+    async def _despertares(self):
+        """Un tick al arrancar y luego uno por cambio en el archivo (o por timeout)."""
+        yield None
+        directorio = os.path.dirname(self.path) or "."
+        nombre = os.path.basename(self.path)
+        if awatch is not None and os.path.isdir(directorio):
+            try:
+                async for _ in awatch(
+                    directorio,
+                    watch_filter=lambda _cambio, ruta: os.path.basename(ruta) == nombre,
+                    debounce=50,
+                    step=10,
+                    rust_timeout=int(self.poll_segundos * 1000),
+                    yield_on_timeout=True,
+                    recursive=False,
+                ):
+                    yield None
+            except Exception:
+                logger.warning(
+                    "[WARN] watchfiles no disponible; consumidor de eventos en modo polling",
+                    extra={"service": service_name},
+                )
+        while True:
+            await asyncio.sleep(self.poll_segundos)
+            yield None
@@ -1,25 +1,51 @@
+import asyncio
 import csv
+import hashlib
 import io
+import itertools
 import os
 import time
-from datetime import datetime
-from typing import Dict, Any, List
+from datetime import datetime, timedelta
+from typing import Dict, Any, IO, Iterator, List, Tuple
 
 import aiofiles
 from fastapi import UploadFile
 from opentelemetry import trace
 from prometheus_client import Counter
+from sqlalchemy import and_, or_, select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
-from ..db import SessionLocal
+from ..db import SessionLocal, upsert_insert
 from ..logging_conf import configure_logging
-from ..models import Factura
+from ..models import Factura, LoteJob
+from . import resumen_service
 
 
 service_name = os.getenv("SERVICE_NAME", "facturacion")
 logger = configure_logging(service_name)
 tracer = trace.get_tracer(__name__)
 
+EXPORT_DIR = os.getenv("FACTURACION_EXPORT_DIR", "/app/exports/facturacion")
+
+# Filas por bloque: una consulta IN (...), un upsert y un commit por bloque
+LOTE_CHUNK_SIZE = int(os.getenv("FACTURACION_LOTE_CHUNK", "1000"))
+
+# Jobs asíncronos de /facturacion/lote
+LOTE_JOB_WORKERS = int(os.getenv("FACTURACION_LOTE_WORKERS", "1"))
+LOTE_JOB_POLL_SEGUNDOS = float(os.getenv("FACTURACION_LOTE_POLL_SEGUNDOS", "2.0"))
+LOTE_JOB_STALE_SEGUNDOS = float(os.getenv("FACTURACION_LOTE_STALE_SEGUNDOS", "300"))
+
+RESULT_HEADER = [
+    "folio_interno",
+    "cliente_id",
+    "plan_id",
+    "monto",
+    "estatus",
+    "detalle",
+    "tiempo_ms",
+]
+
 # Métrica personalizada: suma del tiempo total por ejecución (ms)
 FACTURACION_LOTE_TIEMPO_TOTAL_MS = Counter(
     "facturacion_lote_tiempo_total_ms",
@@ -27,149 +53,585 @@ FACTURACION_LOTE_TIEMPO_TOTAL_MS = Counter(
 )
 
 
-async def procesar_lote_csv(file: UploadFile, idem: bool = True) -> Dict[str, Any]:
-    """
-    Procesa un CSV con encabezado: cliente_id,plan_id,monto,folio_interno
-    - Inserta facturas con estatus 'emitida' por cada registro válido
-    - Genera CSV de resultados en /app/exports/facturacion/
-    - Retorna resumen JSON
-    """
-    # Leer contenido del archivo de forma asíncrona
-    raw = await file.read()
-    text = raw.decode("utf-8")
+def _iter_chunks(reader: Iterator[Dict[str, str]], size: int) -> Iterator[List[Dict[str, str]]]:
+    chunk: List[Dict[str, str]] = []
+    for row in reader:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
-    reader = csv.DictReader(io.StringIO(text))
-    rows: List[Dict[str, str]] = list(reader)
 
-    total_registros = len(rows)
-    logger.info(f"[INFO] Procesando lote con {total_registros} registros")
+def _upsert_stmt(db: Session, idem: bool):
+    """INSERT ... ON CONFLICT (uuid) según el dialecto (Postgres en prod, SQLite en tests)."""
+    stmt = upsert_insert(db)(Factura)
+    if not idem:
+        return stmt.on_conflict_do_nothing(index_elements=[Factura.uuid])
+    return stmt.on_conflict_do_update(
+        index_elements=[Factura.uuid],
+        set_={
+            "cliente_id": stmt.excluded.cliente_id,
+            "total": stmt.excluded.total,
+            "xml_path": stmt.excluded.xml_path,
+            "estatus": stmt.excluded.estatus,
+        },
+    )
+
+
+def _procesar_chunk(
+    db: Session, rows: List[Dict[str, str]], idem: bool, xml_path: str
+) -> Tuple[List[List[str]], int, int]:
+    """
+    Valida un bloque, precarga los folios existentes con un solo IN (...)
+    y aplica el bloque con un upsert. Retorna (resultados, exitosos, fallidos).
+    """
+    t0 = time.perf_counter()
+    folios = {(row.get("folio_interno") or "").strip() for row in rows}
+    folios.discard("")
+    existentes: Dict[str, Any] = {}
+    if folios:
+        existentes = {
+            f.uuid: f
+            for f in db.execute(
+                select(Factura.uuid, Factura.cliente_id, Factura.total, Factura.estatus, Factura.creado_en)
+                .where(Factura.uuid.in_(folios))
+            )
+        }
+    ahora = datetime.utcnow()
 
     resultados: List[List[str]] = []
+    filas: Dict[str, Dict[str, Any]] = {}
     exitosos = 0
     fallidos = 0
-    tiempos_ms_sum = 0.0
+    for row in rows:
+        estatus = "OK"
+        detalle = "Emisión simulada exitosa"
+        folio = ""
 
-    # Preparar DB
-    db: Session = SessionLocal()
+        # Validaciones
+        try:
+            cliente_id_raw = row.get("cliente_id")
+            plan_id_raw = row.get("plan_id")
+            monto_raw = row.get("monto")
+            folio = (row.get("folio_interno") or "").strip()
+
+            if not (cliente_id_raw and plan_id_raw and monto_raw and folio):
+                raise ValueError("Campos faltantes")
+
+            cliente_id = int(cliente_id_raw)
+            int(plan_id_raw)  # actualmente no usado para DB
+            monto = float(monto_raw)
+
+            if monto < 0:
+                raise ValueError("Monto negativo")
+
+            if folio in existentes or folio in filas:
+                if idem:
+                    # Idempotente: actualiza registro existente
+                    detalle = "Actualizado (idempotente)"
+                else:
+                    # Estricto: no tocar y marcar como duplicado
+                    raise LookupError("UUID ya existe")
+            filas[folio] = {
+                "uuid": folio,
+                "cliente_id": cliente_id,
+                "total": monto,
+                "xml_path": xml_path,
+                "estatus": "emitida",
+                "creado_en": ahora,
+                "fecha_emision": ahora,
+            }
+            exitosos += 1
+        except LookupError as e:
+            estatus = "DUPLICADO"
+            detalle = str(e.args[0])
+            fallidos += 1
+        except Exception as e:  # noqa: BLE001 - error de validación/negocio
+            estatus = "ERROR"
+            detalle = str(e)
+            fallidos += 1
+
+        resultados.append(
+            [
+                folio,
+                row.get("cliente_id", ""),
+                row.get("plan_id", ""),
+                row.get("monto", ""),
+                estatus,
+                detalle,
+            ]
+        )
 
-    # Asegurar carpeta de exportación
-    export_dir = "/app/exports/facturacion"
-    os.makedirs(export_dir, exist_ok=True)
+    if filas:
+        db.execute(_upsert_stmt(db, idem), list(filas.values()))
+        deltas: List[resumen_service.Delta] = []
+        for folio, fila in filas.items():
+            previa = existentes.get(folio)
+            if previa is None:
+                deltas += resumen_service.alta(ahora, fila["cliente_id"], "emitida", fila["total"])
+            else:
+                deltas += resumen_service.baja(previa.creado_en, previa.cliente_id, previa.estatus, previa.total)
+                deltas += resumen_service.alta(previa.creado_en, fila["cliente_id"], "emitida", fila["total"])
+        resumen_service.registrar(db, deltas)
+
+    # Tiempo amortizado por fila dentro del bloque
+    dt_ms = (time.perf_counter() - t0) * 1000.0
+    por_fila = str(int(dt_ms / len(rows)))
+    for r in resultados:
+        r.append(por_fila)
+    return resultados, exitosos, fallidos
+
+
+def _leer_siguiente_chunk(chunks: Iterator[List[Dict[str, str]]]) -> List[Dict[str, str]] | None:
+    return next(chunks, None)
+
+
+def _nombre_resultado() -> str:
     timestamp = datetime.now().strftime("%Y%m%d_%H%M")
-    out_filename = f"lote_{timestamp}.csv"
-    out_path = os.path.join(export_dir, out_filename)
+    return f"lote_{timestamp}.csv"
+
+
+def _hash_archivo(raw: IO[bytes]) -> str:
+    h = hashlib.sha256()
+    for bloque in iter(lambda: raw.read(1024 * 1024), b""):
+        h.update(bloque)
+    raw.seek(0)
+    return h.hexdigest()
+
+
+class LoteEnCurso(Exception):
+    """El archivo ya tiene un job en cola o en proceso (con avance reciente)."""
+
+    def __init__(self, job_id: int, estatus: str) -> None:
+        super().__init__(f"Lote en curso (job {job_id}, {estatus})")
+        self.job_id = job_id
+        self.estatus = estatus
+
+
+def _job_del_archivo(db: Session, archivo_hash: str, out_filename: str) -> Tuple[LoteJob, bool]:
+    """
+    Job del archivo con la fila bloqueada (FOR UPDATE), creándolo si no existe,
+    y si está en curso (`_en_curso`). Es la regla común de `_abrir_job` y
+    `_encolar_job`; un job completado que no está en curso se reinicia.
+    """
+    job = db.execute(
+        select(LoteJob).where(LoteJob.archivo_hash == archivo_hash).with_for_update()
+    ).scalar_one_or_none()
+    if job is None:
+        job = LoteJob(archivo_hash=archivo_hash, csv_resultado=out_filename)
+        db.add(job)
+        return job, False
+    if _en_curso(job):
+        return job, True
+    if job.estatus == "completado":
+        _reiniciar_job(job, out_filename)
+    return job, False
+
+
+def _abrir_job(db: Session, archivo_hash: str, out_filename: str, reclamado: bool = False) -> LoteJob:
+    """
+    Obtiene el checkpoint del archivo. Un lote sin terminar se reanuda desde
+    `ultima_fila`; uno completado (o nuevo) empieza de cero.
+
+    Un job en curso (ver `_job_del_archivo`) lanza LoteEnCurso, salvo que el
+    llamador sea el worker que ya lo reclamó en `_reclamar_job` (`reclamado`).
+    """
+    job, en_curso = _job_del_archivo(db, archivo_hash, out_filename)
+    if en_curso and not reclamado:
+        db.rollback()
+        raise LoteEnCurso(job.id, job.estatus)
+    job.estatus = "en_proceso"
+    job.fila_inicio = job.ultima_fila or 0
+    job.iniciado_en = job.actualizado_en = datetime.utcnow()
+    try:
+        db.commit()
+    except IntegrityError:
+        # Otro request creó el job del mismo archivo al mismo tiempo
+        db.rollback()
+        otro = db.execute(select(LoteJob).where(LoteJob.archivo_hash == archivo_hash)).scalar_one()
+        raise LoteEnCurso(otro.id, otro.estatus)
+    return job
+
+
+def _en_curso(job: LoteJob) -> bool:
+    """En cola, o en proceso con un worker vivo (ver LOTE_JOB_STALE_SEGUNDOS)."""
+    limite = datetime.utcnow() - timedelta(seconds=LOTE_JOB_STALE_SEGUNDOS)
+    return job.estatus == "en_cola" or (job.estatus == "en_proceso" and job.actualizado_en >= limite)
+
+
+def _reiniciar_job(job: LoteJob, out_filename: str) -> None:
+    job.ultima_fila = job.procesados = job.exitosos = job.fallidos = 0
+    job.csv_resultado = out_filename
+
+
+def _aplicar_chunk(
+    db: Session, job: LoteJob, rows: List[Dict[str, str]], idem: bool, xml_path: str
+) -> List[List[str]]:
+    """Aplica un bloque y avanza el checkpoint en la misma transacción."""
+    try:
+        resultados, ok, ko = _procesar_chunk(db, rows, idem, xml_path)
+        job.ultima_fila += len(rows)
+        job.procesados += len(rows)
+        job.exitosos += ok
+        job.fallidos += ko
+        job.actualizado_en = datetime.utcnow()
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return resultados
+
+
+def _marcar_job(db: Session, job: LoteJob, estatus: str) -> None:
+    upload = job.archivo_path if estatus == "completado" else None
+    job.estatus = estatus
+    job.actualizado_en = datetime.utcnow()
+    if upload:
+        job.archivo_path = None
+    db.commit()
+    if upload:
+        # La copia del upload solo sirve para reanudar; un job completado ya no la necesita
+        _borrar_upload(upload)
+
+
+def _borrar_upload(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def procesar_lote_stream(
+    raw: IO[bytes],
+    out_filename: str,
+    idem: bool = True,
+    chunk_size: int = LOTE_CHUNK_SIZE,
+    reclamado: bool = False,
+) -> Dict[str, Any]:
+    """
+    Procesa un CSV binario en bloques de `chunk_size` filas sin materializarlo:
+    el parseo y la escritura en DB de cada bloque corren en un hilo aparte y
+    los resultados se anexan al CSV de salida conforme avanzan.
+
+    Cada bloque se confirma junto con el checkpoint del archivo (lote_jobs),
+    así que volver a subir un archivo interrumpido reanuda tras la última
+    fila confirmada y sigue anexando a su CSV de resultados original. Si el
+    archivo ya se está procesando (otro request o un job asíncrono) lanza
+    LoteEnCurso.
+    """
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    archivo_hash = await asyncio.to_thread(_hash_archivo, raw)
+
+    # Preparar DB
+    db: Session = SessionLocal()
+    text = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+    t_inicio = time.perf_counter()
 
     # Procesar con traza
     with tracer.start_as_current_span("facturacion.lote.csv") as span:
-        span.set_attribute("batch.size", total_registros)
         try:
-            for row in rows:
-                t0 = time.perf_counter()
-                estatus = "OK"
-                detalle = "Emisión simulada exitosa"
-
-                # Validaciones
-                try:
-                    cliente_id_raw = row.get("cliente_id")
-                    plan_id_raw = row.get("plan_id")
-                    monto_raw = row.get("monto")
-                    folio = (row.get("folio_interno") or "").strip()
-
-                    if not (cliente_id_raw and plan_id_raw and monto_raw and folio):
-                        raise ValueError("Campos faltantes")
-
-                    cliente_id = int(cliente_id_raw)
-                    plan_id = int(plan_id_raw)  # actualmente no usado para DB
-                    monto = float(monto_raw)
-
-                    if monto < 0:
-                        raise ValueError("Monto negativo")
-
-                    existing = db.query(Factura).filter(Factura.uuid == folio).first()
-                    if existing:
-                        if idem:
-                            # Idempotente: actualiza registro existente
-                            existing.cliente_id = cliente_id
-                            existing.total = monto
-                            existing.xml_path = f"lotes/{out_filename}"
-                            existing.estatus = "emitida"
-                            exitosos += 1
-                            detalle = "Actualizado (idempotente)"
-                        else:
-                            # Estricto: no tocar y marcar como duplicado
-                            estatus = "DUPLICADO"
-                            detalle = "UUID ya existe"
-                            fallidos += 1
-                    else:
-                        fac = Factura(
-                            uuid=folio,
-                            cliente_id=cliente_id,
-                            total=monto,
-                            xml_path=f"lotes/{out_filename}",
-                            estatus="emitida",
-                        )
-                        db.add(fac)
-                        exitosos += 1
-                except Exception as e:  # noqa: BLE001 - error de validación/negocio
-                    estatus = "ERROR"
-                    detalle = str(e)
-                    fallidos += 1
-
-                dt_ms = (time.perf_counter() - t0) * 1000.0
-                tiempos_ms_sum += dt_ms
-                resultados.append(
-                    [
-                        folio,
-                        row.get("cliente_id", ""),
-                        row.get("plan_id", ""),
-                        row.get("monto", ""),
-                        estatus,
-                        detalle,
-                        str(int(dt_ms)),
-                    ]
-                )
+            job = await asyncio.to_thread(_abrir_job, db, archivo_hash, out_filename, reclamado)
+            reanudado_desde = job.ultima_fila
+            out_filename = job.csv_resultado
+            out_path = os.path.join(EXPORT_DIR, out_filename)
+            xml_path = f"lotes/{out_filename}"
+            if reanudado_desde:
+                logger.info(f"[INFO] Reanudando lote {archivo_hash[:12]} desde la fila {reanudado_desde}")
 
-            # Commit una sola vez al final para eficiencia
-            db.commit()
+            reader = itertools.islice(csv.DictReader(text), reanudado_desde, None)
+            chunks = _iter_chunks(reader, chunk_size)
+            try:
+                async with aiofiles.open(out_path, "a" if reanudado_desde else "w", encoding="utf-8", newline="") as f:
+                    out_buf = io.StringIO()
+                    writer = csv.writer(out_buf)
+                    if not reanudado_desde:
+                        writer.writerow(RESULT_HEADER)
+                    while True:
+                        rows = await asyncio.to_thread(_leer_siguiente_chunk, chunks)
+                        if rows is None:
+                            break
+                        resultados = await asyncio.to_thread(_aplicar_chunk, db, job, rows, idem, xml_path)
+                        writer.writerows(resultados)
+                        await f.write(out_buf.getvalue())
+                        out_buf.seek(0)
+                        out_buf.truncate()
+                    await f.write(out_buf.getvalue())
+            except Exception:
+                await asyncio.to_thread(_marcar_job, db, job, "fallido")
+                raise
+            await asyncio.to_thread(_marcar_job, db, job, "completado")
+            procesados, exitosos, fallidos = job.procesados, job.exitosos, job.fallidos
         finally:
             db.close()
+            text.detach()
 
-        # Guardar CSV de resultados (asíncrono)
-        header = [
-            "folio_interno",
-            "cliente_id",
-            "plan_id",
-            "monto",
-            "estatus",
-            "detalle",
-            "tiempo_ms",
-        ]
-
-        # Construir CSV en memoria para escribir en bloque
-        out_buf = io.StringIO()
-        writer = csv.writer(out_buf)
-        writer.writerow(header)
-        writer.writerows(resultados)
-        csv_text = out_buf.getvalue()
-
-        async with aiofiles.open(out_path, "w", encoding="utf-8", newline="") as f:
-            await f.write(csv_text)
-
-        total_ms_int = int(tiempos_ms_sum)
-        logger.info(f"[INFO] Tiempo total: {total_ms_int} ms")
+        total_ms_int = int((time.perf_counter() - t_inicio) * 1000.0)
+        logger.info(f"[INFO] Lote de {procesados} registros procesado en {total_ms_int} ms")
 
         # Métrica personalizada
         FACTURACION_LOTE_TIEMPO_TOTAL_MS.inc(total_ms_int)
 
         # Trazas
+        span.set_attribute("batch.size", procesados)
+        span.set_attribute("batch.reanudado_desde", reanudado_desde)
         span.set_attribute("batch.tiempo_total_ms", total_ms_int)
         span.set_attribute("batch.exitosos", exitosos)
         span.set_attribute("batch.fallidos", fallidos)
 
     return {
-        "procesados": total_registros,
+        "procesados": procesados,
         "exitosos": exitosos,
         "fallidos": fallidos,
-        "tiempo_total_ms": int(tiempos_ms_sum),
+        "tiempo_total_ms": total_ms_int,
         "csv_resultado": out_filename,
+        "reanudado_desde": reanudado_desde,
     }
+
+
+async def procesar_lote_csv(file: UploadFile, idem: bool = True, chunk_size: int = LOTE_CHUNK_SIZE) -> Dict[str, Any]:
+    """
+    Procesa un CSV con encabezado: cliente_id,plan_id,monto,folio_interno
+    - Inserta/actualiza facturas con estatus 'emitida' por cada registro válido
+    - Confirma cada bloque de `chunk_size` filas con su checkpoint
+    - Genera CSV de resultados en /app/exports/facturacion/
+    - Retorna resumen JSON
+    """
+    return await procesar_lote_stream(file.file, _nombre_resultado(), idem=idem, chunk_size=chunk_size)
+
+
+def _guardar_upload(raw: IO[bytes]) -> Tuple[str, str, int]:
+    """Copia el upload a EXPORT_DIR/uploads calculando hash y número de filas."""
+    upload_dir = os.path.join(EXPORT_DIR, "uploads")
+    os.makedirs(upload_dir, exist_ok=True)
+    h = hashlib.sha256()
+    lineas = 0
+    ultimo = b"\n"
+    tmp_path = os.path.join(upload_dir, f".tmp-{os.getpid()}-{time.monotonic_ns()}")
+    with open(tmp_path, "wb") as out:
+        for bloque in iter(lambda: raw.read(1024 * 1024), b""):
+            h.update(bloque)
+            lineas += bloque.count(b"\n")
+            ultimo = bloque[-1:]
+            out.write(bloque)
+    if ultimo != b"\n":
+        lineas += 1
+    archivo_hash = h.hexdigest()
+    path = os.path.join(upload_dir, f"{archivo_hash}.csv")
+    os.replace(tmp_path, path)
+    # Aproximado: no descuenta saltos de línea dentro de campos entrecomillados
+    return archivo_hash, path, max(lineas - 1, 0)
+
+
+def _encolar_job(raw: IO[bytes], idem: bool, chunk_size: int) -> LoteJob:
+    """
+    Deja el upload en cola. Un job en curso con su copia guardada se devuelve
+    tal cual; uno en proceso sin copia (request síncrono) recibe la del upload
+    sin cambiar de estatus, para que `_reclamar_job` lo retome si ese request
+    muere. Cualquier otro (nuevo, fallido, completado o sin avance reciente)
+    vuelve a 'en_cola' con la copia, reanudando desde su checkpoint.
+    """
+    archivo_hash, path, total_filas = _guardar_upload(raw)
+    db: Session = SessionLocal()
+    try:
+        job, en_curso = _job_del_archivo(db, archivo_hash, _nombre_resultado())
+        if en_curso and job.archivo_path:
+            # Ya en curso: devolver el mismo job
+            db.expunge(job)
+            return job
+        if not en_curso:
+            job.estatus = "en_cola"
+            job.actualizado_en = datetime.utcnow()
+        job.archivo_path = path
+        job.idem = idem
+        job.chunk = chunk_size
+        job.total_filas = total_filas
+        db.commit()
+        db.refresh(job)
+        db.expunge(job)
+        return job
+    finally:
+        db.close()
+
+
+async def encolar_lote_csv(file: UploadFile, idem: bool = True, chunk_size: int = LOTE_CHUNK_SIZE) -> Dict[str, Any]:
+    """Guarda el upload y lo deja en cola para el worker; no procesa filas."""
+    job = await asyncio.to_thread(_encolar_job, file.file, idem, chunk_size)
+    return {"job_id": job.id, "estatus": job.estatus, "total_filas": job.total_filas}
+
+
+def _reclamar_job() -> LoteJob | None:
+    """
+    Toma el siguiente job en cola (FOR UPDATE SKIP LOCKED). También recupera
+    jobs 'en_proceso' sin avance reciente, cuyo worker murió: se reanudan
+    desde su checkpoint.
+    """
+    db: Session = SessionLocal()
+    try:
+        limite = datetime.utcnow() - timedelta(seconds=LOTE_JOB_STALE_SEGUNDOS)
+        job = db.execute(
+            select(LoteJob)
+            .where(
+                LoteJob.archivo_path.is_not(None),
+                or_(
+                    LoteJob.estatus == "en_cola",
+                    and_(LoteJob.estatus == "en_proceso", LoteJob.actualizado_en < limite),
+                ),
+            )
+            .order_by(LoteJob.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        ).scalar_one_or_none()
+        if job is None:
+            db.rollback()
+            return None
+        job.estatus = "en_proceso"
+        job.actualizado_en = datetime.utcnow()
+        db.commit()
+        db.refresh(job)
+        db.expunge(job)
+        return job
+    finally:
+        db.close()
+
+
+def _limpiar_uploads() -> int:
+    """
+    Borra de EXPORT_DIR/uploads las copias que ningún job en cola o en proceso
+    referencia (jobs fallidos, encolados que nunca se confirmaron, temporales
+    de un proceso caído). Respeta las más recientes que LOTE_JOB_STALE_SEGUNDOS
+    para no competir con un `_encolar_job` en curso.
+    """
+    upload_dir = os.path.join(EXPORT_DIR, "uploads")
+    if not os.path.isdir(upload_dir):
+        return 0
+    db: Session = SessionLocal()
+    try:
+        activos = set(
+            db.execute(
+                select(LoteJob.archivo_path).where(
+                    LoteJob.archivo_path.is_not(None), LoteJob.estatus.in_(["en_cola", "en_proceso"])
+                )
+            ).scalars()
+        )
+    finally:
+        db.close()
+    limite = time.time() - LOTE_JOB_STALE_SEGUNDOS
+    borrados = 0
+    with os.scandir(upload_dir) as entradas:
+        for entrada in entradas:
+            if entrada.path in activos or not entrada.is_file():
+                continue
+            try:
+                if entrada.stat().st_mtime >= limite:
+                    continue
+                os.remove(entrada.path)
+                borrados += 1
+            except FileNotFoundError:
+                pass
+    if borrados:
+        logger.info(f"[INFO] {borrados} uploads de lote huérfanos borrados", extra={"service": service_name})
+    return borrados
+
+
+async def procesar_siguiente_job() -> bool:
+    """Procesa un job en cola. Retorna False si no había trabajo."""
+    job = await asyncio.to_thread(_reclamar_job)
+    if job is None:
+        return False
+    logger.info(f"[INFO] Job de lote {job.id} iniciado")
+    raw = await asyncio.to_thread(open, job.archivo_path, "rb")
+    try:
+        await procesar_lote_stream(
+            raw, job.csv_resultado, idem=job.idem, chunk_size=job.chunk or LOTE_CHUNK_SIZE, reclamado=True
+        )
+    except Exception:
+        logger.exception(f"job de lote {job.id} falló", extra={"service": service_name})
+    finally:
+        raw.close()
+    return True
+
+
+def _estado_job(job_id: int) -> LoteJob | None:
+    db: Session = SessionLocal()
+    try:
+        job = db.get(LoteJob, job_id)
+        if job is not None:
+            db.expunge(job)
+        return job
+    finally:
+        db.close()
+
+
+async def estado_job(job_id: int) -> Dict[str, Any] | None:
+    job = await asyncio.to_thread(_estado_job, job_id)
+    if job is None:
+        return None
+    filas_por_segundo = 0.0
+    if job.iniciado_en is not None:
+        segundos = (job.actualizado_en - job.iniciado_en).total_seconds()
+        if segundos > 0:
+            filas_por_segundo = round((job.ultima_fila - job.fila_inicio) / segundos, 1)
+    return {
+        "job_id": job.id,
+        "estatus": job.estatus,
+        "total_filas": job.total_filas,
+        "procesados": job.procesados,
+        "exitosos": job.exitosos,
+        "fallidos": job.fallidos,
+        "filas_por_segundo": filas_por_segundo,
+        "csv_resultado": job.csv_resultado,
+        "actualizado_en": job.actualizado_en.isoformat(),
+    }
+
+
+def ruta_resultado(nombre: str) -> str:
+    return os.path.join(EXPORT_DIR, nombre)
+
+
+class LoteJobWorker:
+    """Workers asyncio que procesan los jobs de lote encolados."""
+
+    def __init__(self, workers: int = LOTE_JOB_WORKERS, poll_segundos: float = LOTE_JOB_POLL_SEGUNDOS) -> None:
+        self.workers = workers
+        self.poll_segundos = poll_segundos
+        self._tasks: List[asyncio.Task] = []
+        self._ultima_limpieza = float("-inf")
+
+    def start(self) -> None:
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._run()))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                trabajo = await procesar_siguiente_job()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("worker de lotes falló", extra={"service": service_name})
+                trabajo = False
+            if not trabajo:
+                await self._limpiar()
+                await asyncio.sleep(self.poll_segundos)
+
+    async def _limpiar(self) -> None:
+        """Barrido de uploads huérfanos, a lo más una vez por LOTE_JOB_STALE_SEGUNDOS."""
+        ahora = time.monotonic()
+        if ahora - self._ultima_limpieza < LOTE_JOB_STALE_SEGUNDOS:
+            return
+        self._ultima_limpieza = ahora
+        try:
+            await asyncio.to_thread(_limpiar_uploads)
+        except Exception:
+            logger.exception("limpieza de uploads de lote falló", extra={"service": service_name})
+
+
+lote_worker = LoteJobWorker()
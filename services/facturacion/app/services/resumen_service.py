@@ -0,0 +1,233 @@
+import asyncio
+import os
+from collections import defaultdict
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, List, NamedTuple
+
+from sqlalchemy import case, delete, func, select, text, true, tuple_
+from sqlalchemy.orm import Session
+
+from ..db import SessionLocal, upsert_insert
+from ..logging_conf import configure_logging
+from ..models import Factura, FacturaResumenCliente, FacturaResumenDiario
+
+
+service_name = os.getenv("SERVICE_NAME", "facturacion")
+logger = configure_logging(service_name)
+
+# Reconstrucción completa periódica como red de seguridad; opt-in (0 = solo la inicial, si hace falta)
+RESUMEN_RECONSTRUIR_SEGUNDOS = float(os.getenv("FACTURACION_RESUMEN_RECONSTRUIR_SEGUNDOS", "0"))
+
+# Clave arbitraria del advisory lock: una sola réplica reconstruye a la vez
+_LOCK_ID = 742011
+
+
+class Delta(NamedTuple):
+    fecha: date
+    cliente_id: int
+    estatus: str
+    cantidad: int
+    monto: float
+
+
+def _fecha(valor: datetime | date | str) -> date:
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, str):
+        return date.fromisoformat(valor[:10])
+    return valor
+
+
+def alta(creado_en: datetime, cliente_id: int, estatus: str, total: float) -> List[Delta]:
+    return [Delta(_fecha(creado_en), cliente_id, estatus, 1, total)]
+
+
+def baja(creado_en: datetime, cliente_id: int, estatus: str, total: float) -> List[Delta]:
+    return [Delta(_fecha(creado_en), cliente_id, estatus, -1, -total)]
+
+
+def cambio(creado_en: datetime, cliente_id: int, total: float, de: str, a: str) -> List[Delta]:
+    if de == a:
+        return []
+    return baja(creado_en, cliente_id, de, total) + alta(creado_en, cliente_id, a, total)
+
+
+def registrar(db: Session, deltas: Iterable[Delta]) -> None:
+    """
+    Aplica deltas a los rollups con un upsert acumulativo por tabla, dentro
+    de la transacción del llamador (se confirman junto con las facturas).
+    """
+    por_dia: Dict[tuple, List[float]] = defaultdict(lambda: [0, 0.0])
+    por_cliente: Dict[tuple, int] = defaultdict(int)
+    for d in deltas:
+        acc = por_dia[(d.fecha, d.estatus)]
+        acc[0] += d.cantidad
+        acc[1] += d.monto
+        por_cliente[(d.cliente_id, d.estatus)] += d.cantidad
+    if not por_dia:
+        return
+
+    insert_ = upsert_insert(db)
+    stmt = insert_(FacturaResumenDiario)
+    db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[FacturaResumenDiario.fecha, FacturaResumenDiario.estatus],
+            set_={
+                "cantidad": FacturaResumenDiario.cantidad + stmt.excluded.cantidad,
+                "monto": FacturaResumenDiario.monto + stmt.excluded.monto,
+            },
+        ),
+        [
+            {"fecha": fecha, "estatus": estatus, "cantidad": cant, "monto": monto}
+            for (fecha, estatus), (cant, monto) in sorted(por_dia.items())
+        ],
+    )
+    stmt = insert_(FacturaResumenCliente)
+    db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[FacturaResumenCliente.cliente_id, FacturaResumenCliente.estatus],
+            set_={"cantidad": FacturaResumenCliente.cantidad + stmt.excluded.cantidad},
+        ),
+        [
+            {"cliente_id": cliente_id, "estatus": estatus, "cantidad": cant}
+            for (cliente_id, estatus), cant in sorted(por_cliente.items())
+        ],
+    )
+
+
+def _tomar_liderazgo(db: Session) -> bool:
+    """Lock de la transacción en curso; las demás réplicas no esperan, omiten la corrida."""
+    if db.get_bind().dialect.name != "postgresql":
+        return True
+    return bool(db.execute(text("SELECT pg_try_advisory_xact_lock(:k)"), {"k": _LOCK_ID}).scalar())
+
+
+def reconstruir(db: Session) -> bool:
+    """
+    Recalcula ambos rollups desde `facturas` (dos GROUP BY) y confirma.
+
+    Upsert que sobrescribe los valores en lugar de DELETE + INSERT (sin
+    choques de llave si dos réplicas arrancan a la vez), seguido de borrar las
+    llaves que ya no tienen facturas. Retorna False si otra réplica ya estaba
+    reconstruyendo.
+    """
+    if not _tomar_liderazgo(db):
+        db.rollback()
+        logger.info("[INFO] Reconstrucción de rollups en curso en otra réplica; se omite", extra={"service": service_name})
+        return False
+    insert_ = upsert_insert(db)
+    dia = func.date(Factura.creado_en)
+    # WHERE true: evita la ambigüedad de INSERT ... SELECT ... ON CONFLICT en sqlite
+    por_dia = (
+        select(dia, Factura.estatus, func.count(), func.coalesce(func.sum(Factura.total), 0))
+        .where(true())
+        .group_by(dia, Factura.estatus)
+    )
+    stmt = insert_(FacturaResumenDiario).from_select(["fecha", "estatus", "cantidad", "monto"], por_dia)
+    db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[FacturaResumenDiario.fecha, FacturaResumenDiario.estatus],
+            set_={"cantidad": stmt.excluded.cantidad, "monto": stmt.excluded.monto},
+        )
+    )
+    db.execute(
+        delete(FacturaResumenDiario).where(
+            tuple_(FacturaResumenDiario.fecha, FacturaResumenDiario.estatus).not_in(
+                select(dia, Factura.estatus).group_by(dia, Factura.estatus)
+            )
+        )
+    )
+    por_cliente = (
+        select(Factura.cliente_id, Factura.estatus, func.count())
+        .where(true())
+        .group_by(Factura.cliente_id, Factura.estatus)
+    )
+    stmt = insert_(FacturaResumenCliente).from_select(["cliente_id", "estatus", "cantidad"], por_cliente)
+    db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[FacturaResumenCliente.cliente_id, FacturaResumenCliente.estatus],
+            set_={"cantidad": stmt.excluded.cantidad},
+        )
+    )
+    db.execute(
+        delete(FacturaResumenCliente).where(
+            tuple_(FacturaResumenCliente.cliente_id, FacturaResumenCliente.estatus).not_in(
+                select(Factura.cliente_id, Factura.estatus).group_by(Factura.cliente_id, Factura.estatus)
+            )
+        )
+    )
+    db.commit()
+    logger.info("[INFO] Rollups de facturación reconstruidos", extra={"service": service_name})
+    return True
+
+
+def asegurar_inicializado(db: Session) -> None:
+    """Primer arranque con facturas previas: poblar los rollups una vez (una sola réplica)."""
+    if db.query(FacturaResumenDiario.fecha).first() is None and db.query(Factura.id).first() is not None:
+        reconstruir(db)
+
+
+def stats(db: Session) -> Dict[str, int]:
+    rows = dict(
+        db.execute(
+            select(FacturaResumenDiario.estatus, func.sum(FacturaResumenDiario.cantidad))
+            .group_by(FacturaResumenDiario.estatus)
+        ).all()
+    )
+    return {
+        "total": int(sum(v or 0 for v in rows.values())),
+        "timbradas": int(rows.get("timbrado") or 0),
+        "pendientes": int(rows.get("pendiente") or 0),
+        "canceladas": int(rows.get("cancelado") or 0),
+    }
+
+
+def kpis(db: Session, ahora: datetime | None = None) -> Dict[str, Any]:
+    ahora = ahora or datetime.utcnow()
+    mes_inicio = ahora.date().replace(day=1)
+    r = FacturaResumenDiario
+    del_mes = r.fecha >= mes_inicio
+    morosos, ingresos, emitidas = db.execute(
+        select(
+            func.coalesce(func.sum(case((r.estatus == "pendiente", r.cantidad), else_=0)), 0),
+            func.coalesce(func.sum(case(((r.estatus == "pagado") & del_mes, r.monto), else_=0)), 0),
+            func.coalesce(func.sum(case((del_mes, r.cantidad), else_=0)), 0),
+        )
+    ).one()
+    activos = db.execute(
+        select(func.count(func.distinct(FacturaResumenCliente.cliente_id))).where(
+            FacturaResumenCliente.estatus.in_(["timbrado", "pagado"]),
+            FacturaResumenCliente.cantidad > 0,
+        )
+    ).scalar()
+    return {
+        "clientes_activos": int(activos or 0),
+        "morosos": int(morosos),
+        "ingresos_mensuales": float(ingresos),
+        "facturas_emitidas": int(emitidas),
+    }
+
+
+async def reconstruir_periodicamente(intervalo: float = RESUMEN_RECONSTRUIR_SEGUNDOS) -> None:
+    def _ciclo(inicial: bool) -> None:
+        db: Session = SessionLocal()
+        try:
+            if inicial:
+                asegurar_inicializado(db)
+            else:
+                reconstruir(db)
+        finally:
+            db.close()
+
+    inicial = True
+    while True:
+        try:
+            await asyncio.to_thread(_ciclo, inicial)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("reconstrucción de rollups falló", extra={"service": service_name})
+        if intervalo <= 0:
+            return
+        inicial = False
+        await asyncio.sleep(intervalo)
@@ -0,0 +1,165 @@
+import asyncio
+import os
+import uuid as uuidlib
+from datetime import datetime, timedelta
+from typing import Iterable, List
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.orm import Session
+
+from ..db import SessionLocal
+from ..logging_conf import configure_logging
+from ..models import Factura, TimbradoPendiente
+from . import resumen_service
+
+
+service_name = os.getenv("SERVICE_NAME", "facturacion")
+logger = configure_logging(service_name)
+
+TIMBRADO_WORKERS = int(os.getenv("TIMBRADO_WORKERS", "2"))
+TIMBRADO_BATCH = int(os.getenv("TIMBRADO_BATCH", "100"))
+TIMBRADO_POLL_SEGUNDOS = float(os.getenv("TIMBRADO_POLL_SEGUNDOS", "1.0"))
+TIMBRADO_MAX_INTENTOS = int(os.getenv("TIMBRADO_MAX_INTENTOS", "5"))
+TIMBRADO_BACKOFF_SEGUNDOS = float(os.getenv("TIMBRADO_BACKOFF_SEGUNDOS", "2.0"))
+TIMBRADO_BACKOFF_MAX_SEGUNDOS = float(os.getenv("TIMBRADO_BACKOFF_MAX_SEGUNDOS", "300"))
+
+
+def timbrar_emulado(xml: str) -> str:
+    # In emulated mode, immediately return timbre UUID
+    return str(uuidlib.uuid4())
+
+
+def encolar_timbrado(db: Session, factura_ids: Iterable[int]) -> int:
+    """Encola facturas para timbrado dentro de la transacción del llamador."""
+    filas = [{"factura_id": fid} for fid in factura_ids]
+    if filas:
+        db.execute(insert(TimbradoPendiente), filas)
+    return len(filas)
+
+
+def _backoff(intentos: int) -> timedelta:
+    segundos = min(TIMBRADO_BACKOFF_SEGUNDOS * (2 ** (intentos - 1)), TIMBRADO_BACKOFF_MAX_SEGUNDOS)
+    return timedelta(seconds=segundos)
+
+
+def procesar_lote_timbrado(limite: int = TIMBRADO_BATCH) -> int:
+    """
+    Reclama hasta `limite` entradas vencidas de la cola (FOR UPDATE SKIP LOCKED),
+    timbra las facturas y confirma todo en una sola transacción.
+    Varias réplicas pueden drenar la cola a la vez sin pisarse.
+    Retorna el número de entradas reclamadas.
+    """
+    db: Session = SessionLocal()
+    try:
+        ahora = datetime.utcnow()
+        entradas: List[TimbradoPendiente] = list(
+            db.execute(
+                select(TimbradoPendiente)
+                .where(
+                    TimbradoPendiente.estatus == "pendiente",
+                    TimbradoPendiente.proximo_intento <= ahora,
+                )
+                .order_by(TimbradoPendiente.proximo_intento)
+                .limit(limite)
+                .with_for_update(skip_locked=True)
+            ).scalars()
+        )
+        if not entradas:
+            db.rollback()
+            return 0
+
+        facturas = {
+            fac.id: fac
+            for fac in db.execute(
+                select(Factura.id, Factura.uuid).where(
+                    Factura.id.in_([e.factura_id for e in entradas])
+                )
+            )
+        }
+        timbradas: List[int] = []
+        for entrada in entradas:
+            fac = facturas.get(entrada.factura_id)
+            if fac is None:
+                # La factura ya no existe: nada que timbrar
+                timbradas.append(entrada.factura_id)
+                continue
+            try:
+                timbrar_emulado(f"xml-{fac.uuid}")
+                timbradas.append(entrada.factura_id)
+            except Exception as exc:  # noqa: BLE001 - se reintenta con backoff
+                entrada.intentos += 1
+                entrada.ultimo_error = str(exc)[:255]
+                if entrada.intentos >= TIMBRADO_MAX_INTENTOS:
+                    entrada.estatus = "fallido"
+                    logger.error(
+                        "Timbrado agotó reintentos",
+                        extra={"service": service_name, "cid": fac.uuid},
+                    )
+                else:
+                    entrada.proximo_intento = ahora + _backoff(entrada.intentos)
+
+        if timbradas:
+            cambiadas = db.execute(
+                update(Factura)
+                .where(Factura.id.in_(timbradas), Factura.estatus == "pendiente")
+                .values(estatus="timbrado")
+                .returning(Factura.creado_en, Factura.cliente_id, Factura.total)
+            ).all()
+            resumen_service.registrar(
+                db,
+                (
+                    d
+                    for f in cambiadas
+                    for d in resumen_service.cambio(f.creado_en, f.cliente_id, f.total, "pendiente", "timbrado")
+                ),
+            )
+            db.execute(delete(TimbradoPendiente).where(TimbradoPendiente.factura_id.in_(timbradas)))
+        db.commit()
+        logger.info(
+            f"[INFO] Timbrado: {len(timbradas)}/{len(entradas)} facturas",
+            extra={"service": service_name},
+        )
+        return len(entradas)
+    finally:
+        db.close()
+
+
+class TimbradoWorkerPool:
+    """Pool de workers asyncio que drenan la cola de timbrado en hilos aparte."""
+
+    def __init__(
+        self,
+        workers: int = TIMBRADO_WORKERS,
+        batch: int = TIMBRADO_BATCH,
+        poll_segundos: float = TIMBRADO_POLL_SEGUNDOS,
+    ) -> None:
+        self.workers = workers
+        self.batch = batch
+        self.poll_segundos = poll_segundos
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        for n in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._run(n)))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def _run(self, n: int) -> None:
+        while True:
+            try:
+                reclamadas = await asyncio.to_thread(procesar_lote_timbrado, self.batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("worker de timbrado falló", extra={"service": service_name})
+                reclamadas = 0
+            # Lote completo: probablemente queda trabajo, seguir sin dormir
+            if reclamadas < self.batch:
+                await asyncio.sleep(self.poll_segundos)
+
+
+timbrado_pool = TimbradoWorkerPool()
@@ -0,0 +1,152 @@
+"""
+Almacenamiento de CFDI y contratos en S3/MinIO.
+
+Un único cliente boto3 por proceso (es thread-safe) con pool de conexiones
+dimensionado para las subidas concurrentes, y un executor compartido para
+subir muchos objetos en paralelo. Si S3 no está disponible se cae a disco
+local, igual que antes.
+"""
+import io
+import os
+import tarfile
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Sequence, Tuple
+
+# Optional deps for local testing: boto3
+try:
+    import boto3  # type: ignore
+    from boto3.s3.transfer import TransferConfig  # type: ignore
+    from botocore.config import Config  # type: ignore
+except Exception:  # pragma: no cover - tolerate missing boto3 in unit envs
+    boto3 = None
+
+
+# Subidas simultáneas a S3/MinIO (acotado para no saturar el pool)
+UPLOAD_CONCURRENCY = int(os.getenv("FACTURACION_UPLOAD_CONCURRENCY", "16"))
+S3_POOL_CONNECTIONS = int(os.getenv("FACTURACION_S3_POOL", str(max(UPLOAD_CONCURRENCY, 10))))
+# "zip" o "tar": un solo objeto por lote en lugar de un XML por factura
+EMPAQUETADO = os.getenv("FACTURACION_S3_EMPAQUETADO", "").lower()
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+
+# (key, contenido, content-type); el contenido puede ser una vista (memoryview)
+Objeto = Tuple[str, bytes | memoryview, str]
+
+_client = None
+_client_lock = threading.Lock()
+_executor: ThreadPoolExecutor | None = None
+_executor_lock = threading.Lock()
+
+
+def bucket() -> str:
+    return os.getenv("S3_BUCKET") or os.getenv("MINIO_BUCKET", "cfdi")
+
+
+class _Dummy:
+    # Return a dummy object to trigger local fallback paths
+    def create_bucket(self, *a, **k):
+        raise RuntimeError("boto3 not available")
+
+    def put_object(self, *a, **k):
+        raise RuntimeError("boto3 not available")
+
+    def upload_fileobj(self, *a, **k):
+        raise RuntimeError("boto3 not available")
+
+
+def get_s3_client():
+    """Cliente S3 del proceso, creado una sola vez."""
+    global _client
+    if _client is not None:
+        return _client
+    with _client_lock:
+        if _client is None:
+            if boto3 is None:
+                _client = _Dummy()
+            else:
+                endpoint = os.getenv("S3_ENDPOINT") or os.getenv("MINIO_ENDPOINT", "http://minio:9000")
+                access = os.getenv("S3_ACCESS_KEY") or os.getenv("MINIO_ACCESS_KEY", "minioadmin")
+                secret = os.getenv("S3_SECRET_KEY") or os.getenv("MINIO_SECRET_KEY", "minioadmin")
+                _client = boto3.client(
+                    "s3",
+                    endpoint_url=endpoint,
+                    aws_access_key_id=access,
+                    aws_secret_access_key=secret,
+                    region_name="us-east-1",
+                    config=Config(
+                        max_pool_connections=S3_POOL_CONNECTIONS,
+                        tcp_keepalive=True,
+                        retries={"max_attempts": 3, "mode": "standard"},
+                    ),
+                )
+    return _client
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY, thread_name_prefix="s3-upload")
+    return _executor
+
+
+def subir_objeto(key: str, body: bytes | memoryview, content_type: str, fallback_dir: str = "/tmp/cfdi") -> str:
+    """Sube un objeto; los grandes van en multipart. Retorna s3:// o file:// (fallback dev)."""
+    if isinstance(body, memoryview):
+        # botocore solo acepta bytes/bytearray o file-like como Body
+        body = body.tobytes()
+    try:
+        s3 = get_s3_client()
+        if len(body) >= MULTIPART_THRESHOLD:
+            s3.upload_fileobj(
+                io.BytesIO(body),
+                bucket(),
+                key,
+                ExtraArgs={"ContentType": content_type},
+                Config=TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, max_concurrency=4),
+            )
+        else:
+            s3.put_object(Bucket=bucket(), Key=key, Body=body, ContentType=content_type)
+        return f"s3://{bucket()}/{key}"
+    except Exception:
+        # Dev fallback: write to local path
+        path = os.path.join(fallback_dir, os.path.basename(key))
+        os.makedirs(fallback_dir, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(body)
+        return f"file://{path}"
+
+
+def subir_objetos(objetos: Sequence[Objeto]) -> List[str]:
+    """Sube varios objetos en paralelo con el executor compartido; conserva el orden."""
+    if len(objetos) == 1:
+        return [subir_objeto(*objetos[0])]
+    futuros = [_get_executor().submit(subir_objeto, *obj) for obj in objetos]
+    return [f.result() for f in futuros]
+
+
+def empaquetar(nombre: str, objetos: Sequence[Objeto], formato: str = EMPAQUETADO) -> str:
+    """
+    Empaqueta los objetos de un lote en un único zip/tar y lo sube como
+    `lotes/<nombre>.<formato>`. Retorna la key del paquete; cada miembro
+    conserva su key original como nombre dentro del paquete.
+    """
+    buf = io.BytesIO()
+    if formato == "tar":
+        with tarfile.open(fileobj=buf, mode="w") as tar:
+            for key, body, _ in objetos:
+                info = tarfile.TarInfo(name=key)
+                info.size = len(body)
+                tar.addfile(info, io.BytesIO(body))
+        content_type = "application/x-tar"
+    else:
+        formato = "zip"
+        with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for key, body, _ in objetos:
+                zf.writestr(key, body)
+        content_type = "application/zip"
+    paquete = f"lotes/{nombre}.{formato}"
+    subir_objeto(paquete, buf.getvalue(), content_type, fallback_dir="/tmp/cfdi/lotes")
+    return paquete
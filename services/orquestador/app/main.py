@@ -1,11 +1,14 @@
 import os
 import json
+import asyncio
+import time
 from datetime import datetime
 from typing import Any
-from fastapi import FastAPI, HTTPException, Request
+from uuid import uuid4
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
-import httpx
 from opentelemetry import trace
 from opentelemetry.sdk.resources import SERVICE_NAME, Resource
 from opentelemetry.sdk.trace import TracerProvider
@@ -22,6 +25,10 @@ except Exception:  # pragma: no cover
             return None
 from .logging_conf import configure_logging
 from .proxy_router import router as proxy_router
+from . import router_lote
+from .router_status import ROUTER_SNAPSHOT_SEGUNDOS, crear_almacen
+from .sagas import AlmacenSagas, DefinicionSaga, ErrorPaso, MotorSagas, Paso, SagaFallida, purgar_periodicamente
+from .upstreams import registro_clientes
 from pydantic import BaseModel, Field, field_validator
 
 
@@ -42,7 +49,6 @@ def setup_tracing():
 
 
 app = FastAPI(title="Orquestador", version="0.1.0")
-app.include_router(proxy_router)
 
 # Enable permissive CORS for dev/E2E usage
 app.add_middleware(
@@ -56,7 +62,31 @@ app.add_middleware(
 
 @app.on_event("startup")
 async def on_startup():
+    global motor_sagas
     setup_tracing()
+    motor_sagas = MotorSagas(AlmacenSagas(), [SAGA_ALTA_CLIENTE, SAGA_PROCESAR_PAGO])
+    # Sagas interrumpidas por un reinicio: continuar o terminar de compensar
+    asyncio.create_task(motor_sagas.reanudar())
+    asyncio.create_task(purgar_periodicamente(motor_sagas.almacen))
+    asyncio.create_task(_mantener_routers())
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await registro_clientes.cerrar()
+    if motor_sagas is not None:
+        motor_sagas.almacen.cerrar()
+    # Último snapshot antes de salir
+    await asyncio.to_thread(router_status_store.mantener)
+
+
+async def _mantener_routers():
+    while True:
+        await asyncio.sleep(ROUTER_SNAPSHOT_SEGUNDOS)
+        try:
+            await asyncio.to_thread(router_status_store.mantener)
+        except Exception:
+            logger.exception("mantenimiento de router status falló", extra={"service": service_name})
 
 
 @app.middleware("http")
@@ -91,20 +121,16 @@ class RouterStatusIn(BaseModel):
         return value
 
 
-router_status_cache: dict[str, dict[str, Any]] = {}
+router_status_store = crear_almacen()
 
 
 @app.post("/router/status")
-async def router_status(payload: RouterStatusIn):
-    now = datetime.utcnow().isoformat()
-    router_status_cache[payload.router_id] = {
-        "router_id": payload.router_id,
-        "cliente_id": payload.cliente_id,
-        "estado": payload.estado,
-        "velocidad_mbps": payload.velocidad_mbps,
-        "timestamp": now,
-    }
-    logger.info(
+def router_status(payload: RouterStatusIn):
+    ts = time.time()
+    now = datetime.utcfromtimestamp(ts).isoformat()
+    router_status_store.actualizar(payload.router_id, payload.cliente_id, payload.estado, payload.velocidad_mbps, ts)
+    # Cada CPE reporta cada ~10s: a INFO esto inunda los logs
+    logger.debug(
         "router status update",
         extra={
             "service": service_name,
@@ -119,9 +145,58 @@ async def router_status(payload: RouterStatusIn):
     return response
 
 
+def _ingerir_lote(raw: bytes, content_type: str) -> dict[str, Any]:
+    filas, errores, recibidos = router_lote.parsear(raw, content_type)
+    router_status_store.actualizar_lote(filas, time.time())
+    logger.debug(
+        "router status lote",
+        extra={"service": service_name, "recibidos": recibidos, "aceptados": len(filas)},
+    )
+    return router_lote.resumen(filas, errores, recibidos)
+
+
+@app.post("/router/status/lote")
+async def router_status_lote(request: Request):
+    """Reportes de muchos routers en un request (NDJSON o binario, ver router_lote)."""
+    demasiado = HTTPException(status_code=413, detail=f"lote mayor a {router_lote.LOTE_MAX_BYTES} bytes")
+    # Rechazar antes de leer el cuerpo; sin Content-Length (chunked) se corta al pasar el límite
+    largo = request.headers.get("content-length")
+    if largo and largo.isdigit() and int(largo) > router_lote.LOTE_MAX_BYTES:
+        raise demasiado
+    partes, leidos = [], 0
+    async for parte in request.stream():
+        leidos += len(parte)
+        if leidos > router_lote.LOTE_MAX_BYTES:
+            raise demasiado
+        partes.append(parte)
+    raw = b"".join(partes)
+    try:
+        return await run_in_threadpool(_ingerir_lote, raw, request.headers.get("content-type", ""))
+    except router_lote.LoteInvalido as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.websocket("/router/status/ws")
+async def router_status_ws(ws: WebSocket):
+    """Intake continuo: cada mensaje es un lote (texto NDJSON o binario) y se responde con su resumen."""
+    await ws.accept()
+    try:
+        while True:
+            msg = await ws.receive()
+            if msg["type"] == "websocket.disconnect":
+                break
+            raw = msg.get("bytes") or (msg.get("text") or "").encode("utf-8")
+            try:
+                await ws.send_json(await run_in_threadpool(_ingerir_lote, raw, ""))
+            except router_lote.LoteInvalido as e:
+                await ws.send_json({"error": str(e)})
+    except WebSocketDisconnect:
+        pass
+
+
 @app.get("/router/status/{router_id}")
 def obtener_router_status(router_id: str):
-    data = router_status_cache.get(router_id)
+    data = router_status_store.obtener(router_id)
     if not data:
         raise HTTPException(status_code=404, detail="No encontrado")
     return data
@@ -148,22 +223,21 @@ async def reenviar_notificacion(payload: NotificacionIn):
     canal = payload.canal
     delivered = False
     if canal == "whatsapp":
-        wa_url = os.getenv("WHATSAPP_URL", "http://whatsapp:8011")
         template = payload.metadata.get("template", "notificacion_generica")
         vars_payload = payload.metadata.get("vars") or {"mensaje": payload.mensaje}
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            try:
-                await client.post(
-                    f"{wa_url}/send-template",
-                    json={
-                        "to": payload.destino or "",
-                        "template": template,
-                        "vars": vars_payload,
-                    },
-                )
-                delivered = True
-            except Exception:
-                delivered = False
+        try:
+            await registro_clientes.cliente("whatsapp").post(
+                "/send-template",
+                json={
+                    "to": payload.destino or "",
+                    "template": template,
+                    "vars": vars_payload,
+                },
+                timeout=5.0,
+            )
+            delivered = True
+        except Exception:
+            delivered = False
     else:
         delivered = True  # portal notifications are handled in-app
     logger.info(
@@ -178,62 +252,129 @@ async def reenviar_notificacion(payload: NotificacionIn):
     return {"status": "ok", "canal": canal, "entregado": delivered}
 
 
+def _verificar(r, servicio: str) -> None:
+    # 5xx se reintenta; 4xx es definitivo
+    if r.status_code >= 500:
+        raise RuntimeError(f"error {servicio}: {r.text}")
+    if r.status_code >= 400:
+        raise ErrorPaso(f"error {servicio}: {r.text}")
+
+
+def _idem(ctx: dict) -> str:
+    # Sin llave del llamador se usa el id de la saga, así los reintentos no duplican
+    return ctx["entrada"].get("idem") or ctx["saga_id"]
+
+
+async def _crear_cliente(ctx: dict):
+    r = await registro_clientes.cliente("clientes").post(
+        "/clientes", json=ctx["entrada"], headers={"Idempotency-Key": _idem(ctx)}
+    )
+    _verificar(r, "clientes")
+    return r.json()
+
+
+async def _inactivar_cliente(ctx: dict):
+    r = await registro_clientes.cliente("clientes").post(f"/clientes/{ctx['cliente']['id']}/inactivar")
+    if r.status_code >= 500:
+        raise RuntimeError(f"error clientes: {r.text}")
+
+
+async def _primera_factura(ctx: dict):
+    lote = [{"cliente_id": ctx["cliente"]["id"], "total": 299.0}]
+    r = await registro_clientes.cliente("facturacion").post(
+        "/facturacion/generar-masiva", json=lote, headers={"Idempotency-Key": _idem(ctx)}
+    )
+    _verificar(r, "facturacion")
+    return r.json()
+
+
+async def _procesar_pago(ctx: dict):
+    r = await registro_clientes.cliente("pagos").post(
+        "/pagos/procesar", json=ctx["entrada"], headers={"Idempotency-Key": _idem(ctx)}
+    )
+    _verificar(r, "pagos")
+    return r.json()
+
+
+async def _notificar_pago(ctx: dict):
+    # Send WhatsApp notification (emulado)
+    r = await registro_clientes.cliente("whatsapp").post("/send-template", json={
+        "to": ctx["entrada"].get("to", "0000000000"),
+        "template": "pago_confirmado",
+        "vars": {"referencia": ctx["pago"].get("referencia")}
+    })
+    _verificar(r, "whatsapp")
+    return True
+
+
+def _cliente_id(body: dict):
+    try:
+        return int(body.get("cliente_id")) if body.get("cliente_id") is not None else None
+    except Exception:
+        return None
+
+
+async def _reconectar(ctx: dict):
+    # Reconectar tras pago conciliado (emulado)
+    cli_id = _cliente_id(ctx["entrada"])
+    if not cli_id:
+        return False
+    r = await registro_clientes.cliente("red").post("/router/reconectar", json={"cliente_id": cli_id})
+    _verificar(r, "red")
+    return True
+
+
+# Steps: cliente -> facturacion (1er factura); si la factura falla se inactiva el cliente
+SAGA_ALTA_CLIENTE = DefinicionSaga("alta-cliente", [
+    Paso("cliente", _crear_cliente, compensacion=_inactivar_cliente, reintentos=2),
+    Paso("factura", _primera_factura, depende=("cliente",)),
+])
+
+# Notificación y reconexión solo dependen del pago: corren en paralelo y no lo revierten
+SAGA_PROCESAR_PAGO = DefinicionSaga("procesar-pago", [
+    Paso("pago", _procesar_pago, reintentos=2),
+    Paso("notificacion", _notificar_pago, depende=("pago",), timeout=5.0, reintentos=1, critico=False),
+    Paso("reconexion", _reconectar, depende=("pago",), reintentos=2, critico=False),
+])
+
+motor_sagas: MotorSagas | None = None
+
+
 @app.post("/saga/alta-cliente")
-async def saga_alta_cliente(body: dict):
-    # Steps: cliente -> facturacion (1er factura) -> notificación
-    clientes = os.getenv("CLIENTES_URL", "http://clientes:8000")
-    fact = os.getenv("FACTURACION_URL", "http://facturacion:8002")
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        # Create client
-        r = await client.post(f"{clientes}/clientes", json=body, headers={"Idempotency-Key": body.get("idem", "")})
-        if r.status_code >= 400:
-            raise HTTPException(status_code=400, detail=f"error clientes: {r.text}")
-        cli = r.json()
-        # Generate first invoice
-        lote = [{"cliente_id": cli["id"], "total": 299.0}]
-        r2 = await client.post(f"{fact}/facturacion/generar-masiva", json=lote)
-        if r2.status_code >= 400:
-            # compensate: mark client inactive
-            try:
-                await client.post(f"{clientes}/clientes/{cli['id']}/inactivar")
-            finally:
-                raise HTTPException(status_code=400, detail=f"error facturacion: {r2.text}")
-        return {"cliente": cli, "facturas": r2.json()}
+async def saga_alta_cliente(body: dict, response: Response):
+    res = await _ejecutar_saga("alta-cliente", body, response)
+    return {"cliente": res["cliente"], "facturas": res["factura"]}
 
 
 @app.post("/saga/procesar-pago")
-async def saga_procesar_pago(body: dict):
-    pagos = os.getenv("PAGOS_URL", "http://pagos:8003")
-    fact = os.getenv("FACTURACION_URL", "http://facturacion:8002")
-    wa_url = os.getenv("WHATSAPP_URL", "http://whatsapp:8011")
-    red_url = os.getenv("RED_URL", "http://red:8020")
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        # Process payment
-        r = await client.post(f"{pagos}/pagos/procesar", json=body, headers={"Idempotency-Key": body.get("idem", "")})
-        if r.status_code >= 400:
-            raise HTTPException(status_code=400, detail=f"error pagos: {r.text}")
-        pago = r.json()
-        # In a real flow, reconcile and possibly trigger invoice payment complement
-        # Send WhatsApp notification (emulado)
-        try:
-            await client.post(f"{wa_url}/send-template", json={
-                "to": body.get("to", "0000000000"),
-                "template": "pago_confirmado",
-                "vars": {"referencia": pago.get("referencia")}
-            })
-        except Exception:
-            pass
-        # Reconectar tras pago conciliado (emulado)
-        try:
-            cli_id = int(body.get("cliente_id")) if body.get("cliente_id") is not None else None
-        except Exception:
-            cli_id = None
-        if cli_id:
-            try:
-                await client.post(f"{red_url}/router/reconectar", json={"cliente_id": cli_id})
-            except Exception:
-                pass
-        return {"pago": pago, "conciliado": True, "notificado": True, "reconectado": bool(cli_id)}
+async def saga_procesar_pago(body: dict, response: Response):
+    res = await _ejecutar_saga("procesar-pago", body, response)
+    # Pasos no críticos: None si fallaron (el detalle queda en GET /saga/{id})
+    return {
+        "pago": res["pago"],
+        "conciliado": True,
+        "notificado": res["notificacion"] is True,
+        "reconectado": res["reconexion"] is True,
+    }
+
+
+@app.get("/saga/{saga_id}")
+async def obtener_saga(saga_id: str):
+    saga = await asyncio.to_thread(motor_sagas.almacen.obtener, saga_id)
+    if saga is None:
+        raise HTTPException(status_code=404, detail="saga no encontrada")
+    return saga
+
+
+async def _ejecutar_saga(tipo: str, body: dict, response: Response) -> dict:
+    saga_id = str(uuid4())
+    response.headers["X-Saga-Id"] = saga_id
+    try:
+        return await motor_sagas.ejecutar(tipo, body, saga_id=saga_id)
+    except SagaFallida as e:
+        raise HTTPException(status_code=400, detail=e.detalle, headers={"X-Saga-Id": saga_id})
+# El proxy /router/{path} va al final para no tapar /router/status
+app.include_router(proxy_router)
 
 # expose metrics at import time
 Instrumentator().instrument(app).expose(app)
@@ -1,12 +1,20 @@
 # services/orquestador/app/proxy_router.py
-from fastapi import APIRouter, Request, Response
 import os
+import time
+
 import httpx
+from fastapi import APIRouter, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+
+from .upstreams import observar_latencia, registro_clientes
 
 router = APIRouter()
 
-# URL del servicio RED dentro de la red de Docker
-RED_URL = os.getenv("RED_URL", "http://red:8020")
+# Streaming (default): los cuerpos pasan por chunks sin acumularse en memoria.
+# ORQ_PROXY_STREAMING=0 regresa al modo que lee todo antes de responder.
+PROXY_STREAMING = os.getenv("ORQ_PROXY_STREAMING", "1") == "1"
+PROXY_TIMEOUT = float(os.getenv("ORQ_PROXY_TIMEOUT_SEGUNDOS", "20"))
 
 
 def _filter_request_headers(headers):
@@ -40,24 +48,75 @@ def _filter_response_headers(headers):
     return out
 
 
+def _filter_streaming_headers(headers):
+    # Se reenvían los bytes tal cual llegan (aiter_raw), así que content-encoding
+    # y content-length siguen siendo válidos; solo se quitan los hop-by-hop
+    out = {}
+    for k, v in headers.items():
+        if k.lower() in ("transfer-encoding", "connection", "keep-alive"):
+            continue
+        out[k] = v
+    return out
+
+
+def _tiene_cuerpo(request: Request) -> bool:
+    h = request.headers
+    return "transfer-encoding" in h or h.get("content-length", "0") not in ("", "0")
+
+
+async def _cuerpo(resp: httpx.Response, inicio: float):
+    try:
+        async for chunk in resp.aiter_raw():
+            yield chunk
+    finally:
+        await resp.aclose()
+        observar_latencia("red", "total", inicio)
+
+
 @router.api_route("/router/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"])
 async def proxy_router(path: str, request: Request):
     """
-    Proxy transparente que reenvía cualquier /router/* al servicio RED definido en RED_URL.
+    Proxy transparente que reenvía cualquier /router/* al servicio RED definido en RED_URL,
+    reutilizando las conexiones keep-alive del pool de `red`.
     Mantiene query params, body y la mayoría de headers útiles.
+
+    En modo streaming el body de entrada se lee del cliente conforme el upstream
+    lo consume y la respuesta se escribe chunk por chunk: si el cliente lee
+    lento, el proxy deja de leer del upstream (backpressure) en vez de acumular.
     """
-    target = f"{RED_URL}/router/{path}"
-    body = await request.body()
+    client = registro_clientes.cliente("red")
     headers = _filter_request_headers(dict(request.headers))
-
-    async with httpx.AsyncClient(timeout=20.0) as client:
+    if not PROXY_STREAMING:
+        body = await request.body()
         resp = await client.request(
             request.method,
-            target,
+            f"/router/{path}",
             content=body if body is not None and len(body) > 0 else None,
             params=dict(request.query_params),
             headers=headers,
+            timeout=PROXY_TIMEOUT,
         )
+        response_headers = _filter_response_headers(resp.headers)
+        return Response(content=resp.content, status_code=resp.status_code, headers=response_headers)
 
-    response_headers = _filter_response_headers(resp.headers)
-    return Response(content=resp.content, status_code=resp.status_code, headers=response_headers)
+    inicio = time.perf_counter()
+    upstream_req = client.build_request(
+        request.method,
+        f"/router/{path}",
+        content=request.stream() if _tiene_cuerpo(request) else None,
+        params=dict(request.query_params),
+        headers=headers,
+        timeout=PROXY_TIMEOUT,
+    )
+    try:
+        resp = await client.send(upstream_req, stream=True)
+    except httpx.TransportError as e:
+        observar_latencia("red", "total", inicio)
+        return JSONResponse(status_code=502, content={"detail": f"red no disponible: {type(e).__name__}"})
+    # aclose también como tarea de fondo por si el cliente corta antes del primer chunk
+    return StreamingResponse(
+        _cuerpo(resp, inicio),
+        status_code=resp.status_code,
+        headers=_filter_streaming_headers(resp.headers),
+        background=BackgroundTask(resp.aclose),
+    )
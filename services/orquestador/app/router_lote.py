@@ -0,0 +1,163 @@
+"""
+Ingesta en lote de telemetría de routers, para proxies agregadores.
+
+Formatos aceptados por `POST /router/status/lote` y por el websocket
+`/router/status/ws`:
+
+- NDJSON: una línea por router con los campos de RouterStatusIn. Todo el
+  lote se valida con una sola llamada de pydantic-core sobre un arreglo JSON
+  (TypedDict con restricciones declarativas, sin validadores en Python); solo
+  si hay errores se identifican las líneas culpables por su índice. Si el
+  índice no corresponde a una línea (JSON roto, varios objetos en una línea)
+  se valida línea por línea. Los errores citan el número de línea física.
+- Binario (`application/vnd.telecable.router-status`): cabecera `RTS1` y
+  registros `!B{n}sIBH` = largo del router_id, router_id UTF-8, cliente_id,
+  código de estado (índice en ESTADOS) y velocidad_mbps. Ver `codificar_binario`.
+
+Las líneas inválidas no tumban el lote: se reportan (hasta LOTE_MAX_ERRORES) y
+el resto se aplica con `actualizar_lote`.
+"""
+import os
+import struct
+from typing import Any, Dict, List, Literal, Tuple
+
+from pydantic import Field, TypeAdapter, ValidationError
+from typing_extensions import Annotated, TypedDict
+
+from .router_status import ESTADOS, Fila, CODIGOS
+
+LOTE_MAX_BYTES = int(os.getenv("ORQ_ROUTER_LOTE_MAX_BYTES", str(8 * 1024 * 1024)))
+LOTE_MAX_ERRORES = int(os.getenv("ORQ_ROUTER_LOTE_MAX_ERRORES", "100"))
+
+MAGIC = b"RTS1"
+CONTENT_TYPE_BINARIO = "application/vnd.telecable.router-status"
+_CABECERA = struct.Struct("!B")
+_CAMPOS = struct.Struct("!IBH")
+_VELOCIDAD_MAX = 3000
+
+
+class LoteInvalido(ValueError):
+    pass
+
+
+class RouterStatusLinea(TypedDict):
+    router_id: Annotated[str, Field(min_length=1)]
+    cliente_id: Annotated[int, Field(ge=1)]
+    estado: Literal["online", "offline", "instalando"]
+    velocidad_mbps: Annotated[int, Field(ge=0, le=_VELOCIDAD_MAX)]
+
+
+_LINEAS = TypeAdapter(List[RouterStatusLinea])
+_LINEA = TypeAdapter(RouterStatusLinea)
+
+Errores = List[Dict[str, Any]]
+
+
+def _fila(d: RouterStatusLinea) -> Fila:
+    return (d["router_id"], d["cliente_id"], CODIGOS[d["estado"]], d["velocidad_mbps"])
+
+
+def _por_linea(numeradas: List[Tuple[int, bytes]]) -> Tuple[List[Fila], Errores]:
+    filas: List[Fila] = []
+    errores: Errores = []
+    for numero, linea in numeradas:
+        try:
+            filas.append(_fila(_LINEA.validate_json(linea)))
+        except ValidationError as e:
+            if len(errores) < LOTE_MAX_ERRORES:
+                err = e.errors()[0]
+                errores.append({"linea": numero, "error": err["msg"], "campo": ".".join(str(x) for x in err["loc"])})
+    return filas, errores
+
+
+def _por_indice(numeradas: List[Tuple[int, bytes]], malas: set) -> Tuple[List[Fila], Errores] | None:
+    """
+    Aplica los índices de error del arreglo: revalida el resto en un llamado y
+    solo las líneas marcadas una por una. Retorna None si los índices no
+    corresponden a líneas (una línea con varios objetos, p. ej. `{..},{..}`).
+    """
+    buenas = [l for i, (_, l) in enumerate(numeradas) if i not in malas]
+    try:
+        datos = _LINEAS.validate_json(b"[" + b",".join(buenas) + b"]")
+    except ValidationError:
+        return None
+    if len(datos) != len(buenas):
+        return None
+    validas, errores = _por_linea([numeradas[i] for i in sorted(malas)])
+    if validas:
+        # Una línea marcada es válida sola: los índices estaban corridos
+        return None
+    return [_fila(d) for d in datos], errores
+
+
+def parsear_ndjson(raw: bytes) -> Tuple[List[Fila], Errores, int]:
+    """Retorna (filas válidas, errores por línea física, líneas recibidas)."""
+    numeradas = [(n, l) for n, l in enumerate(raw.split(b"\n"), 1) if l.strip()]
+    lineas = [l for _, l in numeradas]
+    try:
+        datos = _LINEAS.validate_json(b"[" + b",".join(lineas) + b"]")
+        if len(datos) == len(lineas):
+            return [_fila(d) for d in datos], [], len(lineas)
+    except ValidationError as e:
+        errs = e.errors()
+        if all(err["type"] != "json_invalid" and err["loc"] and isinstance(err["loc"][0], int) for err in errs):
+            malas = {err["loc"][0] for err in errs}
+            if max(malas) < len(lineas):
+                resultado = _por_indice(numeradas, malas)
+                if resultado is not None:
+                    return resultado[0], resultado[1], len(lineas)
+    # JSON roto o índices que no corresponden a líneas: se valida línea por línea
+    filas, errores = _por_linea(numeradas)
+    return filas, errores, len(lineas)
+
+
+def parsear_binario(raw: bytes) -> Tuple[List[Fila], Errores, int]:
+    if not raw.startswith(MAGIC):
+        raise LoteInvalido("cabecera binaria inválida")
+    filas: List[Fila] = []
+    errores: Errores = []
+    pos, n, fin = len(MAGIC), 0, len(raw)
+    while pos < fin:
+        n += 1
+        try:
+            (largo,) = _CABECERA.unpack_from(raw, pos)
+            router_id = raw[pos + 1 : pos + 1 + largo].decode("utf-8")
+            cliente_id, estado, velocidad = _CAMPOS.unpack_from(raw, pos + 1 + largo)
+        except (struct.error, UnicodeDecodeError):
+            # Un registro truncado o corrupto desalinea el resto del buffer
+            raise LoteInvalido(f"registro {n} truncado o corrupto")
+        pos += 1 + largo + _CAMPOS.size
+        if not router_id or cliente_id < 1 or estado >= len(ESTADOS) or velocidad > _VELOCIDAD_MAX:
+            if len(errores) < LOTE_MAX_ERRORES:
+                errores.append({"linea": n, "error": "valor fuera de rango"})
+            continue
+        filas.append((router_id, cliente_id, estado, velocidad))
+    return filas, errores, n
+
+
+def codificar_binario(items: List[Dict[str, Any]]) -> bytes:
+    """Codifica dicts con los campos de RouterStatusIn al formato binario."""
+    partes = [MAGIC]
+    for d in items:
+        rid = d["router_id"].encode("utf-8")
+        partes.append(_CABECERA.pack(len(rid)) + rid + _CAMPOS.pack(d["cliente_id"], CODIGOS[d["estado"]], d["velocidad_mbps"]))
+    return b"".join(partes)
+
+
+def parsear(raw: bytes, content_type: str = "") -> Tuple[List[Fila], Errores, int]:
+    if len(raw) > LOTE_MAX_BYTES:
+        raise LoteInvalido(f"lote mayor a {LOTE_MAX_BYTES} bytes")
+    if CONTENT_TYPE_BINARIO in content_type or raw.startswith(MAGIC):
+        return parsear_binario(raw)
+    return parsear_ndjson(raw)
+
+
+def resumen(filas: List[Fila], errores: Errores, recibidos: int) -> Dict[str, Any]:
+    offline = CODIGOS["offline"]
+    return {
+        "recibidos": recibidos,
+        "aceptados": len(filas),
+        "errores": errores,
+        # Equivale a la "accion": "reset" del endpoint individual
+        "reset": [f[0] for f in filas if f[2] == offline],
+    }
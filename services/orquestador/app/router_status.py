@@ -0,0 +1,246 @@
+"""
+Último estado reportado por cada router (CPE), con memoria acotada.
+
+Backends (`ORQ_ROUTER_BACKEND`):
+- "local" (default): en proceso, repartido en shards con su propio lock para
+  que los reportes concurrentes no compitan por uno solo. Cada router ocupa un
+  `RegistroRouter` con __slots__ (el estado va como código entero). Los shards
+  son OrderedDict en orden de último reporte: los routers callados más de
+  `ORQ_ROUTER_TTL_SEGUNDOS` se desalojan desde el frente, y si se rebasa
+  `ORQ_ROUTER_MAX` se desaloja el más antiguo.
+  Con `ORQ_ROUTER_SNAPSHOT` se guarda un snapshot en JSON lines que se recarga
+  al arrancar, así un reinicio no pierde la telemetría.
+- "redis://...": un hash por router con EXPIRE igual al TTL; compartido entre
+  workers de uvicorn y réplicas. Requiere el paquete redis.
+
+Con más de un worker usar redis: el backend local no se comparte entre procesos.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Protocol, Tuple
+
+from .logging_conf import configure_logging
+
+# Optional deps: redis para compartir el estado entre workers
+try:
+    import redis  # type: ignore
+except Exception:  # pragma: no cover - tolerate missing redis
+    redis = None
+
+
+service_name = os.getenv("SERVICE_NAME", "orquestador")
+logger = configure_logging(service_name)
+
+ROUTER_BACKEND = os.getenv("ORQ_ROUTER_BACKEND", "local")
+ROUTER_MAX = int(os.getenv("ORQ_ROUTER_MAX", "200000"))
+ROUTER_SHARDS = int(os.getenv("ORQ_ROUTER_SHARDS", "16"))
+ROUTER_TTL_SEGUNDOS = float(os.getenv("ORQ_ROUTER_TTL_SEGUNDOS", "300"))
+ROUTER_SNAPSHOT = os.getenv("ORQ_ROUTER_SNAPSHOT", "")
+ROUTER_SNAPSHOT_SEGUNDOS = float(os.getenv("ORQ_ROUTER_SNAPSHOT_SEGUNDOS", "60"))
+
+ESTADOS = ("online", "offline", "instalando")
+CODIGOS = {e: i for i, e in enumerate(ESTADOS)}
+
+# (router_id, cliente_id, código de estado, velocidad_mbps)
+Fila = Tuple[str, int, int, int]
+
+
+def _iso(ts: float) -> str:
+    return datetime.utcfromtimestamp(ts).isoformat()
+
+
+class RegistroRouter:
+    __slots__ = ("cliente_id", "estado", "velocidad_mbps", "ts")
+
+    def __init__(self, cliente_id: int, estado: int, velocidad_mbps: int, ts: float) -> None:
+        self.cliente_id = cliente_id
+        self.estado = estado
+        self.velocidad_mbps = velocidad_mbps
+        self.ts = ts
+
+    def a_dict(self, router_id: str) -> Dict[str, Any]:
+        return {
+            "router_id": router_id,
+            "cliente_id": self.cliente_id,
+            "estado": ESTADOS[self.estado],
+            "velocidad_mbps": self.velocidad_mbps,
+            "timestamp": _iso(self.ts),
+        }
+
+
+class AlmacenRouters(Protocol):
+    def actualizar(self, router_id: str, cliente_id: int, estado: str, velocidad_mbps: int, ts: float) -> None: ...
+
+    def actualizar_lote(self, filas: Iterable[Fila], ts: float) -> int: ...
+
+    def obtener(self, router_id: str) -> Optional[Dict[str, Any]]: ...
+
+    def mantener(self) -> None: ...
+
+
+class AlmacenLocal:
+    def __init__(
+        self,
+        max_routers: int = ROUTER_MAX,
+        shards: int = ROUTER_SHARDS,
+        ttl: float = ROUTER_TTL_SEGUNDOS,
+        snapshot: str = ROUTER_SNAPSHOT,
+    ) -> None:
+        self.ttl = ttl
+        self.snapshot = snapshot
+        self._max_shard = max(1, max_routers // shards)
+        self._shards: List[Tuple["OrderedDict[str, RegistroRouter]", threading.Lock]] = [
+            (OrderedDict(), threading.Lock()) for _ in range(shards)
+        ]
+
+    def _shard(self, router_id: str) -> Tuple["OrderedDict[str, RegistroRouter]", threading.Lock]:
+        return self._shards[hash(router_id) % len(self._shards)]
+
+    def actualizar(self, router_id: str, cliente_id: int, estado: str, velocidad_mbps: int, ts: float) -> None:
+        datos, lock = self._shard(router_id)
+        registro = RegistroRouter(cliente_id, CODIGOS[estado], velocidad_mbps, ts)
+        with lock:
+            # Reinsertar al final mantiene el orden por último reporte
+            datos.pop(router_id, None)
+            datos[router_id] = registro
+            self._desalojar(datos, time.time())
+
+    def actualizar_lote(self, filas: Iterable[Fila], ts: float) -> int:
+        """Aplica un lote ya validado tomando el lock de cada shard una sola vez."""
+        n = len(self._shards)
+        por_shard: List[List[Fila]] = [[] for _ in range(n)]
+        for fila in filas:
+            por_shard[hash(fila[0]) % n].append(fila)
+        ahora = time.time()
+        total = 0
+        for (datos, lock), grupo in zip(self._shards, por_shard):
+            if not grupo:
+                continue
+            with lock:
+                for router_id, cliente_id, estado, velocidad in grupo:
+                    datos.pop(router_id, None)
+                    datos[router_id] = RegistroRouter(cliente_id, estado, velocidad, ts)
+                self._desalojar(datos, ahora)
+            total += len(grupo)
+        return total
+
+    def obtener(self, router_id: str) -> Optional[Dict[str, Any]]:
+        datos, lock = self._shard(router_id)
+        with lock:
+            registro = datos.get(router_id)
+            if registro is None:
+                return None
+            if registro.ts < time.time() - self.ttl:
+                del datos[router_id]
+                return None
+            return registro.a_dict(router_id)
+
+    def _desalojar(self, datos: "OrderedDict[str, RegistroRouter]", ahora: float) -> int:
+        limite = ahora - self.ttl
+        desalojados = 0
+        while datos:
+            router_id, registro = next(iter(datos.items()))
+            if registro.ts >= limite and len(datos) <= self._max_shard:
+                break
+            del datos[router_id]
+            desalojados += 1
+        return desalojados
+
+    def mantener(self) -> None:
+        """Desaloja routers vencidos en todos los shards y guarda el snapshot."""
+        ahora = time.time()
+        desalojados = 0
+        for datos, lock in self._shards:
+            with lock:
+                desalojados += self._desalojar(datos, ahora)
+        if desalojados:
+            logger.info(f"[INFO] Routers desalojados por TTL: {desalojados}", extra={"service": service_name})
+        if self.snapshot:
+            self.guardar_snapshot()
+
+    def __len__(self) -> int:
+        return sum(len(datos) for datos, _ in self._shards)
+
+    def guardar_snapshot(self) -> int:
+        # Copia por shard bajo su lock; la escritura va fuera de los locks
+        filas: List[str] = []
+        for datos, lock in self._shards:
+            with lock:
+                items = list(datos.items())
+            filas.extend(
+                json.dumps([rid, r.cliente_id, r.estado, r.velocidad_mbps, r.ts], separators=(",", ":")) for rid, r in items
+            )
+        os.makedirs(os.path.dirname(self.snapshot) or ".", exist_ok=True)
+        tmp = f"{self.snapshot}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("\n".join(filas))
+        os.replace(tmp, self.snapshot)
+        return len(filas)
+
+    def cargar_snapshot(self) -> int:
+        if not self.snapshot or not os.path.exists(self.snapshot):
+            return 0
+        limite = time.time() - self.ttl
+        cargados = 0
+        with open(self.snapshot, encoding="utf-8") as f:
+            filas = [json.loads(linea) for linea in f if linea.strip()]
+        # En orden de reporte para que el desalojo siga siendo por antigüedad
+        for rid, cliente_id, estado, velocidad, ts in sorted(filas, key=lambda fila: fila[4]):
+            if ts < limite:
+                continue
+            datos, lock = self._shard(rid)
+            with lock:
+                datos[rid] = RegistroRouter(cliente_id, estado, velocidad, ts)
+                self._desalojar(datos, time.time())
+            cargados += 1
+        logger.info(f"[INFO] Snapshot de routers cargado: {cargados}", extra={"service": service_name})
+        return cargados
+
+
+class AlmacenRedis:
+    def __init__(self, url: str, ttl: float = ROUTER_TTL_SEGUNDOS) -> None:
+        self.ttl = int(ttl)
+        self._r = redis.Redis.from_url(url, decode_responses=True)
+
+    def actualizar(self, router_id: str, cliente_id: int, estado: str, velocidad_mbps: int, ts: float) -> None:
+        clave = f"orq:router:{router_id}"
+        pipe = self._r.pipeline(transaction=False)
+        pipe.hset(clave, mapping={"c": cliente_id, "e": CODIGOS[estado], "v": velocidad_mbps, "t": ts})
+        pipe.expire(clave, self.ttl)
+        pipe.execute()
+
+    def actualizar_lote(self, filas: Iterable[Fila], ts: float) -> int:
+        pipe = self._r.pipeline(transaction=False)
+        total = 0
+        for router_id, cliente_id, estado, velocidad in filas:
+            clave = f"orq:router:{router_id}"
+            pipe.hset(clave, mapping={"c": cliente_id, "e": estado, "v": velocidad, "t": ts})
+            pipe.expire(clave, self.ttl)
+            total += 1
+        pipe.execute()
+        return total
+
+    def obtener(self, router_id: str) -> Optional[Dict[str, Any]]:
+        h = self._r.hgetall(f"orq:router:{router_id}")
+        if not h:
+            return None
+        return RegistroRouter(int(h["c"]), int(h["e"]), int(h["v"]), float(h["t"])).a_dict(router_id)
+
+    def mantener(self) -> None:
+        # EXPIRE ya desaloja; redis persiste por su cuenta
+        return None
+
+
+def crear_almacen(backend: str = ROUTER_BACKEND) -> AlmacenRouters:
+    if backend.startswith("redis://") or backend.startswith("rediss://"):
+        if redis is None:
+            logger.warning("[WARN] ORQ_ROUTER_BACKEND=redis sin paquete redis; se usa el almacén local", extra={"service": service_name})
+        else:
+            return AlmacenRedis(backend)
+    almacen = AlmacenLocal()
+    almacen.cargar_snapshot()
+    return almacen
@@ -0,0 +1,357 @@
+"""
+Motor de sagas del orquestador.
+
+Una saga se declara como un DAG de pasos (`Paso.depende`); los pasos cuyas
+dependencias ya terminaron corren en paralelo. Cada paso tiene timeout,
+reintentos con backoff y una compensación opcional. El estado de cada
+instancia y de cada paso se guarda en sqlite (ORQ_SAGAS_DB) antes y después de
+ejecutarlo, de modo que al reiniciar el orquestador `reanudar()` continúa las
+sagas que quedaron a medias:
+
+- `en_curso`: se reintentan los pasos sin terminar y se sigue adelante. Un paso
+  que estaba corriendo durante la caída se vuelve a ejecutar, así que las
+  acciones deben ser idempotentes (los upstreams reciben Idempotency-Key).
+- `compensando`: se repiten las compensaciones pendientes, en orden inverso.
+
+Un fallo en un paso `critico` (por agotar reintentos o por `ErrorPaso`, que no
+se reintenta) compensa los pasos completados y la saga termina `compensada`.
+Un paso no crítico que falla queda `fallido` y sus dependientes siguen.
+
+El almacén es local al proceso: con varias réplicas cada una reanuda solo las
+sagas que ella misma inició. Las sagas terminadas se purgan tras
+SAGAS_RETENCION_HORAS (ver `purgar_periodicamente`).
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+from uuid import uuid4
+
+from .logging_conf import configure_logging
+
+
+service_name = os.getenv("SERVICE_NAME", "orquestador")
+logger = configure_logging(service_name)
+
+SAGAS_DB = os.getenv("ORQ_SAGAS_DB", "/app_data/sagas.db")
+SAGAS_BACKOFF_SEGUNDOS = float(os.getenv("ORQ_SAGAS_BACKOFF_SEGUNDOS", "0.5"))
+# Sagas terminadas (completada/compensada) se borran pasado este tiempo
+SAGAS_RETENCION_HORAS = float(os.getenv("ORQ_SAGAS_RETENCION_HORAS", "168"))
+SAGAS_PURGA_SEGUNDOS = float(os.getenv("ORQ_SAGAS_PURGA_SEGUNDOS", "3600"))
+
+Accion = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+class ErrorPaso(Exception):
+    """Error de negocio de un paso: no se reintenta."""
+
+
+class SagaFallida(Exception):
+    def __init__(self, saga_id: str, paso: str, detalle: str) -> None:
+        super().__init__(detalle)
+        self.saga_id = saga_id
+        self.paso = paso
+        self.detalle = detalle
+
+
+@dataclass
+class Paso:
+    nombre: str
+    accion: Accion
+    compensacion: Optional[Accion] = None
+    depende: Tuple[str, ...] = ()
+    timeout: float = 10.0
+    reintentos: int = 0
+    critico: bool = True
+
+
+@dataclass
+class DefinicionSaga:
+    tipo: str
+    pasos: List[Paso]
+    _por_nombre: Dict[str, Paso] = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        self._por_nombre = {p.nombre: p for p in self.pasos}
+        if len(self._por_nombre) != len(self.pasos):
+            raise ValueError(f"saga {self.tipo}: pasos duplicados")
+        for p in self.pasos:
+            faltan = set(p.depende) - set(self._por_nombre)
+            if faltan:
+                raise ValueError(f"saga {self.tipo}: {p.nombre} depende de pasos inexistentes {sorted(faltan)}")
+        self.orden()  # valida que no haya ciclos
+
+    def paso(self, nombre: str) -> Paso:
+        return self._por_nombre[nombre]
+
+    def orden(self) -> List[str]:
+        """Orden topológico estable (el de declaración cuando no hay restricción)."""
+        hechos: List[str] = []
+        pendientes = [p.nombre for p in self.pasos]
+        while pendientes:
+            listos = [n for n in pendientes if all(d in hechos for d in self._por_nombre[n].depende)]
+            if not listos:
+                raise ValueError(f"saga {self.tipo}: ciclo entre {pendientes}")
+            hechos.extend(listos)
+            pendientes = [n for n in pendientes if n not in listos]
+        return hechos
+
+
+class AlmacenSagas:
+    """Estado de sagas y pasos en sqlite; las llamadas se serializan con un lock."""
+
+    def __init__(self, path: str = SAGAS_DB) -> None:
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sagas (
+                id TEXT PRIMARY KEY,
+                tipo TEXT NOT NULL,
+                estado TEXT NOT NULL,
+                entrada TEXT NOT NULL,
+                error TEXT,
+                creado_en TEXT NOT NULL,
+                actualizado_en TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_sagas_estado ON sagas (estado);
+            CREATE TABLE IF NOT EXISTS saga_pasos (
+                saga_id TEXT NOT NULL,
+                nombre TEXT NOT NULL,
+                estado TEXT NOT NULL,
+                intentos INTEGER NOT NULL DEFAULT 0,
+                resultado TEXT,
+                error TEXT,
+                completado_en TEXT,
+                PRIMARY KEY (saga_id, nombre)
+            );
+            """
+        )
+
+    def _ejecutar(self, sql: str, params: Iterable[Any] = ()) -> List[sqlite3.Row]:
+        with self._lock:
+            return self._conn.execute(sql, tuple(params)).fetchall()
+
+    def crear(self, saga_id: str, tipo: str, entrada: Dict[str, Any], pasos: Iterable[str]) -> None:
+        ahora = datetime.utcnow().isoformat()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute(
+                "INSERT INTO sagas (id, tipo, estado, entrada, creado_en, actualizado_en) VALUES (?, ?, 'en_curso', ?, ?, ?)",
+                (saga_id, tipo, json.dumps(entrada), ahora, ahora),
+            )
+            self._conn.executemany(
+                "INSERT INTO saga_pasos (saga_id, nombre, estado) VALUES (?, ?, 'pendiente')",
+                [(saga_id, n) for n in pasos],
+            )
+            self._conn.execute("COMMIT")
+
+    def estado_saga(self, saga_id: str, estado: str, error: Optional[str] = None) -> None:
+        self._ejecutar(
+            "UPDATE sagas SET estado = ?, error = COALESCE(?, error), actualizado_en = ? WHERE id = ?",
+            (estado, error, datetime.utcnow().isoformat(), saga_id),
+        )
+
+    def estado_paso(
+        self, saga_id: str, nombre: str, estado: str, resultado: Any = None, error: Optional[str] = None, intento: bool = False
+    ) -> None:
+        self._ejecutar(
+            "UPDATE saga_pasos SET estado = ?, resultado = COALESCE(?, resultado), error = ?,"
+            " intentos = intentos + ?, completado_en = CASE WHEN ? = 'completado' THEN ? ELSE completado_en END"
+            " WHERE saga_id = ? AND nombre = ?",
+            (
+                estado,
+                json.dumps(resultado) if resultado is not None else None,
+                error,
+                1 if intento else 0,
+                estado,
+                datetime.utcnow().isoformat(),
+                saga_id,
+                nombre,
+            ),
+        )
+
+    def obtener(self, saga_id: str) -> Optional[Dict[str, Any]]:
+        filas = self._ejecutar(
+            "SELECT id, tipo, estado, entrada, error, creado_en, actualizado_en FROM sagas WHERE id = ?", (saga_id,)
+        )
+        if not filas:
+            return None
+        sid, tipo, estado, entrada, error, creado_en, actualizado_en = filas[0]
+        pasos = self._ejecutar(
+            "SELECT nombre, estado, intentos, resultado, error, completado_en FROM saga_pasos WHERE saga_id = ?", (saga_id,)
+        )
+        return {
+            "id": sid,
+            "tipo": tipo,
+            "estado": estado,
+            "entrada": json.loads(entrada),
+            "error": error,
+            "creado_en": creado_en,
+            "actualizado_en": actualizado_en,
+            "pasos": {
+                n: {
+                    "estado": e,
+                    "intentos": i,
+                    "resultado": json.loads(r) if r is not None else None,
+                    "error": err,
+                    "completado_en": c,
+                }
+                for n, e, i, r, err, c in pasos
+            },
+        }
+
+    def inconclusas(self) -> List[str]:
+        filas = self._ejecutar("SELECT id FROM sagas WHERE estado IN ('en_curso', 'compensando') ORDER BY creado_en")
+        return [f[0] for f in filas]
+
+    def purgar(self, antes_de: datetime) -> int:
+        """Borra las sagas terminadas sin cambios desde `antes_de` junto con sus pasos; retorna cuántas."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            filtro = "SELECT id FROM sagas WHERE estado IN ('completada', 'compensada') AND actualizado_en < ?"
+            params = (antes_de.isoformat(),)
+            self._conn.execute(f"DELETE FROM saga_pasos WHERE saga_id IN ({filtro})", params)
+            borradas = self._conn.execute(f"DELETE FROM sagas WHERE id IN ({filtro})", params).rowcount
+            self._conn.execute("COMMIT")
+        return borradas
+
+    def cerrar(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class MotorSagas:
+    def __init__(self, almacen: AlmacenSagas, definiciones: Iterable[DefinicionSaga] = ()) -> None:
+        self.almacen = almacen
+        self.definiciones: Dict[str, DefinicionSaga] = {}
+        for d in definiciones:
+            self.registrar(d)
+
+    def registrar(self, definicion: DefinicionSaga) -> None:
+        self.definiciones[definicion.tipo] = definicion
+
+    async def ejecutar(self, tipo: str, entrada: Dict[str, Any], saga_id: Optional[str] = None) -> Dict[str, Any]:
+        """Crea y corre una saga; retorna los resultados por paso o lanza SagaFallida."""
+        definicion = self.definiciones[tipo]
+        saga_id = saga_id or str(uuid4())
+        await asyncio.to_thread(self.almacen.crear, saga_id, tipo, entrada, definicion.orden())
+        return await self._correr(saga_id)
+
+    async def reanudar(self) -> int:
+        """Continúa las sagas que quedaron en curso o compensando; retorna cuántas."""
+        ids = await asyncio.to_thread(self.almacen.inconclusas)
+        for saga_id in ids:
+            try:
+                await self._correr(saga_id)
+            except SagaFallida:
+                pass
+            except Exception:
+                logger.exception(f"no se pudo reanudar la saga {saga_id}", extra={"service": service_name})
+        if ids:
+            logger.info(f"[INFO] Sagas reanudadas: {len(ids)}", extra={"service": service_name})
+        return len(ids)
+
+    async def _correr(self, saga_id: str) -> Dict[str, Any]:
+        saga = await asyncio.to_thread(self.almacen.obtener, saga_id)
+        definicion = self.definiciones[saga["tipo"]]
+        estados = {n: p["estado"] for n, p in saga["pasos"].items()}
+        ctx: Dict[str, Any] = {"saga_id": saga_id, "entrada": saga["entrada"]}
+        ctx.update({n: p["resultado"] for n, p in saga["pasos"].items() if p["estado"] == "completado"})
+
+        if saga["estado"] == "compensando":
+            await self._compensar(definicion, saga_id, estados, ctx)
+            raise SagaFallida(saga_id, "", saga["error"] or "saga compensada")
+
+        while True:
+            terminados = {n for n, e in estados.items() if e in ("completado", "fallido")}
+            listos = [
+                n
+                for n in definicion.orden()
+                if estados[n] not in ("completado", "fallido") and all(d in terminados for d in definicion.paso(n).depende)
+            ]
+            if not listos:
+                break
+            salidas = await asyncio.gather(*(self._paso(saga_id, definicion.paso(n), ctx) for n in listos))
+            falla: Optional[Tuple[str, str]] = None
+            for n, (ok, valor) in zip(listos, salidas):
+                if ok:
+                    estados[n] = "completado"
+                    ctx[n] = valor
+                else:
+                    estados[n] = "fallido"
+                    if definicion.paso(n).critico and falla is None:
+                        falla = (n, valor)
+            if falla is not None:
+                paso, detalle = falla
+                await asyncio.to_thread(self.almacen.estado_saga, saga_id, "compensando", detalle)
+                await self._compensar(definicion, saga_id, estados, ctx)
+                raise SagaFallida(saga_id, paso, detalle)
+
+        await asyncio.to_thread(self.almacen.estado_saga, saga_id, "completada")
+        return {n: ctx.get(n) for n in definicion.orden()}
+
+    async def _paso(self, saga_id: str, paso: Paso, ctx: Dict[str, Any]) -> Tuple[bool, Any]:
+        """Corre un paso con timeout y reintentos; retorna (ok, resultado | detalle del error)."""
+        detalle = ""
+        for intento in range(paso.reintentos + 1):
+            await asyncio.to_thread(self.almacen.estado_paso, saga_id, paso.nombre, "en_curso", intento=True)
+            try:
+                resultado = await asyncio.wait_for(paso.accion(ctx), paso.timeout)
+            except ErrorPaso as e:
+                detalle = str(e)
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                detalle = f"{paso.nombre}: {str(e) or type(e).__name__}"
+                if intento < paso.reintentos:
+                    await asyncio.sleep(SAGAS_BACKOFF_SEGUNDOS * (2 ** intento))
+                continue
+            await asyncio.to_thread(self.almacen.estado_paso, saga_id, paso.nombre, "completado", resultado)
+            return True, resultado
+        logger.warning(f"[WARN] Saga {saga_id}: paso {paso.nombre} falló: {detalle}", extra={"service": service_name})
+        await asyncio.to_thread(self.almacen.estado_paso, saga_id, paso.nombre, "fallido", error=detalle)
+        return False, detalle
+
+    async def _compensar(self, definicion: DefinicionSaga, saga_id: str, estados: Dict[str, str], ctx: Dict[str, Any]) -> None:
+        # Orden inverso al topológico; los ya compensados (antes de una caída) se saltan
+        for n in reversed(definicion.orden()):
+            paso = definicion.paso(n)
+            if estados[n] != "completado" or paso.compensacion is None:
+                continue
+            try:
+                await asyncio.wait_for(paso.compensacion(ctx), paso.timeout)
+                await asyncio.to_thread(self.almacen.estado_paso, saga_id, n, "compensado")
+                estados[n] = "compensado"
+            except Exception as e:
+                # Queda en 'compensando' para reintentarse en el próximo reanudar()
+                logger.error(
+                    f"[ERROR] Saga {saga_id}: compensación de {n} falló: {type(e).__name__} {e}",
+                    extra={"service": service_name},
+                )
+                return
+        await asyncio.to_thread(self.almacen.estado_saga, saga_id, "compensada")
+
+
+async def purgar_periodicamente(
+    almacen: AlmacenSagas, retencion_horas: float = SAGAS_RETENCION_HORAS, intervalo: float = SAGAS_PURGA_SEGUNDOS
+) -> None:
+    while True:
+        try:
+            limite = datetime.utcnow() - timedelta(hours=retencion_horas)
+            borradas = await asyncio.to_thread(almacen.purgar, limite)
+            if borradas:
+                logger.info(f"[INFO] Sagas terminadas purgadas: {borradas}", extra={"service": service_name})
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("purga de sagas falló", extra={"service": service_name})
+        await asyncio.sleep(intervalo)
@@ -0,0 +1,171 @@
+"""
+Registro de clientes HTTP del orquestador, uno por servicio upstream.
+
+Cada upstream (clientes, facturacion, pagos, red, whatsapp) tiene un
+httpx.AsyncClient de vida igual a la app, con su propio pool: las conexiones
+keep-alive se reutilizan entre requests y un upstream lento no agota las
+conexiones de los demás. Se configura por entorno:
+
+- `<UPSTREAM>_URL`: base del servicio (p. ej. PAGOS_URL)
+- `ORQ_<UPSTREAM>_MAX_CONEXIONES` / `ORQ_MAX_CONEXIONES`: tope del pool
+- `ORQ_KEEPALIVE_CONEXIONES`, `ORQ_KEEPALIVE_SEGUNDOS`: conexiones ociosas retenidas y su expiración
+- `ORQ_HTTP2=1`: HTTP/2 si el paquete h2 está instalado (si no, HTTP/1.1)
+
+La ocupación de cada pool se publica en /metrics al momento del scrape, junto
+con un histograma de latencia por upstream: `cabeceras` (hasta recibir el
+status y headers) para toda llamada y `total` para las respuestas en streaming
+del proxy, medido al cerrar el cuerpo.
+"""
+import os
+import time
+from typing import Dict, Iterator
+
+import httpx
+
+from .logging_conf import configure_logging
+
+# Optional deps: h2 para HTTP/2, prometheus_client para métricas del pool
+try:
+    import h2  # type: ignore  # noqa: F401
+    _H2_DISPONIBLE = True
+except Exception:  # pragma: no cover - tolerate missing h2
+    _H2_DISPONIBLE = False
+try:
+    from prometheus_client import REGISTRY, Histogram  # type: ignore
+    from prometheus_client.core import GaugeMetricFamily  # type: ignore
+except Exception:  # pragma: no cover - tolerate missing prometheus_client
+    REGISTRY = None
+    Histogram = None
+
+
+service_name = os.getenv("SERVICE_NAME", "orquestador")
+logger = configure_logging(service_name)
+
+UPSTREAMS: Dict[str, str] = {
+    "clientes": os.getenv("CLIENTES_URL", "http://clientes:8000"),
+    "facturacion": os.getenv("FACTURACION_URL", "http://facturacion:8002"),
+    "pagos": os.getenv("PAGOS_URL", "http://pagos:8003"),
+    "red": os.getenv("RED_URL", "http://red:8020"),
+    "whatsapp": os.getenv("WHATSAPP_URL", "http://whatsapp:8011"),
+}
+
+MAX_CONEXIONES = int(os.getenv("ORQ_MAX_CONEXIONES", "100"))
+KEEPALIVE_CONEXIONES = int(os.getenv("ORQ_KEEPALIVE_CONEXIONES", "20"))
+KEEPALIVE_SEGUNDOS = float(os.getenv("ORQ_KEEPALIVE_SEGUNDOS", "30"))
+TIMEOUT_SEGUNDOS = float(os.getenv("ORQ_TIMEOUT_SEGUNDOS", "10"))
+HTTP2 = os.getenv("ORQ_HTTP2", "0") == "1"
+
+LATENCIA = (
+    Histogram(
+        "orquestador_upstream_latencia_segundos",
+        "Latencia de llamadas a upstreams por fase",
+        ["upstream", "fase"],
+        buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20),
+    )
+    if Histogram is not None
+    else None
+)
+
+
+def observar_latencia(upstream: str, fase: str, inicio: float) -> None:
+    """Registra los segundos transcurridos desde `inicio` (time.perf_counter)."""
+    if LATENCIA is not None:
+        LATENCIA.labels(upstream=upstream, fase=fase).observe(time.perf_counter() - inicio)
+
+
+def _hooks(nombre: str) -> Dict[str, list]:
+    async def _inicio(request: httpx.Request) -> None:
+        request.extensions["orq_inicio"] = time.perf_counter()
+
+    async def _cabeceras(response: httpx.Response) -> None:
+        inicio = response.request.extensions.get("orq_inicio")
+        if inicio is not None:
+            observar_latencia(nombre, "cabeceras", inicio)
+
+    return {"request": [_inicio], "response": [_cabeceras]}
+
+
+class RegistroClientes:
+    """Un AsyncClient por upstream, creado al primer uso y cerrado al apagar la app."""
+
+    def __init__(self, upstreams: Dict[str, str] = UPSTREAMS, transport: httpx.AsyncBaseTransport | None = None) -> None:
+        self.upstreams = dict(upstreams)
+        self._transport = transport
+        self._clientes: Dict[str, httpx.AsyncClient] = {}
+        self._http2 = HTTP2 and _H2_DISPONIBLE
+        if HTTP2 and not _H2_DISPONIBLE:
+            logger.warning("[WARN] ORQ_HTTP2=1 sin paquete h2; se usa HTTP/1.1", extra={"service": service_name})
+
+    def limites(self, nombre: str) -> httpx.Limits:
+        maximo = int(os.getenv(f"ORQ_{nombre.upper()}_MAX_CONEXIONES", str(MAX_CONEXIONES)))
+        return httpx.Limits(
+            max_connections=maximo,
+            max_keepalive_connections=min(KEEPALIVE_CONEXIONES, maximo),
+            keepalive_expiry=KEEPALIVE_SEGUNDOS,
+        )
+
+    def cliente(self, nombre: str) -> httpx.AsyncClient:
+        c = self._clientes.get(nombre)
+        if c is None or c.is_closed:
+            c = httpx.AsyncClient(
+                base_url=self.upstreams[nombre],
+                timeout=TIMEOUT_SEGUNDOS,
+                limits=self.limites(nombre),
+                http2=self._http2,
+                transport=self._transport,
+                event_hooks=_hooks(nombre),
+            )
+            self._clientes[nombre] = c
+        return c
+
+    async def cerrar(self) -> None:
+        for c in self._clientes.values():
+            await c.aclose()
+        self._clientes.clear()
+
+    def ocupacion(self) -> Dict[str, Dict[str, int]]:
+        """Conexiones activas, ociosas, en espera y tope por upstream."""
+        out: Dict[str, Dict[str, int]] = {}
+        for nombre, c in self._clientes.items():
+            # httpcore.AsyncConnectionPool; los transports de prueba no tienen pool
+            pool = getattr(c._transport, "_pool", None)
+            if pool is None:
+                continue
+            conexiones = list(pool.connections)
+            ociosas = sum(1 for cx in conexiones if cx.is_idle())
+            out[nombre] = {
+                "activas": len(conexiones) - ociosas,
+                "ociosas": ociosas,
+                # Requests sin conexión asignada: el pool está saturado
+                "en_espera": sum(1 for r in getattr(pool, "_requests", []) if getattr(r, "connection", None) is None),
+                "maximo": pool._max_connections or 0,
+            }
+        return out
+
+
+class _ColectorPool:
+    """Colector de Prometheus que lee la ocupación de los pools en cada scrape."""
+
+    def __init__(self, registro: RegistroClientes) -> None:
+        self.registro = registro
+
+    def collect(self) -> Iterator:
+        conexiones = GaugeMetricFamily(
+            "orquestador_upstream_conexiones",
+            "Conexiones del pool HTTP por upstream y estado",
+            labels=["upstream", "estado"],
+        )
+        maximo = GaugeMetricFamily(
+            "orquestador_upstream_conexiones_max", "Tope de conexiones del pool por upstream", labels=["upstream"]
+        )
+        for nombre, o in self.registro.ocupacion().items():
+            for estado in ("activas", "ociosas", "en_espera"):
+                conexiones.add_metric([nombre, estado], o[estado])
+            maximo.add_metric([nombre], o["maximo"])
+        yield conexiones
+        yield maximo
+
+
+registro_clientes = RegistroClientes()
+if REGISTRY is not None:
+    REGISTRY.register(_ColectorPool(registro_clientes))
@@ -0,0 +1,57 @@
+import asyncio
+import json
+import os
+from typing import Any, List, Tuple
+
+# Optional deps: aiokafka (sin broker se usa solo el log en archivo)
+try:
+    from aiokafka import AIOKafkaProducer  # type: ignore
+except Exception:  # pragma: no cover - tolerate missing aiokafka
+    AIOKafkaProducer = None
+
+EVENTOS_PATH = os.getenv("PAGOS_EVENTOS_PATH", "/app_events/events.log")
+
+
+class EventBus:
+    """Kafka si hay KAFKA_BROKER; siempre refleja al log compartido en archivo."""
+
+    def __init__(self, path: str = EVENTOS_PATH) -> None:
+        self.broker = os.getenv("KAFKA_BROKER")
+        self.enabled = bool(self.broker) and AIOKafkaProducer is not None
+        self.path = path
+        self._producer = None
+
+    async def start(self):
+        if self.enabled and self._producer is None:
+            try:
+                self._producer = AIOKafkaProducer(bootstrap_servers=self.broker, acks="all")
+                await self._producer.start()
+            except Exception:
+                # fallback to file-only mode
+                self.enabled = False
+                self._producer = None
+
+    async def stop(self):
+        if self._producer:
+            await self._producer.stop()
+            self._producer = None
+
+    async def publicar_lote(self, eventos: List[Tuple[str, str | None, dict[str, Any]]]) -> None:
+        """Publica (topic, clave, payload) y espera confirmación de todos; un fallo se propaga."""
+        if self._producer:
+            envios = [
+                await self._producer.send(topic, json.dumps(payload).encode("utf-8"), key=clave.encode("utf-8") if clave else None)
+                for topic, clave, payload in eventos
+            ]
+            await asyncio.gather(*envios)
+        # Una sola escritura en modo append para todo el lote
+        lineas = "".join(json.dumps({"topic": topic, "payload": payload}) + "\n" for topic, _, payload in eventos)
+        await asyncio.to_thread(self._anexar, lineas)
+
+    def _anexar(self, lineas: str) -> None:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lineas)
+
+
+event_bus = EventBus()
@@ -1,11 +1,14 @@
+import asyncio
 import os
 import json
-import hashlib
-import hmac
+import tempfile
+from datetime import datetime, timedelta
 from uuid import uuid4
-from fastapi import FastAPI, Request, Header, HTTPException
+from fastapi import FastAPI, File, Request, Header, HTTPException, Query, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from opentelemetry import trace
 from opentelemetry.sdk.resources import SERVICE_NAME, Resource
@@ -23,16 +26,37 @@ except Exception:  # pragma: no cover - allow unit tests without the dependency
             return None
 
 from .logging_conf import configure_logging
-from .db import init_db, SessionLocal
-from .models import Conciliacion, IdempotencyKey, Pago, Transaccion, WebhookLog
-import httpx
+from .db import engine, init_db, SessionLocal
+from .particiones import mantener_periodicamente
+from .models import Conciliacion, IdempotencyKey, Pago, PagoReferencia, Transaccion
+from .services import idempotencia_service as idempotencia
+from .services import eventos_outbox_service as eventos_outbox
+from .services import outbox_facturas_service as outbox_facturas
+from .services.eventos_outbox_service import relay_eventos
+from .services.outbox_facturas_service import despachador_facturas
+from .services.conciliacion_service import reporte_csv
+from .services.lote_pagos_service import LoteInvalido, importar_lote
+from .services.pendientes_service import (
+    PENDIENTES_LIMITE,
+    PENDIENTES_LIMITE_MAX,
+    CursorInvalido,
+    pagina,
+    stream_ndjson,
+)
+from .services.webhook_service import EVENT_ID_MAX, escritor_webhooks, firma_valida
+from .services.estado_cuenta_service import (
+    TOLERANCIA_MONTO,
+    VENTANA_DIAS,
+    EstadoCuentaDuplicado,
+    EstadoCuentaInvalido,
+    conciliar_estado_cuenta,
+)
 from pydantic import BaseModel, Field
 
 
 service_name = os.getenv("SERVICE_NAME", "pagos")
 logger = configure_logging(service_name)
 
-
 def setup_tracing():
     provider = TracerProvider(resource=Resource.create({SERVICE_NAME: service_name}))
     otlp_endpoint = os.getenv("OTEL_EXPORTER_OTLP_ENDPOINT")
@@ -54,6 +78,7 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 
@@ -61,6 +86,19 @@ app.add_middleware(
 async def on_startup():
     setup_tracing()
     init_db()
+    escritor_webhooks.start()
+    despachador_facturas.start()
+    await relay_eventos.start()
+    # Particiones mensuales por adelantado y archivo de las vencidas (opt-in, Postgres)
+    asyncio.create_task(mantener_periodicamente(engine))
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    # Vaciar la cola de webhooks antes de salir
+    await escritor_webhooks.stop()
+    await despachador_facturas.stop()
+    await relay_eventos.stop()
 
 
 @app.middleware("http")
@@ -107,15 +145,6 @@ class PagoIn(BaseModel):
     factura_uuid: str | None = None
 
 
-def _marcar_factura_pagada(uuid: str) -> None:
-    fact_url = os.getenv("FACTURACION_URL", "http://facturacion:8002")
-    try:
-        response = httpx.patch(f"{fact_url}/facturacion/{uuid}/pagar", timeout=5.0)
-        response.raise_for_status()
-    except Exception as exc:
-        logger.warning("no se pudo marcar factura pagada", extra={"service": service_name, "uuid": uuid, "error": str(exc)})
-
-
 @app.post("/pagos")
 def crear_pago(body: PagoIn):
     db: Session = SessionLocal()
@@ -130,6 +159,7 @@ def crear_pago(body: PagoIn):
             estatus="conciliado" if conciliado else "confirmado",
             factura_uuid=body.factura_uuid,
         )
+        db.add(PagoReferencia(referencia=referencia))
         db.add(pago)
         db.flush()
         tx = Transaccion(
@@ -140,38 +170,78 @@ def crear_pago(body: PagoIn):
         )
         db.add(tx)
         db.add(Conciliacion(referencia=referencia, conciliado=conciliado))
-        db.commit()
         if conciliado and body.factura_uuid:
-            _marcar_factura_pagada(body.factura_uuid)
+            # Aviso a facturación vía outbox, en la misma transacción que el pago
+            outbox_facturas.encolar(db, body.factura_uuid, referencia)
+        eventos_outbox.registrar(db, eventos_outbox.PAGO_REGISTRADO, [eventos_outbox.evento_pago(pago)])
+        db.commit()
+        relay_eventos.despertar()
+        if conciliado:
+            despachador_facturas.despertar()
         db.refresh(pago)
         return _serialize_pago(pago)
     finally:
         db.close()
 
 
-@app.get("/pagos/pendientes")
-def pagos_pendientes():
+def _importar_lote(raw, nombre: str, content_type: str) -> dict:
     db: Session = SessionLocal()
     try:
-        rows = (
-            db.query(Pago)
-            .filter(Pago.estatus != "conciliado")
-            .order_by(Pago.creado_en.asc())
-            .all()
-        )
-        return [_serialize_pago(p) for p in rows]
+        try:
+            resumen = importar_lote(db, raw, nombre, content_type)
+        except LoteInvalido as exc:
+            raise HTTPException(status_code=400, detail=str(exc))
+        if resumen["exitosos"]:
+            relay_eventos.despertar()
+            despachador_facturas.despertar()
+        return resumen
     finally:
         db.close()
 
 
+@app.post("/pagos/lote")
+async def importar_lote_endpoint(request: Request, nombre: str = Query("", max_length=200)):
+    """Alta masiva de pagos desde CSV o NDJSON (cuerpo crudo; Content-Type text/csv o application/x-ndjson).
+    Se inserta por bloques y se responde el resultado de cada fila."""
+    # El cuerpo se vuelca a disco por partes; el procesamiento corre en el threadpool
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as raw:
+        async for chunk in request.stream():
+            raw.write(chunk)
+        raw.seek(0)
+        return await run_in_threadpool(_importar_lote, raw, nombre, request.headers.get("content-type", ""))
+
+
+@app.get("/pagos/pendientes")
+def pagos_pendientes(
+    cursor: str | None = Query(None, max_length=200),
+    limite: int | None = Query(None, ge=1, le=PENDIENTES_LIMITE_MAX),
+    formato: str = Query("json", pattern="^(json|ndjson)$"),
+):
+    """Pagos no conciliados por antigüedad. `json` (default) responde una página
+    de `limite` y el cursor de la siguiente en `X-Next-Cursor`; `ndjson` transmite
+    todo (o hasta `limite`) desde `cursor`."""
+    try:
+        if formato == "ndjson":
+            return StreamingResponse(stream_ndjson(cursor, limite), media_type="application/x-ndjson")
+        db: Session = SessionLocal()
+        try:
+            pagos, siguiente = pagina(db, cursor, limite or PENDIENTES_LIMITE)
+        finally:
+            db.close()
+    except CursorInvalido as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    headers = {"X-Next-Cursor": siguiente} if siguiente else {}
+    return JSONResponse(content=pagos, headers=headers)
+
+
 @app.post("/pagos/procesar")
 def procesar_pago(body: dict, idempotency_key: str | None = Header(default=None, alias="Idempotency-Key")):
     db: Session = next(get_db())
     try:
         if idempotency_key:
-            existing = db.query(IdempotencyKey).filter(IdempotencyKey.key == idempotency_key).first()
-            if existing:
-                return json.loads(existing.response)
+            previo = idempotencia.buscar(db, idempotency_key)
+            if previo is not None:
+                return previo
         referencia = body.get("referencia") or str(uuid4())
         metodo = body.get("metodo", "spei")
         monto = float(body.get("monto", 0))
@@ -181,17 +251,38 @@ def procesar_pago(body: dict, idempotency_key: str | None = Header(default=None,
         except Exception:
             cliente_id_int = None
         pago = Pago(referencia=referencia, metodo=metodo, monto=monto, cliente_id=cliente_id_int, estatus="confirmado")
+        # La PK de pagos_referencias rechaza una referencia repetida, con o sin particiones
+        db.add(PagoReferencia(referencia=referencia))
         db.add(pago)
-        db.flush()
+        try:
+            db.flush()
+        except IntegrityError:
+            db.rollback()
+            previo = idempotencia.buscar(db, idempotency_key) if idempotency_key else None
+            if previo is not None:
+                return previo
+            raise HTTPException(status_code=409, detail=f"Referencia duplicada: {referencia}")
         tx = Transaccion(pago_ref=referencia, provider=metodo.upper(), provider_tx=str(uuid4()), exitoso=True)
         db.add(tx)
         db.add(Conciliacion(referencia=referencia, conciliado=True))
-        db.commit()
-        db.refresh(pago)
+        eventos_outbox.registrar(db, eventos_outbox.PAGO_REGISTRADO, [eventos_outbox.evento_pago(pago)])
         resp = _serialize_pago(pago)
+        resp_json = json.dumps(resp)
         if idempotency_key:
-            db.add(IdempotencyKey(key=idempotency_key, reference=referencia, response=json.dumps(resp)))
+            # Llave y respuesta en la misma transacción que el pago
+            db.add(IdempotencyKey(key=idempotency_key, reference=referencia, response=resp_json))
+        try:
             db.commit()
+        except IntegrityError:
+            db.rollback()
+            # Otra petición con la misma llave ganó la carrera: devolver su respuesta
+            previo = idempotencia.buscar(db, idempotency_key) if idempotency_key else None
+            if previo is None:
+                raise
+            return previo
+        relay_eventos.despertar()
+        if idempotency_key:
+            idempotencia.recordar(idempotency_key, resp_json)
         return resp
     finally:
         db.close()
@@ -200,37 +291,60 @@ def procesar_pago(body: dict, idempotency_key: str | None = Header(default=None,
 @app.post("/pagos/webhook")
 async def webhook(request: Request, x_signature: str | None = Header(default=None)):
     secret = os.getenv("WEBHOOK_SECRET", "devsecret")
-    # Simple anti-replay: event_id uniqueness
-    db: Session = next(get_db())
+    raw = await request.body()
+    # HMAC sobre los bytes recibidos, tal como los firmó la pasarela
+    if x_signature and not firma_valida(secret, raw, x_signature):
+        raise HTTPException(status_code=401, detail="Invalid signature")
     try:
-        body = await request.json()
-        event_id = body.get("id") or str(uuid4())
-        if db.query(WebhookLog).filter(WebhookLog.event_id == event_id).first():
-            return {"status": "ignored"}
-        # naive HMAC check
-        raw = json.dumps(body, sort_keys=True).encode("utf-8")
-        expected = hmac.new(secret.encode("utf-8"), raw, hashlib.sha256).hexdigest()
-        if x_signature and x_signature != expected:
-            raise HTTPException(status_code=401, detail="Invalid signature")
-        db.add(WebhookLog(event_id=event_id, payload=json.dumps(body)))
-        db.commit()
-        return {"status": "ok"}
-    finally:
-        db.close()
+        body = json.loads(raw)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="JSON inválido")
+    event_id = str(body.get("id") or uuid4()) if isinstance(body, dict) else str(uuid4())
+    if len(event_id) > EVENT_ID_MAX:
+        raise HTTPException(status_code=400, detail=f"id excede {EVENT_ID_MAX} caracteres")
+    estado = await escritor_webhooks.aceptar(event_id, raw.decode("utf-8", errors="replace"))
+    if estado == "lleno":
+        raise HTTPException(status_code=503, detail="Cola de webhooks llena, reintente")
+    if estado == "error":
+        # No persistido: sin confirmar, para que la pasarela reintente
+        raise HTTPException(status_code=503, detail="No se pudo registrar el webhook, reintente")
+    return {"status": estado}
 
 
 @app.get("/pagos/conciliar")
-def conciliar():
-    db: Session = next(get_db())
+def conciliar(
+    formato: str = Query("json", pattern="^(json|csv)$"),
+    marca: str | None = Query(None, max_length=64, description="Corrida incremental: solo pagos posteriores a esta marca de agua"),
+):
+    """Reporte de conciliación. `formato=csv` lo transmite como text/csv por chunks;
+    `json` (default) conserva la respuesta {"csv": ...}."""
+    if formato == "csv":
+        return StreamingResponse(
+            reporte_csv(marca),
+            media_type="text/csv",
+            headers={"Content-Disposition": 'attachment; filename="conciliacion.csv"'},
+        )
+    csv = "".join(reporte_csv(marca)).rstrip("\n")
+    return JSONResponse(content={"csv": csv})
+
+
+@app.post("/pagos/conciliar/estado-cuenta")
+def conciliar_estado_cuenta_endpoint(
+    archivo: UploadFile = File(...),
+    tolerancia: float = Query(TOLERANCIA_MONTO, ge=0, le=100),
+    ventana_dias: int = Query(VENTANA_DIAS, ge=0, le=31),
+):
+    """Importa un estado de cuenta bancario/SPEI (CSV u OFX) y concilia sus movimientos contra los pagos."""
+    db: Session = SessionLocal()
     try:
-        # Simple reconciliation report: list confirmed payments
-        pagos = db.query(Pago).all()
-        rows = ["referencia,monto,estatus,conciliado"]
-        for p in pagos:
-            conc = db.query(Conciliacion).filter(Conciliacion.referencia == p.referencia).first()
-            rows.append(f"{p.referencia},{p.monto:.2f},{p.estatus},{'true' if conc and conc.conciliado else 'false'}")
-        csv = "\n".join(rows)
-        return JSONResponse(content={"csv": csv})
+        try:
+            resumen = conciliar_estado_cuenta(db, archivo.file, archivo.filename or "", tolerancia, ventana_dias)
+        except EstadoCuentaDuplicado as exc:
+            raise HTTPException(status_code=409, detail=str(exc))
+        except EstadoCuentaInvalido as exc:
+            raise HTTPException(status_code=400, detail=str(exc))
+        db.commit()
+        return resumen
     finally:
         db.close()
 
@@ -248,16 +362,17 @@ def obtener_pago(referencia: str):
 
 
 @app.get("/pagos/cliente/{cliente_id}")
-def pagos_cliente(cliente_id: int):
+def pagos_cliente(
+    cliente_id: int,
+    meses: int | None = Query(None, ge=1, le=120, description="Solo pagos de los últimos `meses` (acota las particiones leídas)"),
+):
+    """Últimos 50 pagos del cliente; con `meses`, solo los de esa ventana."""
     db: Session = next(get_db())
     try:
-        rows = (
-            db.query(Pago)
-            .filter(Pago.cliente_id == cliente_id)
-            .order_by(Pago.creado_en.desc())
-            .limit(50)
-            .all()
-        )
+        q = db.query(Pago).filter(Pago.cliente_id == cliente_id)
+        if meses is not None:
+            q = q.filter(Pago.creado_en >= datetime.utcnow() - timedelta(days=31 * meses))
+        rows = q.order_by(Pago.creado_en.desc()).limit(50).all()
         return [_serialize_pago(p) for p in rows]
     finally:
         db.close()
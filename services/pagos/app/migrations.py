@@ -0,0 +1,155 @@
+"""
+Migraciones idempotentes del esquema de pagos.
+
+`create_all` solo crea tablas nuevas; los cambios sobre tablas existentes
+(columnas, índices) se registran aquí y se aplican una sola vez por base,
+anotados en `pagos_migraciones`.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Iterator, List, Tuple
+
+from sqlalchemy import inspect, literal, select, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.schema import CreateIndex
+
+from .models import Conciliacion, ConciliacionMarca, ConciliacionReportado, Pago, PagoReferencia, SchemaMigracion, WebhookLog
+from .particiones import asegurar_particiones, esta_particionada
+
+
+def _agregar_columna(conn: Connection, tabla: str, columna) -> None:
+    existentes = {c["name"] for c in inspect(conn).get_columns(tabla)}
+    if columna.name in existentes:
+        return
+    tipo = columna.type.compile(dialect=conn.dialect)
+    conn.execute(text(f"ALTER TABLE {tabla} ADD COLUMN {columna.name} {tipo}"))
+
+
+def _crear_indices(conn: Connection, tabla) -> None:
+    existentes = {ix["name"] for ix in inspect(conn).get_indexes(tabla.name)}
+    for index in tabla.indexes:
+        if index.name in existentes:
+            continue
+        if conn.dialect.name == "postgresql":
+            # Sin bloquear escrituras; requiere AUTOCOMMIT. El DDL compilado conserva
+            # el WHERE de los índices parciales
+            ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=conn.dialect))
+            # Postgres no admite CONCURRENTLY sobre el padre de una tabla particionada
+            if not esta_particionada(conn, tabla.name):
+                ddl = ddl.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)
+            conn.execute(text(ddl))
+        else:
+            index.create(conn, checkfirst=True)
+
+
+def _0001_conciliaciones_indice_referencia(conn: Connection) -> None:
+    _crear_indices(conn, Conciliacion.__table__)
+
+
+def _0002_pagos_factura_uuid(conn: Connection) -> None:
+    _agregar_columna(conn, Pago.__tablename__, Pago.__table__.c.factura_uuid)
+
+
+def _0003_pagos_indice_pendientes(conn: Connection) -> None:
+    _crear_indices(conn, Pago.__table__)
+
+
+def _0004_pagos_indice_cliente(conn: Connection) -> None:
+    _crear_indices(conn, Pago.__table__)
+
+
+def _0005_marcas_ultimo_creado_en(conn: Connection) -> None:
+    _agregar_columna(conn, ConciliacionMarca.__tablename__, ConciliacionMarca.__table__.c.ultimo_creado_en)
+
+
+def _0006_webhooks_payload_text(conn: Connection) -> None:
+    # sqlite no aplica el largo de VARCHAR; en Postgres un payload > 1000 fallaba el insert
+    if conn.dialect.name == "postgresql":
+        conn.execute(text(f"ALTER TABLE {WebhookLog.__tablename__} ALTER COLUMN payload TYPE TEXT"))
+
+
+def _0007_pagos_referencias(conn: Connection) -> None:
+    # Respaldo de las referencias existentes; el WHERE evita la ambigüedad de
+    # INSERT ... SELECT ... ON CONFLICT en sqlite
+    conn.execute(
+        text(
+            f"INSERT INTO {PagoReferencia.__tablename__} (referencia, creado_en) "
+            f"SELECT referencia, creado_en FROM {Pago.__tablename__} WHERE referencia IS NOT NULL "
+            "ON CONFLICT (referencia) DO NOTHING"
+        )
+    )
+
+
+def _0008_conciliacion_reportados(conn: Connection) -> None:
+    # Las marcas previas filtraban por id: se anotan como reportados los pagos
+    # hasta su último id dentro de la ventana, para que el primer re-escaneo
+    # no los repita
+    from .services.conciliacion_service import CONCILIACION_HOLGURA
+
+    marcas = conn.execute(
+        select(ConciliacionMarca.nombre, ConciliacionMarca.ultimo_pago_id, ConciliacionMarca.ultimo_creado_en)
+        .where(ConciliacionMarca.ultimo_creado_en.is_not(None))
+    ).all()
+    for nombre, ultimo_id, ultimo_creado_en in marcas:
+        conn.execute(
+            ConciliacionReportado.__table__.insert().from_select(
+                ["nombre", "pago_id", "creado_en"],
+                select(literal(nombre), Pago.id, Pago.creado_en).where(
+                    Pago.id <= ultimo_id, Pago.creado_en >= ultimo_creado_en - CONCILIACION_HOLGURA
+                ),
+            )
+        )
+
+MIGRACIONES: List[Tuple[str, Callable[[Connection], None], bool]] = [
+    # (id, función, requiere AUTOCOMMIT)
+    ("0001_conciliaciones_indice_referencia", _0001_conciliaciones_indice_referencia, True),
+    ("0002_pagos_factura_uuid", _0002_pagos_factura_uuid, False),
+    ("0003_pagos_indice_pendientes", _0003_pagos_indice_pendientes, True),
+    ("0004_pagos_indice_cliente", _0004_pagos_indice_cliente, True),
+    ("0005_marcas_ultimo_creado_en", _0005_marcas_ultimo_creado_en, False),
+    ("0006_webhooks_payload_text", _0006_webhooks_payload_text, False),
+    ("0007_pagos_referencias", _0007_pagos_referencias, False),
+    ("0008_conciliacion_reportados", _0008_conciliacion_reportados, False),
+]
+
+
+# Clave arbitraria del advisory lock que serializa réplicas arrancando a la vez
+_LOCK_ID = 742003
+
+
+@contextmanager
+def con_lock(engine: Engine) -> Iterator[None]:
+    """Serializa entre réplicas el DDL de arranque y mantenimiento (no-op fuera de Postgres)."""
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as lock_conn:
+        lock_conn.execute(text("SELECT pg_advisory_lock(:k)"), {"k": _LOCK_ID})
+        try:
+            yield
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": _LOCK_ID})
+
+
+def aplicar_migraciones(engine: Engine) -> None:
+    with con_lock(engine):
+        _aplicar_pendientes(engine)
+        # Opt-in (PAGOS_PARTICIONES=1); solo Postgres
+        asegurar_particiones(engine)
+
+
+def _aplicar_pendientes(engine: Engine) -> None:
+    with engine.connect() as conn:
+        aplicadas = set(conn.execute(select(SchemaMigracion.id)).scalars())
+    for mig_id, fn, autocommit in MIGRACIONES:
+        if mig_id in aplicadas:
+            continue
+        if autocommit:
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                fn(conn)
+            with engine.begin() as conn:
+                conn.execute(SchemaMigracion.__table__.insert().values(id=mig_id, aplicado_en=datetime.utcnow()))
+        else:
+            with engine.begin() as conn:
+                fn(conn)
+                conn.execute(SchemaMigracion.__table__.insert().values(id=mig_id, aplicado_en=datetime.utcnow()))
@@ -1,5 +1,5 @@
 from sqlalchemy.orm import Mapped, mapped_column
-from sqlalchemy import Integer, String, Float, DateTime, Boolean
+from sqlalchemy import Integer, String, Float, DateTime, Boolean, Index, Text, UniqueConstraint, text
 from datetime import datetime
 from .db import Base
 
@@ -15,12 +15,33 @@ class IdempotencyKey(Base):
 
 class Pago(Base):
     __tablename__ = "pagos"
+    __table_args__ = (
+        # Índice parcial para /pagos/pendientes; en BDs existentes lo crea migrations.py
+        Index(
+            "ix_pagos_pendientes",
+            "creado_en",
+            "id",
+            postgresql_where=text("estatus <> 'conciliado'"),
+            sqlite_where=text("estatus <> 'conciliado'"),
+        ),
+        Index("ix_pagos_cliente_creado", "cliente_id", "creado_en"),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     referencia: Mapped[str] = mapped_column(String(100), unique=True)
     metodo: Mapped[str] = mapped_column(String(30))
     monto: Mapped[float] = mapped_column(Float)
     cliente_id: Mapped[int | None] = mapped_column(Integer, nullable=True)
     estatus: Mapped[str] = mapped_column(String(30), default="pendiente")
+    factura_uuid: Mapped[str | None] = mapped_column(String(64), nullable=True)
+    creado_en: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class PagoReferencia(Base):
+    """Unicidad global de `pagos.referencia`. Con particiones el UNIQUE de `pagos`
+    incluye creado_en, así que quien inserta un pago reserva aquí su referencia
+    en la misma transacción."""
+    __tablename__ = "pagos_referencias"
+    referencia: Mapped[str] = mapped_column(String(100), primary_key=True)
     creado_en: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
 
@@ -38,14 +59,82 @@ class WebhookLog(Base):
     __tablename__ = "webhooks"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     event_id: Mapped[str] = mapped_column(String(100), unique=True)
-    payload: Mapped[str] = mapped_column(String(1000))
+    payload: Mapped[str] = mapped_column(Text)
     recibido_en: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
 
 class Conciliacion(Base):
     __tablename__ = "conciliaciones"
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    referencia: Mapped[str] = mapped_column(String(100))
+    # Indexada para el EXISTS de /pagos/conciliar; en BDs existentes la crea migrations.py
+    referencia: Mapped[str] = mapped_column(String(100), index=True)
     conciliado: Mapped[bool] = mapped_column(Boolean, default=False)
     creado_en: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
 
+
+class MovimientoBancario(Base):
+    """Línea de un estado de cuenta importado y el pago con el que se concilió (si hubo)."""
+    __tablename__ = "movimientos_bancarios"
+    __table_args__ = (UniqueConstraint("archivo_hash", "linea", name="uq_movimientos_archivo_linea"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    archivo_hash: Mapped[str] = mapped_column(String(64), index=True)
+    linea: Mapped[int] = mapped_column(Integer)
+    fecha: Mapped[datetime] = mapped_column(DateTime)
+    monto: Mapped[float] = mapped_column(Float)
+    referencia: Mapped[str | None] = mapped_column(String(100), nullable=True)
+    descripcion: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    # Pago.referencia conciliado; indexado para el anti-join de candidatos
+    pago_ref: Mapped[str | None] = mapped_column(String(100), nullable=True, index=True)
+    # exacta | referencia_monto | monto_fecha
+    regla: Mapped[str | None] = mapped_column(String(30), nullable=True)
+    creado_en: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class FacturaPagadaOutbox(Base):
+    """Aviso pendiente a facturación de que una factura quedó pagada (outbox)."""
+    __tablename__ = "outbox_facturas_pagadas"
+    __table_args__ = (Index("ix_outbox_facturas_pendientes", "estatus", "proximo_intento"),)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    factura_uuid: Mapped[str] = mapped_column(String(64))
+    pago_ref: Mapped[str] = mapped_column(String(100))
+    estatus: Mapped[str] = mapped_column(String(20), default="pendiente")
+    intentos: Mapped[int] = mapped_column(Integer, default=0)
+    proximo_intento: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    ultimo_error: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    creado_en: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class EventoOutbox(Base):
+    """Evento de dominio de pagos pendiente de publicar, escrito en la misma transacción que el cambio."""
+    __tablename__ = "eventos_outbox"
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    topic: Mapped[str] = mapped_column(String(64))
+    # Llave de partición en Kafka (cliente_id): orden por cliente
+    clave: Mapped[str | None] = mapped_column(String(100), nullable=True)
+    payload: Mapped[str] = mapped_column(Text)
+    creado_en: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class ConciliacionMarca(Base):
+    """Marca de agua de una corrida incremental de conciliación."""
+    __tablename__ = "conciliacion_marcas"
+    nombre: Mapped[str] = mapped_column(String(64), primary_key=True)
+    # Mayor Pago.id reportado (informativo: los ids no se confirman en orden)
+    ultimo_pago_id: Mapped[int] = mapped_column(Integer, default=0)
+    # Corte de la última corrida completa: acota la siguiente por fecha (ventana de re-escaneo y poda de particiones)
+    ultimo_creado_en: Mapped[datetime | None] = mapped_column(DateTime, nullable=True)
+    actualizado_en: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class ConciliacionReportado(Base):
+    """Pagos ya reportados por una marca dentro de la ventana de re-escaneo (deduplicación)."""
+    __tablename__ = "conciliacion_reportados"
+    nombre: Mapped[str] = mapped_column(String(64), primary_key=True)
+    pago_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    creado_en: Mapped[datetime] = mapped_column(DateTime, index=True)
+
+
+class SchemaMigracion(Base):
+    __tablename__ = "pagos_migraciones"
+    id: Mapped[str] = mapped_column(String(100), primary_key=True)
+    aplicado_en: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,224 @@
+"""
+Particionado mensual por rango (Postgres) de las tablas de pagos que solo crecen.
+
+Opt-in con `PAGOS_PARTICIONES=1`; en SQLite o sin la variable no hace nada.
+Corre dentro del advisory lock de `aplicar_migraciones`:
+
+1. Conversión (una vez por tabla): la tabla actual se renombra a `<tabla>_legacy`,
+   se crea `<tabla>` PARTITION BY RANGE (creado_en) con las mismas columnas y
+   secuencia, se copian las filas y se borra la legacy. Es una reescritura
+   completa dentro de una transacción: conviene hacerla en ventana de
+   mantenimiento.
+2. Mantenimiento: crea las particiones `<tabla>_pYYYYMM` de los próximos
+   `PAGOS_PARTICIONES_ADELANTE` meses; una partición DEFAULT recibe lo que
+   quede fuera de rango.
+3. Archivo (opcional, `PAGOS_PARTICIONES_RETENER_MESES` > 0): las particiones
+   más viejas que la retención se separan (DETACH) y se mueven al esquema
+   `PAGOS_PARTICIONES_ESQUEMA_ARCHIVO`, listas para pg_dump y DROP.
+
+Postgres exige que las PK y los UNIQUE incluyan la llave de partición: la PK
+pasa a (id, creado_en) y `pagos.referencia` a UNIQUE (referencia, creado_en).
+La unicidad global de la referencia la da `pagos_referencias` (sin particionar),
+que se escribe en la misma transacción que cada pago.
+`webhooks` queda sin particionar: su UNIQUE(event_id) es la deduplicación
+definitiva de los webhooks y no puede ser global en una tabla particionada.
+"""
+import asyncio
+import os
+import re
+from datetime import date, datetime
+from typing import Dict, Iterator, List
+
+from sqlalchemy import Table, UniqueConstraint, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.schema import CreateIndex
+
+from .logging_conf import configure_logging
+from .models import Conciliacion, Pago, Transaccion
+
+
+service_name = os.getenv("SERVICE_NAME", "pagos")
+logger = configure_logging(service_name)
+
+PARTICIONES_ACTIVAS = os.getenv("PAGOS_PARTICIONES", "0") == "1"
+MESES_ADELANTE = int(os.getenv("PAGOS_PARTICIONES_ADELANTE", "3"))
+# 0 = nunca archivar
+RETENER_MESES = int(os.getenv("PAGOS_PARTICIONES_RETENER_MESES", "0"))
+ESQUEMA_ARCHIVO = os.getenv("PAGOS_PARTICIONES_ESQUEMA_ARCHIVO", "pagos_archivo")
+MANTENIMIENTO_SEGUNDOS = float(os.getenv("PAGOS_PARTICIONES_MANTENIMIENTO_SEGUNDOS", "86400"))
+
+# Tabla -> columna de partición
+TABLAS: Dict[str, str] = {
+    Pago.__tablename__: "creado_en",
+    Transaccion.__tablename__: "creado_en",
+    Conciliacion.__tablename__: "creado_en",
+}
+_MODELOS: Dict[str, Table] = {m.__tablename__: m.__table__ for m in (Pago, Transaccion, Conciliacion)}
+
+
+def inicio_mes(d: date) -> date:
+    return date(d.year, d.month, 1)
+
+
+def sumar_meses(d: date, n: int) -> date:
+    total = d.year * 12 + d.month - 1 + n
+    return date(total // 12, total % 12 + 1, 1)
+
+
+def meses(desde: date, hasta: date) -> Iterator[date]:
+    """Primer día de cada mes entre `desde` y `hasta`, inclusive."""
+    mes = inicio_mes(desde)
+    while mes <= hasta:
+        yield mes
+        mes = sumar_meses(mes, 1)
+
+
+def nombre_particion(tabla: str, mes: date) -> str:
+    return f"{tabla}_p{mes:%Y%m}"
+
+
+def ddl_particion(tabla: str, mes: date) -> str:
+    return (
+        f"CREATE TABLE IF NOT EXISTS {nombre_particion(tabla, mes)} PARTITION OF {tabla} "
+        f"FOR VALUES FROM ('{mes.isoformat()}') TO ('{sumar_meses(mes, 1).isoformat()}')"
+    )
+
+
+def ddl_conversion(dialect, tabla: str, desde: date, hasta: date) -> List[str]:
+    """Sentencias para convertir `tabla` en particionada (ver docstring del módulo)."""
+    columna = TABLAS[tabla]
+    modelo = _MODELOS[tabla]
+    legacy = f"{tabla}_legacy"
+    sentencias = [
+        f"UPDATE {tabla} SET {columna} = now() AT TIME ZONE 'utc' WHERE {columna} IS NULL",
+        f"ALTER TABLE {tabla} RENAME TO {legacy}",
+        f"CREATE TABLE {tabla} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING STORAGE) PARTITION BY RANGE ({columna})",
+        # La secuencia del id sigue numerando y pasa a la tabla nueva antes del DROP
+        f"ALTER SEQUENCE IF EXISTS {tabla}_id_seq OWNED BY {tabla}.id",
+        f"CREATE TABLE IF NOT EXISTS {tabla}_default PARTITION OF {tabla} DEFAULT",
+    ]
+    sentencias += [ddl_particion(tabla, mes) for mes in meses(desde, hasta)]
+    sentencias += [
+        f"INSERT INTO {tabla} SELECT * FROM {legacy}",
+        f"DROP TABLE {legacy}",
+        f"ALTER TABLE {tabla} ADD PRIMARY KEY (id, {columna})",
+    ]
+    for restriccion in modelo.constraints:
+        if isinstance(restriccion, UniqueConstraint):
+            cols = [c.name for c in restriccion.columns]
+            sentencias.append(
+                f"ALTER TABLE {tabla} ADD CONSTRAINT {tabla}_{'_'.join(cols)}_key UNIQUE ({', '.join(cols + [columna])})"
+            )
+    # Los índices se declaran en el padre y Postgres los replica en cada partición
+    sentencias += [str(CreateIndex(ix).compile(dialect=dialect)) for ix in modelo.indexes]
+    return sentencias
+
+
+def esta_particionada(conn: Connection, tabla: str) -> bool:
+    return bool(
+        conn.execute(
+            text(
+                "SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid "
+                "WHERE c.relname = :t AND c.relnamespace = current_schema()::regnamespace"
+            ),
+            {"t": tabla},
+        ).first()
+    )
+
+
+def particiones(conn: Connection, tabla: str) -> List[str]:
+    return list(
+        conn.execute(
+            text(
+                "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                "JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = :t ORDER BY c.relname"
+            ),
+            {"t": tabla},
+        ).scalars()
+    )
+
+
+def _convertir(engine: Engine, tabla: str, hasta: date) -> None:
+    with engine.begin() as conn:
+        minimo = conn.execute(text(f"SELECT min({TABLAS[tabla]}) FROM {tabla}")).scalar()
+        desde = inicio_mes(minimo.date() if minimo else hasta)
+        for sentencia in ddl_conversion(conn.dialect, tabla, desde, hasta):
+            conn.execute(text(sentencia))
+    logger.info(f"[INFO] Tabla {tabla} convertida a particionada por mes", extra={"service": service_name})
+
+
+def asegurar_particiones(engine: Engine, hoy: date | None = None, adelante: int = MESES_ADELANTE) -> None:
+    """Convierte las tablas pendientes y crea las particiones de los próximos meses."""
+    if engine.dialect.name != "postgresql" or not PARTICIONES_ACTIVAS:
+        return
+    hoy = hoy or datetime.utcnow().date()
+    hasta = sumar_meses(inicio_mes(hoy), adelante)
+    for tabla in TABLAS:
+        with engine.connect() as conn:
+            particionada = esta_particionada(conn, tabla)
+        if not particionada:
+            _convertir(engine, tabla, hasta)
+            continue
+        for mes in meses(hoy, hasta):
+            try:
+                with engine.begin() as conn:
+                    conn.execute(text(ddl_particion(tabla, mes)))
+            except Exception:
+                # Típicamente: la DEFAULT ya tiene filas de ese mes; requiere intervención manual
+                logger.exception(
+                    f"no se pudo crear {nombre_particion(tabla, mes)}", extra={"service": service_name}
+                )
+
+
+def particiones_a_archivar(nombres: List[str], tabla: str, hoy: date, retener_meses: int) -> List[str]:
+    """Particiones mensuales de `tabla` que terminan antes del inicio de la retención."""
+    limite = sumar_meses(inicio_mes(hoy), -retener_meses)
+    patron = re.compile(rf"^{re.escape(tabla)}_p(\d{{4}})(\d{{2}})$")
+    viejas = []
+    for nombre in nombres:
+        m = patron.match(nombre)
+        if m and sumar_meses(date(int(m.group(1)), int(m.group(2)), 1), 1) <= limite:
+            viejas.append(nombre)
+    return viejas
+
+
+def archivar_particiones(engine: Engine, hoy: date | None = None, retener_meses: int = RETENER_MESES) -> List[str]:
+    """DETACH de las particiones vencidas y traslado al esquema de archivo; retorna las movidas."""
+    if engine.dialect.name != "postgresql" or not PARTICIONES_ACTIVAS or retener_meses <= 0:
+        return []
+    hoy = hoy or datetime.utcnow().date()
+    movidas = []
+    for tabla in TABLAS:
+        with engine.connect() as conn:
+            if not esta_particionada(conn, tabla):
+                continue
+            viejas = particiones_a_archivar(particiones(conn, tabla), tabla, hoy, retener_meses)
+        for nombre in viejas:
+            with engine.begin() as conn:
+                conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {ESQUEMA_ARCHIVO}"))
+                conn.execute(text(f"ALTER TABLE {tabla} DETACH PARTITION {nombre}"))
+                conn.execute(text(f"ALTER TABLE {nombre} SET SCHEMA {ESQUEMA_ARCHIVO}"))
+            movidas.append(nombre)
+            logger.info(f"[INFO] Partición {nombre} archivada en {ESQUEMA_ARCHIVO}", extra={"service": service_name})
+    return movidas
+
+
+async def mantener_periodicamente(engine: Engine, intervalo: float = MANTENIMIENTO_SEGUNDOS) -> None:
+    """Particiones por adelantado y archivo de las vencidas, una vez por `intervalo`."""
+    if engine.dialect.name != "postgresql" or not PARTICIONES_ACTIVAS:
+        return
+    from .migrations import con_lock
+
+    def _ciclo() -> None:
+        with con_lock(engine):
+            asegurar_particiones(engine)
+            archivar_particiones(engine)
+
+    while True:
+        await asyncio.sleep(intervalo)
+        try:
+            await asyncio.to_thread(_ciclo)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("mantenimiento de particiones falló", extra={"service": service_name})
@@ -0,0 +1 @@
+"""Service layer package for pagos app."""
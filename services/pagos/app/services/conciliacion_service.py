@@ -0,0 +1,130 @@
+"""
+Reporte de conciliación de pagos.
+
+Una sola consulta con EXISTS correlacionado sobre `conciliaciones` (resuelto
+con el índice por referencia) en lugar de una consulta por pago, leída por
+bloques con un cursor del servidor y emitida como CSV incremental.
+
+Las corridas con `marca` no filtran por `Pago.id > último id`: los ids se
+asignan al insertar pero se confirman en cualquier orden, y un pago con id
+menor que se confirma después de la corrida se perdería. En su lugar cada
+corrida re-escanea una ventana de CONCILIACION_HOLGURA hacia atrás desde el
+corte de la anterior y descarta los pagos ya reportados por la marca
+(`conciliacion_reportados`, que solo guarda los de la ventana). El filtro por
+fecha además permite a Postgres podar las particiones mensuales viejas (ver
+particiones.py). Un pago cuya transacción quede abierta más que la holgura
+no se reporta en corridas incrementales.
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Iterator, Tuple
+
+from sqlalchemy import delete, exists, select
+from sqlalchemy.orm import Session
+
+from ..db import SessionLocal, upsert_insert
+from ..logging_conf import configure_logging
+from ..models import Conciliacion, ConciliacionMarca, ConciliacionReportado, Pago
+
+
+service_name = os.getenv("SERVICE_NAME", "pagos")
+logger = configure_logging(service_name)
+
+ENCABEZADO = "referencia,monto,estatus,conciliado"
+# Filas por bloque leído del cursor (y por chunk de la respuesta)
+CONCILIACION_BLOQUE = int(os.getenv("PAGOS_CONCILIACION_BLOQUE", "1000"))
+# Ventana de re-escaneo bajo el corte de la marca: cubre confirmaciones tardías y relojes de réplicas distintas
+CONCILIACION_HOLGURA = timedelta(hours=float(os.getenv("PAGOS_CONCILIACION_HOLGURA_HORAS", "24")))
+
+
+def _consulta(marca: str | None = None, desde_fecha: datetime | None = None):
+    condiciones = []
+    en_conciliacion = [Conciliacion.referencia == Pago.referencia, Conciliacion.conciliado.is_(True)]
+    if desde_fecha is not None:
+        # Predicados constantes sobre la llave de partición de ambas tablas
+        limite = desde_fecha - CONCILIACION_HOLGURA
+        condiciones.append(Pago.creado_en >= limite)
+        en_conciliacion.append(Conciliacion.creado_en >= limite)
+    if marca:
+        condiciones.append(
+            ~exists().where(ConciliacionReportado.nombre == marca, ConciliacionReportado.pago_id == Pago.id)
+        )
+    conciliado = exists().where(*en_conciliacion)
+    return (
+        select(Pago.id, Pago.referencia, Pago.monto, Pago.estatus, Pago.creado_en, conciliado.label("conciliado"))
+        .where(*condiciones)
+        .order_by(Pago.id)
+    )
+
+
+def marca_actual(db: Session, nombre: str) -> Tuple[int, datetime | None]:
+    fila = db.get(ConciliacionMarca, nombre)
+    return (fila.ultimo_pago_id, fila.ultimo_creado_en) if fila else (0, None)
+
+
+def _registrar_reportados(db: Session, nombre: str, filas, limite: datetime) -> None:
+    """Anota (sin confirmar) los pagos de `filas` que caen en la ventana de la siguiente corrida."""
+    valores = [{"nombre": nombre, "pago_id": f.id, "creado_en": f.creado_en} for f in filas if f.creado_en >= limite]
+    if valores:
+        db.execute(upsert_insert(db)(ConciliacionReportado).on_conflict_do_nothing(), valores)
+
+
+def _avanzar_marca(db: Session, nombre: str, ultimo_id: int, corte: datetime) -> None:
+    """Guarda el corte, purga los reportados fuera de la nueva ventana y confirma todo junto."""
+    ins = upsert_insert(db)(ConciliacionMarca).values(
+        nombre=nombre, ultimo_pago_id=ultimo_id, ultimo_creado_en=corte, actualizado_en=datetime.utcnow()
+    )
+    db.execute(
+        ins.on_conflict_do_update(
+            index_elements=[ConciliacionMarca.nombre],
+            set_={
+                "ultimo_pago_id": ins.excluded.ultimo_pago_id,
+                "ultimo_creado_en": ins.excluded.ultimo_creado_en,
+                "actualizado_en": ins.excluded.actualizado_en,
+            },
+            # Nunca retroceder si otra corrida con la misma marca llegó más lejos
+            where=(ConciliacionMarca.ultimo_creado_en.is_(None)) | (ConciliacionMarca.ultimo_creado_en < ins.excluded.ultimo_creado_en),
+        )
+    )
+    db.execute(
+        delete(ConciliacionReportado).where(
+            ConciliacionReportado.nombre == nombre, ConciliacionReportado.creado_en < corte - CONCILIACION_HOLGURA
+        )
+    )
+    db.commit()
+
+
+def _linea(fila) -> str:
+    return f"{fila.referencia},{fila.monto:.2f},{fila.estatus},{'true' if fila.conciliado else 'false'}\n"
+
+
+def reporte_csv(marca: str | None = None, bloque: int = CONCILIACION_BLOQUE) -> Iterator[str]:
+    """
+    Genera el CSV de conciliación en chunks de `bloque` filas.
+    Con `marca`, solo los pagos que la marca aún no reportó; la marca (y los
+    pagos anotados como reportados) se confirma únicamente si el reporte se
+    consumió completo.
+    """
+    db: Session = SessionLocal()
+    try:
+        desde, desde_fecha = marca_actual(db, marca) if marca else (0, None)
+        # Corte tomado antes de leer: lo confirmado después cae en la ventana de la siguiente corrida
+        corte = datetime.utcnow()
+        yield ENCABEZADO + "\n"
+        ultimo = desde
+        filas = 0
+        resultado = db.execute(_consulta(marca, desde_fecha).execution_options(yield_per=bloque))
+        for particion in resultado.partitions():
+            ultimo = max(ultimo, particion[-1].id)
+            filas += len(particion)
+            if marca:
+                _registrar_reportados(db, marca, particion, corte - CONCILIACION_HOLGURA)
+            yield "".join(map(_linea, particion))
+        if marca:
+            _avanzar_marca(db, marca, ultimo, corte)
+        logger.info(
+            f"[INFO] Conciliación: {filas} pagos" + (f" (marca {marca}: corte {corte.isoformat()})" if marca else ""),
+            extra={"service": service_name},
+        )
+    finally:
+        db.close()
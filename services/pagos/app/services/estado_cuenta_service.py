@@ -0,0 +1,362 @@
+"""
+Conciliación bancaria: cruza un estado de cuenta (CSV u OFX) contra los pagos.
+
+El archivo se parsea en streaming y se procesa por bloques de
+BLOQUE_ESCRITURA movimientos. Por bloque, los pagos candidatos (sin movimiento
+bancario asignado, dentro del rango de fechas del bloque) se cargan con una
+sola consulta que los bloquea (FOR UPDATE SKIP LOCKED: dos importaciones
+concurrentes no asignan el mismo pago), y se arman índices hash por referencia
+y por monto. Cada movimiento se resuelve en memoria en una pasada, con estas
+reglas en orden:
+
+- `exacta`: la referencia coincide con Pago.referencia o con el provider_tx
+  de su transacción, y el monto es igual.
+- `referencia_monto`: la referencia coincide y la diferencia de monto está
+  dentro de la tolerancia.
+- `monto_fecha`: sin referencia. El monto cae dentro de la tolerancia y la
+  fecha dentro de la ventana; se elige el candidato más cercano.
+
+Al cerrar cada bloque sus movimientos se insertan en bloque y los pagos
+conciliados se actualizan con UPDATE ... IN; el anti-join del bloque siguiente
+ya ve esas asignaciones.
+"""
+import csv
+import hashlib
+import io
+import itertools
+import os
+import re
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from typing import IO, Dict, Iterable, Iterator, List, NamedTuple, Tuple
+
+from sqlalchemy import exists, insert, select, update
+from sqlalchemy.orm import Session
+
+from ..logging_conf import configure_logging
+from ..models import Conciliacion, MovimientoBancario, Pago, Transaccion
+
+
+service_name = os.getenv("SERVICE_NAME", "pagos")
+logger = configure_logging(service_name)
+
+# Diferencia de monto aceptada para reglas aproximadas (MXN)
+TOLERANCIA_MONTO = float(os.getenv("PAGOS_CONCILIACION_TOLERANCIA", "1.00"))
+# Días de diferencia aceptados entre fecha bancaria y fecha del pago
+VENTANA_DIAS = int(os.getenv("PAGOS_CONCILIACION_VENTANA_DIAS", "3"))
+BLOQUE_ESCRITURA = 5000
+# Largo de MovimientoBancario.referencia
+_REFERENCIA_MAX = 100
+
+
+class Movimiento(NamedTuple):
+    linea: int
+    fecha: datetime
+    monto: float
+    referencia: str | None
+    descripcion: str | None
+
+
+class Candidato(NamedTuple):
+    referencia: str
+    monto: float
+    fecha: datetime
+
+
+class EstadoCuentaInvalido(ValueError):
+    pass
+
+
+class EstadoCuentaDuplicado(EstadoCuentaInvalido):
+    pass
+
+
+# --- parseo --------------------------------------------------------------
+
+_COLUMNAS = {
+    "fecha": ("fecha", "date", "fecha_operacion", "fecha operacion"),
+    "monto": ("monto", "importe", "amount", "abono", "deposito"),
+    "referencia": ("referencia", "reference", "ref", "clave_rastreo", "clave de rastreo", "fitid"),
+    "descripcion": ("descripcion", "concepto", "description", "memo"),
+}
+_FORMATOS_FECHA = ("%Y-%m-%d", "%d/%m/%Y", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%d-%m-%Y", "%Y%m%d")
+
+
+def _fecha(valor: str) -> datetime:
+    valor = valor.strip()
+    for fmt in _FORMATOS_FECHA:
+        try:
+            return datetime.strptime(valor, fmt)
+        except ValueError:
+            continue
+    raise EstadoCuentaInvalido(f"Fecha inválida: {valor!r}")
+
+
+def _monto(valor: str) -> float:
+    try:
+        return float(valor.strip().replace("$", "").replace(",", ""))
+    except ValueError:
+        raise EstadoCuentaInvalido(f"Monto inválido: {valor!r}") from None
+
+
+def _parsear_csv(texto: IO[str]) -> Iterator[Movimiento]:
+    reader = csv.reader(texto)
+    encabezado = [c.strip().lower() for c in next(reader, [])]
+    idx: Dict[str, int] = {}
+    for campo, alias in _COLUMNAS.items():
+        for i, col in enumerate(encabezado):
+            if col in alias:
+                idx[campo] = i
+                break
+    if "fecha" not in idx or "monto" not in idx:
+        raise EstadoCuentaInvalido("El CSV requiere columnas de fecha y monto")
+    i_ref, i_desc = idx.get("referencia"), idx.get("descripcion")
+    for n, fila in enumerate(reader, start=2):
+        if not fila or not any(c.strip() for c in fila):
+            continue
+        try:
+            yield Movimiento(
+                linea=n,
+                fecha=_fecha(fila[idx["fecha"]]),
+                monto=_monto(fila[idx["monto"]]),
+                referencia=(fila[i_ref].strip() or None) if i_ref is not None else None,
+                descripcion=(fila[i_desc].strip() or None) if i_desc is not None else None,
+            )
+        except IndexError:
+            raise EstadoCuentaInvalido(f"Línea {n}: columnas faltantes") from None
+
+
+_OFX_TRN = re.compile(r"<STMTTRN>(.*?)(?:</STMTTRN>|(?=<STMTTRN>)|(?=</BANKTRANLIST>))", re.S | re.I)
+_OFX_TAG = re.compile(r"<(\w+)>([^<\r\n]*)")
+
+
+def _parsear_ofx(texto: str) -> Iterator[Movimiento]:
+    # OFX 1.x (SGML, sin cierres) y 2.x (XML) comparten las etiquetas de hoja
+    for n, bloque in enumerate(_OFX_TRN.finditer(texto), start=1):
+        tags = {k.upper(): v.strip() for k, v in _OFX_TAG.findall(bloque.group(1))}
+        if "DTPOSTED" not in tags or "TRNAMT" not in tags:
+            raise EstadoCuentaInvalido(f"Transacción OFX {n} sin DTPOSTED/TRNAMT")
+        yield Movimiento(
+            linea=n,
+            fecha=_fecha(tags["DTPOSTED"][:8]),
+            monto=_monto(tags["TRNAMT"]),
+            referencia=tags.get("REFNUM") or tags.get("CHECKNUM") or tags.get("FITID") or None,
+            descripcion=tags.get("MEMO") or tags.get("NAME") or None,
+        )
+
+
+def parsear_estado_cuenta(raw: IO[bytes], nombre: str = "") -> Iterator[Movimiento]:
+    """Detecta el formato por extensión o contenido (OFX/CSV) y genera los movimientos."""
+    inicio = raw.read(512)
+    raw.seek(0)
+    es_ofx = nombre.lower().endswith((".ofx", ".qfx")) or b"<OFX>" in inicio.upper() or b"OFXHEADER" in inicio.upper()
+    if es_ofx:
+        return _parsear_ofx(raw.read().decode("utf-8", errors="replace"))
+    return _parsear_csv(io.TextIOWrapper(raw, encoding="utf-8-sig", newline=""))
+
+
+# --- matching ------------------------------------------------------------
+
+
+def _centavos(monto: float) -> int:
+    return int(round(monto * 100))
+
+
+class Indices:
+    """
+    Índices hash sobre los pagos candidatos: por referencia (y provider_tx) y
+    por monto exacto en centavos, cada uno con su lista ordenada por fecha
+    para buscar el más cercano con bisect. Un pago se asigna a lo más una vez.
+    """
+
+    def __init__(self, candidatos: Iterable[Tuple[Candidato, str | None]], tolerancia: float) -> None:
+        self.tolerancia = tolerancia
+        self.por_referencia: Dict[str, Candidato] = {}
+        self.usados: set[str] = set()
+        self._candidatos: Dict[str, Candidato] = {}
+        self._por_centavos: Dict[int, List[Tuple[datetime, str]]] = defaultdict(list)
+        for cand, alterna in candidatos:
+            if cand.referencia not in self._candidatos:
+                self._candidatos[cand.referencia] = cand
+                self._por_centavos[_centavos(cand.monto)].append((cand.fecha, cand.referencia))
+            self.por_referencia[cand.referencia] = cand
+            if alterna:
+                self.por_referencia[alterna] = cand
+        for lista in self._por_centavos.values():
+            lista.sort()
+        self._montos = sorted(self._por_centavos)
+
+    def por_ref(self, referencia: str | None) -> Candidato | None:
+        if not referencia:
+            return None
+        cand = self.por_referencia.get(referencia)
+        return cand if cand is not None and cand.referencia not in self.usados else None
+
+    def usar(self, cand: Candidato) -> None:
+        self.usados.add(cand.referencia)
+        lista = self._por_centavos[_centavos(cand.monto)]
+        i = bisect_left(lista, (cand.fecha, cand.referencia))
+        if i < len(lista) and lista[i][1] == cand.referencia:
+            del lista[i]
+
+    def por_monto_fecha(self, monto: float, fecha: datetime, ventana: timedelta) -> Candidato | None:
+        """Candidato con el monto más parecido (dentro de tolerancia) y, a igual monto, la fecha más cercana."""
+        c = _centavos(monto)
+        tol = _centavos(self.tolerancia)
+        montos = self._montos[bisect_left(self._montos, c - tol) : bisect_right(self._montos, c + tol)]
+        for m in sorted(montos, key=lambda m: abs(m - c)):
+            lista = self._por_centavos[m]
+            i = bisect_left(lista, (fecha,))
+            cercano = min(
+                (lista[j] for j in (i - 1, i) if 0 <= j < len(lista)),
+                key=lambda x: abs(x[0] - fecha),
+                default=None,
+            )
+            if cercano is not None and abs(cercano[0] - fecha) <= ventana:
+                return self._candidatos[cercano[1]]
+        return None
+
+
+def emparejar(
+    movimientos: Iterable[Movimiento],
+    indices: Indices,
+    ventana: timedelta,
+) -> Iterator[Tuple[Movimiento, str | None, str | None]]:
+    """Genera (movimiento, referencia del pago, regla) en una sola pasada."""
+    for mov in movimientos:
+        if mov.monto <= 0:
+            # Cargos/retiros: no corresponden a pagos de clientes
+            yield mov, None, None
+            continue
+        cand = indices.por_ref(mov.referencia)
+        regla = None
+        if cand is not None:
+            dif = abs(cand.monto - mov.monto)
+            if dif < 0.005:
+                regla = "exacta"
+            elif dif <= indices.tolerancia + 1e-9:
+                regla = "referencia_monto"
+            else:
+                cand = None
+        if cand is None:
+            cand = indices.por_monto_fecha(mov.monto, mov.fecha, ventana)
+            regla = "monto_fecha" if cand is not None else None
+        if cand is None:
+            yield mov, None, None
+            continue
+        indices.usar(cand)
+        yield mov, cand.referencia, regla
+
+
+def _consulta_candidatos(desde: datetime, hasta: datetime):
+    asignado = exists().where(MovimientoBancario.pago_ref == Pago.referencia)
+    return (
+        select(Pago.referencia, Pago.monto, Pago.creado_en, Transaccion.provider_tx)
+        # La transacción se crea junto con el pago: el rango de fechas poda también sus particiones
+        .outerjoin(
+            Transaccion,
+            (Transaccion.pago_ref == Pago.referencia) & (Transaccion.creado_en >= desde - timedelta(days=1)),
+        )
+        .where(Pago.creado_en >= desde, Pago.creado_en <= hasta, ~asignado)
+        # Los pagos que otra importación en curso ya tomó se omiten en vez de esperarla
+        .with_for_update(skip_locked=True, of=Pago)
+        .execution_options(yield_per=BLOQUE_ESCRITURA)
+    )
+
+
+def _cargar_candidatos(db: Session, desde: datetime, hasta: datetime) -> Iterator[Tuple[Candidato, str | None]]:
+    """Pagos sin movimiento bancario asignado dentro del rango, con su provider_tx, bloqueados hasta el commit."""
+    for fila in db.execute(_consulta_candidatos(desde, hasta)):
+        yield Candidato(fila.referencia, float(fila.monto), fila.creado_en), fila.provider_tx
+
+
+def _bloques(filas: Iterable, n: int) -> Iterator[List]:
+    it = iter(filas)
+    while bloque := list(itertools.islice(it, n)):
+        yield bloque
+
+
+def _conciliar_bloque(
+    db: Session,
+    movimientos: List[Movimiento],
+    archivo_hash: str,
+    ahora: datetime,
+    tolerancia: float,
+    ventana: timedelta,
+) -> Counter:
+    """Empareja e inserta un bloque de movimientos; retorna el conteo por regla."""
+    desde = min(m.fecha for m in movimientos) - ventana
+    hasta = max(m.fecha for m in movimientos) + ventana + timedelta(days=1)
+    indices = Indices(_cargar_candidatos(db, desde, hasta), tolerancia)
+
+    filas = []
+    reglas: Counter = Counter()
+    conciliados: List[str] = []
+    for mov, pago_ref, regla in emparejar(movimientos, indices, ventana):
+        filas.append(
+            {
+                "archivo_hash": archivo_hash,
+                "linea": mov.linea,
+                "fecha": mov.fecha,
+                "monto": mov.monto,
+                # Una referencia más larga que la columna no coincide con ningún pago; se guarda truncada
+                "referencia": (mov.referencia or "")[:_REFERENCIA_MAX] or None,
+                "descripcion": (mov.descripcion or "")[:255] or None,
+                "pago_ref": pago_ref,
+                "regla": regla,
+                "creado_en": ahora,
+            }
+        )
+        if pago_ref:
+            reglas[regla] += 1
+            conciliados.append(pago_ref)
+
+    db.execute(insert(MovimientoBancario), filas)
+    for bloque in _bloques(conciliados, 1000):
+        db.execute(update(Pago).where(Pago.referencia.in_(bloque)).values(estatus="conciliado"))
+        db.execute(update(Conciliacion).where(Conciliacion.referencia.in_(bloque)).values(conciliado=True))
+    return reglas
+
+
+def conciliar_estado_cuenta(
+    db: Session,
+    raw: IO[bytes],
+    nombre: str = "",
+    tolerancia: float = TOLERANCIA_MONTO,
+    ventana_dias: int = VENTANA_DIAS,
+) -> Dict:
+    """
+    Importa y concilia un estado de cuenta. No hace commit: el llamador
+    controla la transacción. Lanza EstadoCuentaInvalido si el archivo no se
+    puede interpretar y EstadoCuentaDuplicado si ya se importó (mismo hash).
+    """
+    h = hashlib.sha256()
+    for bloque in iter(lambda: raw.read(1024 * 1024), b""):
+        h.update(bloque)
+    archivo_hash = h.hexdigest()
+    raw.seek(0)
+    if db.execute(select(MovimientoBancario.id).where(MovimientoBancario.archivo_hash == archivo_hash).limit(1)).first():
+        raise EstadoCuentaDuplicado("Estado de cuenta ya importado")
+
+    ventana = timedelta(days=ventana_dias)
+    ahora = datetime.utcnow()
+    movimientos = 0
+    reglas: Counter = Counter()
+    for bloque in _bloques(parsear_estado_cuenta(raw, nombre), BLOQUE_ESCRITURA):
+        movimientos += len(bloque)
+        reglas.update(_conciliar_bloque(db, bloque, archivo_hash, ahora, tolerancia, ventana))
+    conciliados = sum(reglas.values())
+    if not movimientos:
+        return {"archivo_hash": archivo_hash, "movimientos": 0, "conciliados": {}, "sin_conciliar": 0}
+
+    logger.info(
+        f"[INFO] Estado de cuenta {archivo_hash[:12]}: {conciliados}/{movimientos} movimientos conciliados",
+        extra={"service": service_name},
+    )
+    return {
+        "archivo_hash": archivo_hash,
+        "movimientos": movimientos,
+        "conciliados": dict(reglas),
+        "sin_conciliar": movimientos - conciliados,
+    }
@@ -0,0 +1,156 @@
+"""
+Outbox transaccional de eventos de dominio de pagos.
+
+Quien registra un pago escribe también su evento en `eventos_outbox`, en el
+mismo commit: si el pago existe, su evento existe. Un relay asyncio toma lotes
+en orden de id (FOR UPDATE SKIP LOCKED, para varias réplicas), los publica en
+el EventBus (Kafka y/o el log en archivo) y borra las filas en la misma
+transacción después de la confirmación del bus.
+
+Entrega al menos una vez: si el bus confirma pero el commit falla, el lote se
+vuelve a publicar. Por eso cada payload lleva `evento_id` y los consumidores
+deben deduplicar con él. Los eventos van con el cliente como llave, así que
+Kafka conserva el orden por cliente.
+"""
+import asyncio
+import json
+import os
+from datetime import datetime
+from typing import Any, Dict, Iterable
+from uuid import uuid4
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
+
+from ..db import SessionLocal
+from ..events import EventBus, event_bus
+from ..logging_conf import configure_logging
+from ..models import EventoOutbox
+
+
+service_name = os.getenv("SERVICE_NAME", "pagos")
+logger = configure_logging(service_name)
+
+EVENTOS_BATCH = int(os.getenv("PAGOS_EVENTOS_BATCH", "500"))
+EVENTOS_POLL_SEGUNDOS = float(os.getenv("PAGOS_EVENTOS_POLL_SEGUNDOS", "1.0"))
+EVENTOS_REINTENTO_SEGUNDOS = float(os.getenv("PAGOS_EVENTOS_REINTENTO_SEGUNDOS", "5.0"))
+EVENTOS_TIMEOUT_SEGUNDOS = float(os.getenv("PAGOS_EVENTOS_TIMEOUT_SEGUNDOS", "30"))
+
+PAGO_REGISTRADO = "PagoRegistrado"
+
+
+def evento_pago(pago: Any) -> Dict[str, Any]:
+    """Payload de PagoRegistrado desde un Pago o un dict con sus columnas."""
+    get = pago.get if isinstance(pago, dict) else lambda k: getattr(pago, k)
+    creado_en = get("creado_en") or datetime.utcnow()
+    return {
+        "evento_id": str(uuid4()),
+        "referencia": get("referencia"),
+        "cliente_id": get("cliente_id"),
+        "monto": get("monto"),
+        "metodo": get("metodo"),
+        "estatus": get("estatus"),
+        "factura_uuid": get("factura_uuid"),
+        "creado_en": creado_en.isoformat(),
+    }
+
+
+def registrar(db: Session, topic: str, payloads: Iterable[Dict[str, Any]]) -> int:
+    """Escribe los eventos en el outbox dentro de la transacción del llamador."""
+    ahora = datetime.utcnow()
+    filas = [
+        {
+            "topic": topic,
+            "clave": str(p["cliente_id"]) if p.get("cliente_id") is not None else None,
+            "payload": json.dumps(p),
+            "creado_en": ahora,
+        }
+        for p in payloads
+    ]
+    if filas:
+        db.execute(insert(EventoOutbox), filas)
+    return len(filas)
+
+
+class RelayEventos:
+    """Tarea asyncio que publica el outbox en el bus por lotes."""
+
+    def __init__(
+        self,
+        bus: EventBus = event_bus,
+        batch: int = EVENTOS_BATCH,
+        poll_segundos: float = EVENTOS_POLL_SEGUNDOS,
+    ) -> None:
+        self.bus = bus
+        self.batch = batch
+        self.poll_segundos = poll_segundos
+        self._task: asyncio.Task | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._despertar: asyncio.Event | None = None
+
+    async def start(self) -> None:
+        await self.bus.start()
+        self._loop = asyncio.get_running_loop()
+        self._despertar = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.bus.stop()
+
+    def despertar(self) -> None:
+        """Adelanta la siguiente publicación; seguro de llamar desde el threadpool."""
+        if self._loop is not None and self._despertar is not None:
+            self._loop.call_soon_threadsafe(self._despertar.set)
+
+    def _publicar_lote(self) -> int:
+        # Todo en el mismo hilo y la misma transacción: el lock de las filas dura
+        # hasta que el bus confirma y se borran
+        db: Session = SessionLocal()
+        try:
+            filas = (
+                db.execute(
+                    select(EventoOutbox).order_by(EventoOutbox.id).limit(self.batch).with_for_update(skip_locked=True)
+                )
+                .scalars()
+                .all()
+            )
+            if not filas:
+                return 0
+            eventos = [(f.topic, f.clave, json.loads(f.payload)) for f in filas]
+            asyncio.run_coroutine_threadsafe(self.bus.publicar_lote(eventos), self._loop).result(EVENTOS_TIMEOUT_SEGUNDOS)
+            db.execute(delete(EventoOutbox).where(EventoOutbox.id.in_([f.id for f in filas])))
+            db.commit()
+            logger.info(f"[INFO] Outbox eventos: {len(filas)} publicados", extra={"service": service_name})
+            return len(filas)
+        finally:
+            db.close()
+
+    async def publicar_una_vez(self) -> int:
+        """Publica un lote; retorna los eventos confirmados."""
+        self._loop = asyncio.get_running_loop()
+        return await asyncio.to_thread(self._publicar_lote)
+
+    async def _run(self) -> None:
+        while True:
+            espera = self.poll_segundos
+            try:
+                publicados = await self.publicar_una_vez()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("relay de eventos falló", extra={"service": service_name})
+                publicados, espera = 0, EVENTOS_REINTENTO_SEGUNDOS
+            # Lote completo: probablemente queda trabajo, seguir sin esperar
+            if publicados < self.batch:
+                try:
+                    await asyncio.wait_for(self._despertar.wait(), espera)
+                except asyncio.TimeoutError:
+                    pass
+                self._despertar.clear()
+
+
+relay_eventos = RelayEventos()
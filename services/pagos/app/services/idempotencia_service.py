@@ -0,0 +1,145 @@
+"""
+Idempotencia de /pagos/procesar en dos niveles frente a `idem_pagos`.
+
+1. LRU en proceso con TTL: los reintentos en ráfaga de una pasarela contra
+   la misma réplica no tocan la base.
+2. Cache compartida opcional entre réplicas (`PAGOS_IDEM_BACKEND`):
+   - "local": stand-in en proceso, para dev y tests
+   - "redis://...": requiere el paquete redis
+   - vacío: desactivada
+
+La fuente de verdad sigue siendo `idem_pagos`: la llave se inserta con la
+respuesta en la misma transacción que el pago (ver main.procesar_pago), así
+que no hay ventana entre ambos commits. Un fallo de la cache compartida
+nunca bloquea un pago; solo se registra y se cae a la base.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Protocol
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from ..logging_conf import configure_logging
+from ..models import IdempotencyKey
+
+# Optional deps: redis para la cache compartida
+try:
+    import redis  # type: ignore
+except Exception:  # pragma: no cover - tolerate missing redis
+    redis = None
+
+
+service_name = os.getenv("SERVICE_NAME", "pagos")
+logger = configure_logging(service_name)
+
+IDEM_LRU_MAX = int(os.getenv("PAGOS_IDEM_LRU_MAX", "10000"))
+IDEM_TTL_SEGUNDOS = float(os.getenv("PAGOS_IDEM_TTL_SEGUNDOS", "86400"))
+IDEM_BACKEND = os.getenv("PAGOS_IDEM_BACKEND", "")
+
+
+class Backend(Protocol):
+    def get(self, key: str) -> str | None: ...
+
+    def set(self, key: str, valor: str) -> None: ...
+
+
+class CacheLRU:
+    """LRU con TTL thread-safe; también sirve como backend compartido local."""
+
+    def __init__(self, max_items: int = IDEM_LRU_MAX, ttl: float = IDEM_TTL_SEGUNDOS) -> None:
+        self.max_items = max_items
+        self.ttl = ttl
+        self._datos: "OrderedDict[str, tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            item = self._datos.get(key)
+            if item is None:
+                return None
+            expira, valor = item
+            if expira < time.monotonic():
+                del self._datos[key]
+                return None
+            self._datos.move_to_end(key)
+            return valor
+
+    def set(self, key: str, valor: str) -> None:
+        with self._lock:
+            self._datos[key] = (time.monotonic() + self.ttl, valor)
+            self._datos.move_to_end(key)
+            while len(self._datos) > self.max_items:
+                self._datos.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._datos.clear()
+
+
+class BackendRedis:
+    def __init__(self, url: str, ttl: float = IDEM_TTL_SEGUNDOS) -> None:
+        self._r = redis.Redis.from_url(url, socket_timeout=0.2, socket_connect_timeout=0.2)
+        self.ttl = int(ttl)
+
+    def get(self, key: str) -> str | None:
+        valor = self._r.get(f"pagos:idem:{key}")
+        return valor.decode("utf-8") if valor is not None else None
+
+    def set(self, key: str, valor: str) -> None:
+        self._r.set(f"pagos:idem:{key}", valor, ex=self.ttl)
+
+
+def crear_backend(url: str = IDEM_BACKEND) -> Backend | None:
+    if not url:
+        return None
+    if url == "local":
+        return CacheLRU()
+    if url.startswith(("redis://", "rediss://")):
+        if redis is None:
+            logger.warning("[WARN] PAGOS_IDEM_BACKEND=redis sin paquete redis; cache compartida desactivada", extra={"service": service_name})
+            return None
+        return BackendRedis(url)
+    raise ValueError(f"Backend de idempotencia no soportado: {url}")
+
+
+lru = CacheLRU()
+compartido: Backend | None = crear_backend()
+
+
+def _compartido_get(key: str) -> str | None:
+    if compartido is None:
+        return None
+    try:
+        return compartido.get(key)
+    except Exception as exc:
+        logger.warning("cache de idempotencia no disponible", extra={"service": service_name, "error": str(exc)})
+        return None
+
+
+def recordar(key: str, respuesta: str) -> None:
+    """Publica en ambos niveles una respuesta ya confirmada en la base."""
+    lru.set(key, respuesta)
+    if compartido is not None:
+        try:
+            compartido.set(key, respuesta)
+        except Exception as exc:
+            logger.warning("cache de idempotencia no disponible", extra={"service": service_name, "error": str(exc)})
+
+
+def buscar(db: Session, key: str) -> Dict[str, Any] | None:
+    """Respuesta guardada para `key`: LRU, luego cache compartida, luego `idem_pagos`."""
+    valor = lru.get(key)
+    if valor is None:
+        valor = _compartido_get(key)
+        if valor is not None:
+            lru.set(key, valor)
+    if valor is None:
+        valor = db.execute(select(IdempotencyKey.response).where(IdempotencyKey.key == key)).scalar_one_or_none()
+        if valor is None:
+            return None
+        recordar(key, valor)
+    return json.loads(valor)
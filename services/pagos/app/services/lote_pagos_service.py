@@ -0,0 +1,235 @@
+"""
+Importación masiva de pagos (archivos diarios de socios de cobranza).
+
+El archivo (CSV con encabezado o NDJSON, una fila por pago) se lee en
+streaming y se procesa por bloques. Cada bloque hace un solo SELECT ... IN
+para detectar referencias ya importadas y luego un INSERT multi-fila por
+tabla (Pago, Transaccion, Conciliacion, el outbox de eventos y, si hay
+factura, el outbox de avisos). Después se hace commit: un error de base solo pierde el bloque en
+curso.
+
+Campos por fila: cliente_id, monto, metodo (opcional, "spei"), factura_uuid
+(opcional), referencia (opcional; si el socio la manda, reimportar el mismo
+archivo no duplica pagos) y provider_tx (opcional, folio del socio).
+"""
+import codecs
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from typing import IO, Any, Dict, Iterator, List, Tuple
+from uuid import uuid4
+
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+
+from ..db import upsert_insert
+from ..logging_conf import configure_logging
+from ..models import Conciliacion, FacturaPagadaOutbox, Pago, PagoReferencia, Transaccion
+from . import eventos_outbox_service as eventos_outbox
+
+
+service_name = os.getenv("SERVICE_NAME", "pagos")
+logger = configure_logging(service_name)
+
+# Filas por bloque: un SELECT IN (...), un INSERT por tabla y un commit
+LOTE_CHUNK_SIZE = int(os.getenv("PAGOS_LOTE_CHUNK", "2000"))
+
+
+class LoteInvalido(ValueError):
+    pass
+
+
+def _es_ndjson(raw: IO[bytes], nombre: str, content_type: str) -> bool:
+    if "ndjson" in content_type or "jsonl" in content_type or nombre.lower().endswith((".ndjson", ".jsonl")):
+        return True
+    if "csv" in content_type or nombre.lower().endswith(".csv"):
+        return False
+    # Sin pistas: se decide por el primer carácter no blanco
+    inicio = raw.read(64)
+    raw.seek(0)
+    return inicio.lstrip(codecs.BOM_UTF8 + b" \t\r\n")[:1] == b"{"
+
+
+def parsear_lote(raw: IO[bytes], nombre: str = "", content_type: str = "") -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """Genera (linea, fila) sin cargar el archivo completo en memoria."""
+    ndjson = _es_ndjson(raw, nombre, content_type)
+    texto = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+    if ndjson:
+        for linea, renglon in enumerate(texto, start=1):
+            if not renglon.strip():
+                continue
+            try:
+                fila = json.loads(renglon)
+            except ValueError:
+                fila = None
+            # Una línea ilegible se reporta como error de esa fila
+            yield linea, fila if isinstance(fila, dict) else {"_error": "JSON inválido"}
+        return
+    reader = csv.DictReader(texto)
+    if not reader.fieldnames or not {"cliente_id", "monto"} <= {c.strip() for c in reader.fieldnames}:
+        raise LoteInvalido("El CSV debe incluir encabezado con cliente_id y monto")
+    for fila in reader:
+        # La línea 1 es el encabezado
+        yield reader.line_num, {(k or "").strip(): v for k, v in fila.items()}
+
+
+def _texto(fila: Dict[str, Any], campo: str, largo: int) -> str | None:
+    valor = fila.get(campo)
+    if valor is None:
+        return None
+    valor = str(valor).strip()
+    if len(valor) > largo:
+        raise ValueError(f"{campo} excede {largo} caracteres")
+    return valor or None
+
+
+def _validar(fila: Dict[str, Any]) -> Dict[str, Any]:
+    if "_error" in fila:
+        raise ValueError(fila["_error"])
+    try:
+        cliente_id = int(fila.get("cliente_id"))
+        monto = float(fila.get("monto"))
+    except (TypeError, ValueError):
+        raise ValueError("cliente_id y monto son obligatorios y numéricos")
+    if cliente_id < 1:
+        raise ValueError("cliente_id inválido")
+    if not monto >= 0:
+        raise ValueError("Monto negativo")
+    return {
+        "cliente_id": cliente_id,
+        "monto": monto,
+        "metodo": _texto(fila, "metodo", 30) or "spei",
+        "factura_uuid": _texto(fila, "factura_uuid", 64),
+        "referencia": _texto(fila, "referencia", 100),
+        "provider_tx": _texto(fila, "provider_tx", 100),
+    }
+
+
+def _procesar_chunk(db: Session, filas: List[Tuple[int, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    resultados: List[Dict[str, Any]] = []
+    validas: List[Tuple[int, Dict[str, Any]]] = []
+    for linea, fila in filas:
+        try:
+            validas.append((linea, _validar(fila)))
+        except ValueError as exc:
+            resultados.append({"linea": linea, "estatus": "error", "detalle": str(exc)})
+
+    externas = {v["referencia"] for _, v in validas if v["referencia"]}
+    existentes = set()
+    if externas:
+        existentes = set(
+            db.execute(select(PagoReferencia.referencia).where(PagoReferencia.referencia.in_(externas))).scalars()
+        )
+
+    ahora = datetime.utcnow()
+    pagos: Dict[str, Dict[str, Any]] = {}
+    detalles: Dict[str, Dict[str, Any]] = {}
+    lineas: Dict[str, int] = {}
+    for linea, v in validas:
+        referencia = v["referencia"] or str(uuid4())
+        if referencia in existentes or referencia in pagos:
+            resultados.append({"linea": linea, "estatus": "duplicado", "referencia": referencia})
+            continue
+        conciliado = v["factura_uuid"] is not None
+        pagos[referencia] = {
+            "referencia": referencia,
+            "metodo": v["metodo"],
+            "monto": v["monto"],
+            "cliente_id": v["cliente_id"],
+            "estatus": "conciliado" if conciliado else "confirmado",
+            "factura_uuid": v["factura_uuid"],
+            "creado_en": ahora,
+        }
+        detalles[referencia] = v
+        lineas[referencia] = linea
+
+    if pagos:
+        # Reservar en pagos_referencias (PK global, también con particiones): una
+        # importación concurrente del mismo archivo espera el commit y no obtiene
+        # la referencia en el RETURNING
+        insertadas = set(
+            db.execute(
+                upsert_insert(db)(PagoReferencia.__table__)
+                .on_conflict_do_nothing(index_elements=["referencia"])
+                .returning(PagoReferencia.__table__.c.referencia),
+                [{"referencia": r, "creado_en": ahora} for r in pagos],
+            ).scalars()
+        )
+        nuevas = [r for r in pagos if r in insertadas]
+        if nuevas:
+            db.execute(insert(Pago.__table__), [pagos[r] for r in nuevas])
+            db.execute(
+                insert(Transaccion),
+                [
+                    {
+                        "pago_ref": r,
+                        "provider": detalles[r]["metodo"].upper(),
+                        "provider_tx": detalles[r]["provider_tx"] or str(uuid4()),
+                        "exitoso": True,
+                        "creado_en": ahora,
+                    }
+                    for r in nuevas
+                ],
+            )
+            db.execute(
+                insert(Conciliacion),
+                [{"referencia": r, "conciliado": pagos[r]["factura_uuid"] is not None, "creado_en": ahora} for r in nuevas],
+            )
+            avisos = [
+                {"factura_uuid": pagos[r]["factura_uuid"], "pago_ref": r, "proximo_intento": ahora, "creado_en": ahora}
+                for r in nuevas
+                if pagos[r]["factura_uuid"] is not None
+            ]
+            if avisos:
+                db.execute(insert(FacturaPagadaOutbox), avisos)
+            eventos_outbox.registrar(
+                db, eventos_outbox.PAGO_REGISTRADO, (eventos_outbox.evento_pago(pagos[r]) for r in nuevas)
+            )
+        for r, linea in lineas.items():
+            estatus = "ok" if r in insertadas else "duplicado"
+            resultados.append({"linea": linea, "estatus": estatus, "referencia": r})
+
+    resultados.sort(key=lambda x: x["linea"])
+    return resultados
+
+
+def importar_lote(
+    db: Session,
+    raw: IO[bytes],
+    nombre: str = "",
+    content_type: str = "",
+    chunk_size: int = LOTE_CHUNK_SIZE,
+) -> Dict[str, Any]:
+    """
+    Importa el archivo haciendo commit por bloque. Lanza LoteInvalido si el
+    formato no se reconoce. Retorna totales y el resultado de cada fila.
+    """
+    resultados: List[Dict[str, Any]] = []
+    chunk: List[Tuple[int, Dict[str, Any]]] = []
+    for item in parsear_lote(raw, nombre, content_type):
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            resultados += _procesar_chunk(db, chunk)
+            db.commit()
+            chunk = []
+    if chunk:
+        resultados += _procesar_chunk(db, chunk)
+        db.commit()
+
+    totales = {"ok": 0, "duplicado": 0, "error": 0}
+    for r in resultados:
+        totales[r["estatus"]] += 1
+    logger.info(
+        f"[INFO] Lote de pagos {nombre or '-'}: {totales['ok']} nuevos, "
+        f"{totales['duplicado']} duplicados, {totales['error']} con error",
+        extra={"service": service_name},
+    )
+    return {
+        "procesados": len(resultados),
+        "exitosos": totales["ok"],
+        "duplicados": totales["duplicado"],
+        "fallidos": totales["error"],
+        "resultados": resultados,
+    }
@@ -0,0 +1,221 @@
+"""
+Outbox de avisos "factura pagada" hacia facturación.
+
+`crear_pago` solo inserta la fila del outbox en la misma transacción que el
+pago; un despachador asyncio reclama lotes de avisos pendientes y los envía
+en una sola llamada a `PATCH /facturacion/pagar-lote`, con un
+httpx.AsyncClient compartido (keep-alive). La latencia de un pago ya no
+depende de la de facturación, y si facturación no responde los avisos se
+reintentan con backoff exponencial.
+
+El reclamo usa FOR UPDATE SKIP LOCKED más un lease (`proximo_intento`
+adelantado), así la transacción no queda abierta durante la llamada HTTP y
+varias réplicas pueden despachar a la vez.
+"""
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import Iterable, List
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.orm import Session
+
+from ..db import SessionLocal
+from ..logging_conf import configure_logging
+from ..models import FacturaPagadaOutbox
+
+# Optional deps for local testing: httpx
+try:
+    import httpx  # type: ignore
+except Exception:  # pragma: no cover - tolerate missing httpx in unit envs
+    httpx = None
+
+
+service_name = os.getenv("SERVICE_NAME", "pagos")
+logger = configure_logging(service_name)
+
+FACTURACION_URL = os.getenv("FACTURACION_URL", "http://facturacion:8002")
+OUTBOX_BATCH = int(os.getenv("PAGOS_OUTBOX_BATCH", "200"))
+OUTBOX_POLL_SEGUNDOS = float(os.getenv("PAGOS_OUTBOX_POLL_SEGUNDOS", "1.0"))
+OUTBOX_LEASE_SEGUNDOS = float(os.getenv("PAGOS_OUTBOX_LEASE_SEGUNDOS", "30"))
+OUTBOX_MAX_INTENTOS = int(os.getenv("PAGOS_OUTBOX_MAX_INTENTOS", "10"))
+OUTBOX_BACKOFF_SEGUNDOS = float(os.getenv("PAGOS_OUTBOX_BACKOFF_SEGUNDOS", "2.0"))
+OUTBOX_BACKOFF_MAX_SEGUNDOS = float(os.getenv("PAGOS_OUTBOX_BACKOFF_MAX_SEGUNDOS", "300"))
+FACTURACION_MAX_CONEXIONES = int(os.getenv("PAGOS_FACTURACION_MAX_CONEXIONES", "20"))
+FACTURACION_TIMEOUT_SEGUNDOS = float(os.getenv("PAGOS_FACTURACION_TIMEOUT_SEGUNDOS", "10"))
+
+
+def encolar(db: Session, factura_uuid: str, pago_ref: str) -> None:
+    """Registra el aviso dentro de la transacción del llamador."""
+    db.add(FacturaPagadaOutbox(factura_uuid=factura_uuid, pago_ref=pago_ref))
+
+
+def _backoff(intentos: int) -> timedelta:
+    segundos = min(OUTBOX_BACKOFF_SEGUNDOS * (2 ** (intentos - 1)), OUTBOX_BACKOFF_MAX_SEGUNDOS)
+    return timedelta(seconds=segundos)
+
+
+def reclamar(limite: int = OUTBOX_BATCH) -> List:
+    """Reclama hasta `limite` avisos vencidos y les da un lease; retorna (id, factura_uuid)."""
+    db: Session = SessionLocal()
+    try:
+        ahora = datetime.utcnow()
+        filas = db.execute(
+            select(FacturaPagadaOutbox.id, FacturaPagadaOutbox.factura_uuid)
+            .where(FacturaPagadaOutbox.estatus == "pendiente", FacturaPagadaOutbox.proximo_intento <= ahora)
+            .order_by(FacturaPagadaOutbox.proximo_intento)
+            .limit(limite)
+            .with_for_update(skip_locked=True)
+        ).all()
+        if filas:
+            db.execute(
+                update(FacturaPagadaOutbox)
+                .where(FacturaPagadaOutbox.id.in_([f.id for f in filas]))
+                .values(proximo_intento=ahora + timedelta(seconds=OUTBOX_LEASE_SEGUNDOS))
+            )
+        db.commit()
+        return filas
+    finally:
+        db.close()
+
+
+def confirmar(ids: Iterable[int]) -> None:
+    ids = list(ids)
+    if not ids:
+        return
+    db: Session = SessionLocal()
+    try:
+        db.execute(delete(FacturaPagadaOutbox).where(FacturaPagadaOutbox.id.in_(ids)))
+        db.commit()
+    finally:
+        db.close()
+
+
+def reprogramar(ids: Iterable[int], error: str) -> None:
+    """Suma un intento y aplica backoff; al agotar intentos el aviso queda `fallido`."""
+    ids = list(ids)
+    if not ids:
+        return
+    db: Session = SessionLocal()
+    try:
+        ahora = datetime.utcnow()
+        filas = db.execute(
+            select(FacturaPagadaOutbox).where(FacturaPagadaOutbox.id.in_(ids)).with_for_update()
+        ).scalars()
+        for fila in filas:
+            fila.intentos += 1
+            fila.ultimo_error = error[:255]
+            if fila.intentos >= OUTBOX_MAX_INTENTOS:
+                fila.estatus = "fallido"
+                logger.error(
+                    "Aviso de factura pagada agotó reintentos",
+                    extra={"service": service_name, "cid": fila.factura_uuid},
+                )
+            else:
+                fila.proximo_intento = ahora + _backoff(fila.intentos)
+        db.commit()
+    finally:
+        db.close()
+
+
+class DespachadorFacturas:
+    """Tarea asyncio que drena el outbox hacia facturación en lotes."""
+
+    def __init__(
+        self,
+        base_url: str = FACTURACION_URL,
+        batch: int = OUTBOX_BATCH,
+        poll_segundos: float = OUTBOX_POLL_SEGUNDOS,
+        transport=None,
+    ) -> None:
+        self.base_url = base_url
+        self.batch = batch
+        self.poll_segundos = poll_segundos
+        self._transport = transport
+        self._client = None
+        self._task: asyncio.Task | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._despertar: asyncio.Event | None = None
+
+    def _crear_cliente(self):
+        return httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=FACTURACION_TIMEOUT_SEGUNDOS,
+            limits=httpx.Limits(
+                max_connections=FACTURACION_MAX_CONEXIONES,
+                max_keepalive_connections=FACTURACION_MAX_CONEXIONES,
+            ),
+            transport=self._transport,
+        )
+
+    def start(self) -> None:
+        if httpx is None:
+            logger.warning("[WARN] httpx no disponible; outbox de facturas sin despachar", extra={"service": service_name})
+            return
+        self._client = self._crear_cliente()
+        self._loop = asyncio.get_running_loop()
+        self._despertar = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def despertar(self) -> None:
+        """Adelanta el siguiente despacho; seguro de llamar desde el threadpool."""
+        if self._loop is not None and self._despertar is not None:
+            self._loop.call_soon_threadsafe(self._despertar.set)
+
+    async def despachar_una_vez(self) -> int:
+        filas = await asyncio.to_thread(reclamar, self.batch)
+        if not filas:
+            return 0
+        uuids = sorted({f.factura_uuid for f in filas})
+        try:
+            r = await self._client.patch("/facturacion/pagar-lote", json={"uuids": uuids})
+            r.raise_for_status()
+            no_encontradas = set(r.json().get("no_encontradas", []))
+        except Exception as exc:
+            logger.warning(
+                "no se pudo avisar a facturación",
+                extra={"service": service_name, "error": str(exc)},
+            )
+            await asyncio.to_thread(reprogramar, [f.id for f in filas], str(exc) or type(exc).__name__)
+            return len(filas)
+        entregados = [f.id for f in filas if f.factura_uuid not in no_encontradas]
+        await asyncio.to_thread(confirmar, entregados)
+        if no_encontradas:
+            # Puede que la factura aún no exista: se reintenta con backoff
+            await asyncio.to_thread(
+                reprogramar, [f.id for f in filas if f.factura_uuid in no_encontradas], "factura no encontrada"
+            )
+        logger.info(
+            f"[INFO] Outbox facturas: {len(entregados)}/{len(filas)} avisos entregados",
+            extra={"service": service_name},
+        )
+        return len(filas)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                enviados = await self.despachar_una_vez()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("despachador de outbox falló", extra={"service": service_name})
+                enviados = 0
+            # Lote completo: probablemente queda trabajo, seguir sin esperar
+            if enviados < self.batch:
+                try:
+                    await asyncio.wait_for(self._despertar.wait(), self.poll_segundos)
+                except asyncio.TimeoutError:
+                    pass
+                self._despertar.clear()
+
+
+despachador_facturas = DespachadorFacturas()
@@ -0,0 +1,115 @@
+"""
+Listado de pagos pendientes (no conciliados) paginado por cursor.
+
+Paginación keyset sobre (creado_en, id), resuelta con el índice parcial
+`ix_pagos_pendientes` (solo filas con estatus != "conciliado"): cada página
+cuesta lo mismo sin importar su posición, a diferencia de OFFSET. Se
+consultan columnas sueltas (sin hidratar objetos ORM) y el modo NDJSON lee
+con un cursor del servidor por bloques, así la memoria no crece con el
+número de pendientes.
+"""
+import base64
+import json
+import os
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Tuple
+
+from sqlalchemy import select, tuple_
+from sqlalchemy.orm import Session
+
+from ..db import SessionLocal
+from ..logging_conf import configure_logging
+from ..models import Pago
+
+
+service_name = os.getenv("SERVICE_NAME", "pagos")
+logger = configure_logging(service_name)
+
+PENDIENTES_LIMITE = int(os.getenv("PAGOS_PENDIENTES_LIMITE", "500"))
+PENDIENTES_LIMITE_MAX = int(os.getenv("PAGOS_PENDIENTES_LIMITE_MAX", "5000"))
+# Filas por bloque leído del cursor (y por chunk de la respuesta NDJSON)
+PENDIENTES_BLOQUE = int(os.getenv("PAGOS_PENDIENTES_BLOQUE", "1000"))
+
+
+class CursorInvalido(ValueError):
+    pass
+
+
+def codificar_cursor(creado_en: datetime, pago_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{creado_en.isoformat()}|{pago_id}".encode()).decode().rstrip("=")
+
+
+def decodificar_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        crudo = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        fecha, pago_id = crudo.rsplit("|", 1)
+        return datetime.fromisoformat(fecha), int(pago_id)
+    except Exception:
+        raise CursorInvalido("Cursor inválido")
+
+
+def _consulta(cursor: str | None):
+    stmt = (
+        select(
+            Pago.id,
+            Pago.referencia,
+            Pago.metodo,
+            Pago.monto,
+            Pago.estatus,
+            Pago.cliente_id,
+            Pago.creado_en,
+            Pago.factura_uuid,
+        )
+        # Mismo predicado que el índice parcial para que el planificador lo use
+        .where(Pago.estatus != "conciliado")
+        .order_by(Pago.creado_en, Pago.id)
+    )
+    if cursor:
+        stmt = stmt.where(tuple_(Pago.creado_en, Pago.id) > tuple_(*decodificar_cursor(cursor)))
+    return stmt
+
+
+def _serializar(fila) -> Dict[str, Any]:
+    # Mismas llaves que main._serialize_pago
+    return {
+        "referencia": fila.referencia,
+        "metodo": fila.metodo,
+        "monto": fila.monto,
+        "estatus": fila.estatus,
+        "clienteId": fila.cliente_id,
+        "creadoEn": fila.creado_en.isoformat(),
+        "facturaUuid": fila.factura_uuid,
+    }
+
+
+def pagina(db: Session, cursor: str | None = None, limite: int = PENDIENTES_LIMITE) -> Tuple[List[Dict[str, Any]], str | None]:
+    """Retorna (pagos, siguiente_cursor); el cursor es None en la última página."""
+    # Una fila extra indica si hay otra página sin un COUNT(*)
+    filas = db.execute(_consulta(cursor).limit(limite + 1)).all()
+    siguiente = None
+    if len(filas) > limite:
+        filas = filas[:limite]
+        siguiente = codificar_cursor(filas[-1].creado_en, filas[-1].id)
+    return [_serializar(f) for f in filas], siguiente
+
+
+def stream_ndjson(cursor: str | None = None, limite: int | None = None, bloque: int = PENDIENTES_BLOQUE) -> Iterator[str]:
+    """Emite los pendientes como NDJSON en chunks de `bloque` filas."""
+    # Validar antes del primer chunk: después ya no se puede responder 400
+    stmt = _consulta(cursor)
+    if limite:
+        stmt = stmt.limit(limite)
+
+    def _generar() -> Iterator[str]:
+        db: Session = SessionLocal()
+        try:
+            total = 0
+            resultado = db.execute(stmt.execution_options(yield_per=bloque))
+            for particion in resultado.partitions():
+                total += len(particion)
+                yield "".join(json.dumps(_serializar(f), ensure_ascii=False) + "\n" for f in particion)
+            logger.info(f"[INFO] Pendientes NDJSON: {total} pagos", extra={"service": service_name})
+        finally:
+            db.close()
+
+    return _generar()
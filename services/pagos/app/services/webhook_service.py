@@ -0,0 +1,193 @@
+"""
+Ingesta de webhooks de pasarelas de pago.
+
+El endpoint solo verifica la firma HMAC sobre los bytes crudos del cuerpo,
+descarta duplicados recientes con un set acotado en memoria y encola el
+evento. Un consumidor asyncio agrupa los eventos y los escribe en bloque con
+INSERT ... ON CONFLICT DO NOTHING: la restricción única de `webhooks.event_id`
+sigue siendo la deduplicación definitiva (otras réplicas, reinicios).
+
+El request espera a que su lote haga commit (group commit): solo se responde
+"ok" a eventos ya persistidos, y un event_id entra al set de vistos después
+del commit. Si la escritura falla se responde 503 y la pasarela reintenta;
+una caída con eventos en cola tampoco pierde nada, porque no se confirmaron.
+Al apagar se vacía la cola antes de salir.
+"""
+import asyncio
+import hashlib
+import hmac
+import os
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Tuple
+
+from sqlalchemy.orm import Session
+
+from ..db import SessionLocal, upsert_insert
+from ..logging_conf import configure_logging
+from ..models import WebhookLog
+
+
+service_name = os.getenv("SERVICE_NAME", "pagos")
+logger = configure_logging(service_name)
+
+WEBHOOK_BATCH = int(os.getenv("PAGOS_WEBHOOK_BATCH", "500"))
+WEBHOOK_FLUSH_MS = int(os.getenv("PAGOS_WEBHOOK_FLUSH_MS", "200"))
+# Eventos en espera antes de responder 503 (la pasarela reintenta)
+WEBHOOK_COLA_MAX = int(os.getenv("PAGOS_WEBHOOK_COLA_MAX", "10000"))
+WEBHOOK_DEDUP_MAX = int(os.getenv("PAGOS_WEBHOOK_DEDUP_MAX", "100000"))
+# Largo de webhooks.event_id: un id mayor haría fallar cada lote que lo incluya
+EVENT_ID_MAX = WebhookLog.__table__.c.event_id.type.length
+
+
+def firma_valida(secret: str, raw: bytes, firma: str) -> bool:
+    esperada = hmac.new(secret.encode("utf-8"), raw, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(esperada, firma.strip().lower())
+
+
+class RecientesVistos:
+    """Set acotado (FIFO) de event_id ya aceptados por esta réplica."""
+
+    def __init__(self, max_items: int = WEBHOOK_DEDUP_MAX) -> None:
+        self.max_items = max_items
+        self._ids: "OrderedDict[str, None]" = OrderedDict()
+
+    def __contains__(self, event_id: str) -> bool:
+        return event_id in self._ids
+
+    def agregar(self, event_id: str) -> None:
+        self._ids[event_id] = None
+        if len(self._ids) > self.max_items:
+            self._ids.popitem(last=False)
+
+
+class EscritorWebhooks:
+    """Cola de eventos con escritura en bloque desde una tarea asyncio."""
+
+    _FIN = object()
+
+    def __init__(
+        self,
+        batch: int = WEBHOOK_BATCH,
+        flush_ms: int = WEBHOOK_FLUSH_MS,
+        cola_max: int = WEBHOOK_COLA_MAX,
+        dedup_max: int = WEBHOOK_DEDUP_MAX,
+    ) -> None:
+        self.batch = batch
+        self.flush_segundos = flush_ms / 1000.0
+        self.cola_max = cola_max
+        self.vistos = RecientesVistos(dedup_max)
+        self._cola: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._cola = asyncio.Queue(maxsize=self.cola_max)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        # El consumidor escribe lo pendiente al encontrar el marcador de fin
+        await self._cola.put(self._FIN)
+        await self._task
+        self._task = None
+        self._cola = None
+
+    async def aceptar(self, event_id: str, payload: str) -> str:
+        """Retorna "ok" si se persistió, "ignored" si es duplicado, "lleno" si no hay
+        espacio en la cola y "error" si no se pudo escribir (el llamador no debe confirmar)."""
+        if event_id in self.vistos:
+            return "ignored"
+        evento = {"event_id": event_id, "payload": payload, "recibido_en": datetime.utcnow()}
+        if self._task is None:
+            # Sin consumidor (scripts, tests): escritura directa
+            (estado,) = await asyncio.to_thread(self._escribir, [evento])
+        else:
+            futuro = asyncio.get_running_loop().create_future()
+            try:
+                self._cola.put_nowait((evento, futuro))
+            except asyncio.QueueFull:
+                return "lleno"
+            estado = await futuro
+        if estado != "error":
+            self.vistos.agregar(event_id)
+        return estado
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        fin = False
+        while not fin:
+            item = await self._cola.get()
+            if item is self._FIN:
+                break
+            lote = [item]
+            limite = loop.time() + self.flush_segundos
+            while len(lote) < self.batch:
+                restante = limite - loop.time()
+                if restante <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._cola.get(), restante)
+                except asyncio.TimeoutError:
+                    break
+                if item is self._FIN:
+                    fin = True
+                    break
+                lote.append(item)
+            await self._escribir_lote(lote)
+
+    async def _escribir_lote(self, lote: List[Tuple[Dict[str, Any], asyncio.Future]]) -> None:
+        try:
+            estados = await asyncio.to_thread(self._escribir, [evento for evento, _ in lote])
+        except Exception:
+            logger.exception("escritura de webhooks falló", extra={"service": service_name})
+            estados = ["error"] * len(lote)
+        for (_, futuro), estado in zip(lote, estados):
+            if not futuro.done():
+                futuro.set_result(estado)
+
+    def _escribir(self, eventos: List[Dict[str, Any]]) -> List[str]:
+        """Inserta el lote ignorando event_id ya persistidos; retorna el estado de cada
+        evento: "ok" (nuevo), "ignored" (ya existía) o "error" (no se escribió)."""
+        db: Session = SessionLocal()
+        try:
+            # Core (no ORM bulk) con RETURNING para saber cuáles se insertaron
+            stmt = (
+                upsert_insert(db)(WebhookLog.__table__)
+                .on_conflict_do_nothing(index_elements=["event_id"])
+                .returning(WebhookLog.__table__.c.event_id)
+            )
+            try:
+                nuevos = set(db.execute(stmt, eventos).scalars())
+                db.commit()
+                estados = []
+                for evento in eventos:
+                    # Repetido dentro del mismo lote: solo el primero cuenta como nuevo
+                    estados.append("ok" if evento["event_id"] in nuevos else "ignored")
+                    nuevos.discard(evento["event_id"])
+            except Exception:
+                # Un evento inválido no tira el lote completo: se reintenta uno por uno
+                db.rollback()
+                estados = []
+                for evento in eventos:
+                    try:
+                        insertado = db.execute(stmt, [evento]).first() is not None
+                        db.commit()
+                        estados.append("ok" if insertado else "ignored")
+                    except Exception:
+                        db.rollback()
+                        logger.exception(
+                            "webhook no persistido", extra={"service": service_name, "cid": evento["event_id"]}
+                        )
+                        estados.append("error")
+            if len(eventos) > 1:
+                logger.info(
+                    f"[INFO] Webhooks: {estados.count('ok')}/{len(eventos)} nuevos escritos en bloque",
+                    extra={"service": service_name},
+                )
+            return estados
+        finally:
+            db.close()
+
+
+escritor_webhooks = EscritorWebhooks()